@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Run the conversion of many forecast runs, optionally in a process pool
+
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import instrument
+
+
+def _call(func, label, args):
+    # one span per run, also in the worker processes
+    with instrument.span('run', run=label):
+        return func(*args)
+
+
+def run_batch(func, tasks, jobs=1):
+    '''
+    Call func(*args) for every task and return a summary of the runs.
+    func returns False if a run was skipped. Exceptions are printed and
+    counted as failed runs, they do not stop the remaining runs.
+
+    With jobs > 1 the runs are converted in a pool of jobs processes, at most
+    jobs runs are in memory at the same time.
+
+    Parameters
+    ----------
+    func : callable
+        Module level function converting one run
+    tasks : OrderedDict
+        {label of the run: tuple of arguments for func}
+    jobs : int
+        Number of runs converted in parallel
+
+    Returns
+    -------
+    summary : OrderedDict
+        Labels of the 'completed', 'failed' and 'skipped' runs
+    '''
+    summary = OrderedDict([('completed', []), ('failed', []), ('skipped', [])])
+
+    def record(label, result=None, err=None):
+        if err is not None:
+            print("failed ", label, ": ", err)
+            summary['failed'].append(label)
+        elif result is False:
+            summary['skipped'].append(label)
+        else:
+            summary['completed'].append(label)
+
+    if jobs <= 1:
+        for label, args in tasks.items():
+            try:
+                record(label, _call(func, label, args))
+            except Exception as err:
+                record(label, err=err)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(_call, func, label, args): label
+                       for label, args in tasks.items()}
+            for future in as_completed(futures):
+                try:
+                    record(futures[future], future.result())
+                except Exception as err:
+                    record(futures[future], err=err)
+
+    print("%d runs completed, %d failed, %d skipped"
+          % tuple(len(v) for v in summary.values()))
+    for label in summary['failed']:
+        print("  failed: ", label)
+    return summary
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Local stand-in for the GDPS datamart and the GFS order pages: a threaded
+# HTTP server with directory listings (href links, like the index pages)
+# and Range requests, serving the synthetic fixtures.
+
+
+import os
+import os.path
+import re
+import sys
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+RANGE_RE = re.compile(r'bytes=(\d+)-(\d*)$')
+
+
+class DatamartHandler(SimpleHTTPRequestHandler):
+    '''
+    Directory listings and files of a folder, with single Range requests
+    answered by 206 Partial Content.
+    '''
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        match = RANGE_RE.match(self.headers.get('Range', ''))
+        if match is None or not os.path.isfile(path):
+            return super().send_head()
+
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        if start >= size:
+            self.send_error(416, "Requested Range Not Satisfiable")
+            return None
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Last-Modified", self.date_time_string(int(os.path.getmtime(path))))
+        self.end_headers()
+        return _Limited(f, end - start + 1)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Limited:
+    # file object returning at most length bytes, for copyfile of send_head
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def serve(directory, port=0):
+    '''
+    Serve directory in a background thread. Returns the server (stop it
+    with server.shutdown()) and its base url.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port),
+                                 partial(DatamartHandler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, "http://127.0.0.1:%d/" % server.server_port
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit("Use with %s <directory> [port]" % sys.argv[0])
+    server, url = serve(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 8000)
+    print("Serving {} at {}".format(sys.argv[1], url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Benchmarks of the download and conversion stages on synthetic fixtures.
+# The fixtures are generated into a work folder and served by a local
+# stand-in of the datamart (datamart_server). Every stage runs in a fresh
+# process, its wall time, throughput and peak RSS are written to a json
+# file, which can be compared against a stored baseline.
+#
+# Use with:
+#   python benchmarks/run_benchmarks.py -o results.json
+#   python benchmarks/run_benchmarks.py --baseline results.json
+
+
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import importlib
+import datetime
+import resource
+import multiprocessing
+from collections import OrderedDict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import numpy as np
+import synthetic_grib
+import datamart_server
+
+
+RUN = datetime.datetime(2020, 1, 1, 0)
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _size(files):
+    return sum(os.path.getsize(f) for f in files)
+
+
+def stage_list_gdps(ctx):
+    import datamart_index
+    import download_gdps_grib
+    index = datamart_index.crawl(ctx['gdps_url'], download_gdps_grib.make_session())
+    return {'files': len(index), 'bytes': 0}
+
+
+def stage_download_gdps(ctx):
+    import download_gdps_grib
+    dest = os.path.join(ctx['work'], 'download_gdps')
+    shutil.rmtree(dest, ignore_errors=True)
+    failed = download_gdps_grib.download_grib_files_concurrent(ctx['gdps_links'], dest,
+                                                               ctx['workers'])
+    if failed:
+        raise RuntimeError("{} downloads failed".format(len(failed)))
+    return {'files': len(ctx['gdps_links']), 'bytes': _size(ctx['gdps_files'])}
+
+
+def stage_download_gfs(ctx):
+    import fileDownload
+    dest = os.path.join(ctx['work'], 'download_gfs')
+    shutil.rmtree(dest, ignore_errors=True)
+    links = fileDownload.get_file_links(ctx['gfs_url'])
+    fileDownload.download_tar_files(links, dest)
+    return {'files': len(links), 'bytes': _size([ctx['gfs_tar']])}
+
+
+def stage_decode_gdps(ctx):
+    import convert_gdps_xarray
+    for f in ctx['gdps_files']:
+        convert_gdps_xarray.extract_param(f)
+    return {'files': len(ctx['gdps_files']), 'bytes': _size(ctx['gdps_files'])}
+
+
+def stage_decode_gfs(ctx):
+    import grib_to_xarray
+    for f in ctx['gfs_files']:
+        grib_to_xarray.read_messages(f, ctx['gfs_vars'])
+    return {'files': len(ctx['gfs_files']), 'bytes': _size(ctx['gfs_files'])}
+
+
+def stage_write_gdps(ctx):
+    import convert_gdps_xarray
+    convert_gdps_xarray.convert_to_netcdf(list(ctx['gdps_files']),
+                                          os.path.join(ctx['work'], 'gdps.nc'))
+    return {'files': len(ctx['gdps_files']), 'bytes': _size(ctx['gdps_files'])}
+
+
+def stage_stream_gdps(ctx):
+    import convert_gdps_xarray
+    convert_gdps_xarray.stream_to_netcdf(ctx['gdps_files'],
+                                         os.path.join(ctx['work'], 'gdps_stream.nc'))
+    return {'files': len(ctx['gdps_files']), 'bytes': _size(ctx['gdps_files'])}
+
+
+def stage_write_gfs(ctx):
+    import grib_to_xarray
+    grib_to_xarray.convert_to_netcdf(list(ctx['gfs_files']), os.path.join(ctx['work'], 'gfs.nc'),
+                                     *ctx['gfs_vars'])
+    return {'files': len(ctx['gfs_files']), 'bytes': _size(ctx['gfs_files'])}
+
+
+def stage_stream_gfs(ctx):
+    import grib_to_xarray
+    grib_to_xarray.stream_to_netcdf(ctx['gfs_files'], os.path.join(ctx['work'], 'gfs_stream.nc'),
+                                    *ctx['gfs_vars'])
+    return {'files': len(ctx['gfs_files']), 'bytes': _size(ctx['gfs_files'])}
+
+
+def stage_sites_gdps(ctx):
+    import convert_gdps_xarray
+    convert_gdps_xarray.extract_sites(ctx['gdps_files'], ctx['locations'],
+                                      os.path.join(ctx['work'], 'gdps_sites.nc'))
+    return {'files': len(ctx['gdps_files']), 'bytes': _size(ctx['gdps_files'])}
+
+
+def stage_tar_gfs(ctx):
+    import fileDownload
+    fileDownload.stream_tars_to_csv(os.path.dirname(ctx['gfs_tar']),
+                                    os.path.join(ctx['work'], 'gfs.csv'),
+                                    ctx['bbox'], *ctx['gfs_vars'])
+    return {'files': len(ctx['gfs_files']), 'bytes': _size([ctx['gfs_tar']])}
+
+
+# stage name: (function, modules imported before timing, description)
+STAGES = OrderedDict([
+    ('list_gdps', (stage_list_gdps, ['datamart_index', 'download_gdps_grib'],
+                   "crawl the datamart index")),
+    ('download_gdps', (stage_download_gdps, ['download_gdps_grib'],
+                       "concurrent download of a GDPS run")),
+    ('download_gfs', (stage_download_gfs, ['fileDownload'], "download of a GFS order")),
+    ('decode_gdps', (stage_decode_gdps, ['convert_gdps_xarray'], "decode all GDPS files")),
+    ('decode_gfs', (stage_decode_gfs, ['grib_to_xarray'], "decode all GFS files")),
+    ('write_gdps', (stage_write_gdps, ['convert_gdps_xarray'],
+                    "stack and write a GDPS run to NetCDF")),
+    ('stream_gdps', (stage_stream_gdps, ['convert_gdps_xarray'],
+                     "stream a GDPS run to NetCDF")),
+    ('write_gfs', (stage_write_gfs, ['grib_to_xarray'], "stack and write a GFS run to NetCDF")),
+    ('stream_gfs', (stage_stream_gfs, ['grib_to_xarray'], "stream a GFS run to NetCDF")),
+    ('sites_gdps', (stage_sites_gdps, ['convert_gdps_xarray'],
+                    "extract the sites from a GDPS run")),
+    ('tar_gfs', (stage_tar_gfs, ['fileDownload'], "decode a GFS tar in-stream to csv")),
+])
+
+
+def _run_stage(name, ctx):
+    # runs in a fresh process, the modules are imported before timing
+    func, modules, _ = STAGES[name]
+    for module in modules:
+        importlib.import_module(module)
+    start_rss = _peak_rss_mb()
+    start = time.perf_counter()
+    result = func(ctx)
+    result['seconds'] = time.perf_counter() - start
+    result['peak_rss_mb'] = _peak_rss_mb()
+    result['start_rss_mb'] = start_rss
+    return result
+
+
+def run_stage(name, ctx, repeat=1):
+    '''
+    Run a stage repeat times, each in a new process, and return the
+    fastest time, the throughput and the highest peak RSS.
+    An exception of the stage is returned as error.
+    '''
+    mp = multiprocessing.get_context('spawn')
+    runs = []
+    for i in range(repeat):
+        with mp.Pool(1) as pool:
+            try:
+                runs.append(pool.apply(_run_stage, (name, ctx)))
+            except Exception as err:
+                return {'error': "{}: {}".format(type(err).__name__, err)}
+    best = min(runs, key=lambda r: r['seconds'])
+    result = OrderedDict([
+        ('seconds', best['seconds']),
+        ('files', best['files']),
+        ('bytes', best['bytes']),
+        ('files_per_s', best['files'] / best['seconds']),
+        ('mb_per_s', best['bytes'] / 1024**2 / best['seconds']),
+        ('peak_rss_mb', max(r['peak_rss_mb'] for r in runs)),
+        ('start_rss_mb', min(r['start_rss_mb'] for r in runs)),
+    ])
+    return result
+
+
+def make_fixtures(work, nj, ni, steps, sites, seed=0):
+    '''
+    Generate the fixtures into work and return the context of the stages
+    (without the urls of the server).
+    '''
+    served = os.path.join(work, 'served')
+    gdps_files = synthetic_grib.write_gdps_run(os.path.join(served, 'gdps'), RUN, nj, ni,
+                                               steps, datamart=True, seed=seed)
+    gfs_files = synthetic_grib.write_gfs_run(os.path.join(work, 'gfs'), RUN, nj, ni,
+                                             steps, seed=seed)
+    os.makedirs(os.path.join(served, 'gfs'), exist_ok=True)
+    gfs_tar = synthetic_grib.write_tar(
+        os.path.join(served, 'gfs', RUN.strftime('gfs_4_%Y%m%d%H.g2.tar')), gfs_files)
+
+    rng = np.random.default_rng(seed)
+    locations = OrderedDict(('site%d' % i, (float(lat), float(lon))) for i, (lat, lon) in
+                            enumerate(zip(rng.uniform(-80, 80, sites), rng.uniform(-179, 179, sites))))
+
+    import pygrib
+    with pygrib.open(gfs_files[0]) as grbs:
+        gfs_vars = [grb.name for grb in grbs]
+    return {'work': work, 'served': served, 'gdps_files': sorted(gdps_files),
+            'gfs_files': sorted(gfs_files), 'gfs_tar': gfs_tar, 'gfs_vars': gfs_vars,
+            'locations': locations, 'bbox': [40.0, 0.0, 60.0, 20.0]}
+
+
+def warm_grid_cache(ctx):
+    '''
+    Fill the grid cache before timing, as in steady operation, so that the
+    first timed stage does not pay for computing the coordinates.
+    '''
+    import pygrib
+    import grid_cache
+    for f in (ctx['gdps_files'][0], ctx['gfs_files'][0]):
+        with pygrib.open(f) as grbs:
+            grid_cache.get_grid(grbs.message(1))
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Print the stages next to the baseline and return the names of the
+    stages that are more than tolerance (fraction) slower.
+    '''
+    slower = []
+    print("%-14s %10s %10s %8s %10s" % ("stage", "seconds", "baseline", "ratio", "rss MB"))
+    for name, result in results['stages'].items():
+        base = baseline.get('stages', {}).get(name, {})
+        if 'error' in result:
+            print("%-14s %s" % (name, result['error']))
+            continue
+        if 'seconds' not in base:
+            print("%-14s %10.3f %10s %8s %10.1f" % (name, result['seconds'], "-", "-",
+                                                     result['peak_rss_mb']))
+            continue
+        ratio = result['seconds'] / base['seconds']
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = " slower"
+            slower.append(name)
+        elif ratio < 1 - tolerance:
+            flag = " faster"
+        print("%-14s %10.3f %10.3f %8.2f %10.1f%s" % (name, result['seconds'], base['seconds'],
+                                                      ratio, result['peak_rss_mb'], flag))
+    config = dict(results['config'], repeat=None)
+    if baseline and dict(baseline.get('config', {}), repeat=None) != config:
+        print("Note: the baseline was recorded with a different configuration")
+    return slower
+
+
+def main(output=None, baseline=None, grid=(181, 360), steps=9, sites=1000, stages=None,
+         repeat=1, workers=8, tolerance=0.2, workdir=None):
+    '''
+    Generate the fixtures, run the stages and write the results to output.
+    Returns the results and the list of stages slower than the baseline.
+    '''
+    nj, ni = grid
+    stages = list(stages or STAGES)
+    work = workdir or tempfile.mkdtemp(prefix='gribbench_')
+    os.makedirs(work, exist_ok=True)
+    try:
+        print("Generating fixtures in {}".format(work))
+        ctx = make_fixtures(work, nj, ni, [3 * i for i in range(steps)], sites)
+        server, url = datamart_server.serve(ctx['served'])
+        ctx['gdps_url'] = url + 'gdps/'
+        ctx['gfs_url'] = url + 'gfs/'
+        ctx['workers'] = workers
+        ctx['gdps_links'] = sorted(url + os.path.relpath(f, ctx['served'])
+                                   for f in ctx['gdps_files'])
+        warm_grid_cache(ctx)
+
+        results = OrderedDict()
+        results['config'] = OrderedDict([('grid', [nj, ni]), ('steps', steps),
+                                         ('sites', sites), ('repeat', repeat),
+                                         ('workers', workers)])
+        results['machine'] = OrderedDict([
+            ('python', platform.python_version()), ('platform', platform.platform()),
+            ('cpus', os.cpu_count()), ('date', datetime.datetime.now().isoformat())])
+        results['stages'] = OrderedDict()
+        for name in stages:
+            print("{}: {}".format(name, STAGES[name][2]))
+            results['stages'][name] = run_stage(name, ctx, repeat)
+        server.shutdown()
+    finally:
+        if workdir is None:
+            shutil.rmtree(work, ignore_errors=True)
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    slower = []
+    if baseline is not None:
+        with open(baseline) as f:
+            slower = compare(results, json.load(f), tolerance)
+    else:
+        compare(results, {}, tolerance)
+    return results, slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark download and conversion stages "
+                                                 "on synthetic grib fixtures")
+    parser.add_argument("-o", "--output", default=None, help="json file for the results")
+    parser.add_argument("-b", "--baseline", default=None,
+                        help="json file of an earlier run to compare against")
+    parser.add_argument("--grid", nargs=2, type=int, default=[181, 360], metavar=("NJ", "NI"),
+                        help="Grid points in latitude and longitude (GDPS: 751 1500)")
+    parser.add_argument("--steps", type=int, default=9, help="Forecast steps (3 hourly)")
+    parser.add_argument("--sites", type=int, default=1000,
+                        help="Number of locations for the site extraction")
+    parser.add_argument("--stages", nargs="+", default=None, choices=list(STAGES),
+                        help="Stages to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Runs per stage, the fastest is reported")
+    parser.add_argument("-j", "--workers", type=int, default=8, help="Download workers")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative slowdown against the baseline reported as regression")
+    parser.add_argument("--workdir", default=None,
+                        help="Keep the fixtures and outputs in this folder")
+    args = parser.parse_args()
+    results, slower = main(args.output, args.baseline, args.grid, args.steps, args.sites,
+                           args.stages, args.repeat, args.workers, args.tolerance,
+                           args.workdir)
+    failed = [name for name, result in results['stages'].items() if 'error' in result]
+    problems = []
+    if failed:
+        problems.append("Failed: {}".format(", ".join(failed)))
+    if slower:
+        problems.append("Slower than the baseline: {}".format(", ".join(slower)))
+    if problems:
+        sys.exit("\n".join(problems))
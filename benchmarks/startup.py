@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Start-up time of the commands of grib_cli. Every command is started in a
+# fresh interpreter that imports grib_cli and the module of the command,
+# as the command does before it starts working. The median over a few
+# repeats is compared against the budget of the command, the downloads
+# must not import any of the scientific packages at all.
+#
+# Use with:
+#   python benchmarks/startup.py
+#   python benchmarks/startup.py --repeat 10 --scale 2
+
+
+import os
+import os.path
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# command: seconds until the work can start
+BUDGETS = {
+    "download gdps": 0.5,
+    "download gfs": 0.5,
+    "download subset": 0.5,
+    "convert gdps": 2.0,
+    "convert gfs": 2.0,
+    "extract": 2.0,
+}
+
+# packages the downloads have no use for
+HEAVY = ["numpy", "pandas", "xarray", "pygrib", "pvlib", "matplotlib", "netCDF4", "dask"]
+
+PROBE = '''
+import sys, json
+import grib_cli
+grib_cli._load({command!r})
+print(json.dumps([m for m in {heavy!r} if m in sys.modules]))
+'''
+
+
+def probe(command):
+    '''
+    Start-up of command in a fresh interpreter, returns the wall time
+    including the interpreter and the heavy packages loaded.
+    '''
+    code = PROBE.format(command=command, heavy=HEAVY)
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True,
+                         capture_output=True, text=True).stdout
+    return {"seconds": time.perf_counter() - start,
+            "heavy": json.loads(out.splitlines()[-1])}
+
+
+def main(commands=None, repeat=5, scale=1.0):
+    '''
+    Measure the commands and print the median against the budget.
+    Returns the list of commands over budget or loading heavy packages.
+    '''
+    failed = []
+    for command in commands or BUDGETS:
+        results = [probe(command) for _ in range(repeat)]
+        seconds = sorted(r["seconds"] for r in results)[len(results) // 2]
+        budget = BUDGETS[command] * scale
+        heavy = results[0]["heavy"] if command.startswith("download") else []
+        ok = seconds <= budget and not heavy
+        print("{:16s} {:6.3f} s (budget {:.2f} s){}{}".format(
+            command, seconds, budget, "" if ok else "  OVER",
+            "  imports " + ", ".join(heavy) if heavy else ""))
+        if not ok:
+            failed.append(command)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the start-up time of the commands")
+    parser.add_argument("commands", nargs="*",
+                        help="Commands to check, quoted, e.g. 'download gdps' (default: all)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Runs per command, the median is compared")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Factor for the budgets, e.g. on slow machines")
+    args = parser.parse_args()
+    unknown = [c for c in args.commands if c not in BUDGETS]
+    if unknown:
+        parser.error("unknown commands: {}".format(", ".join(unknown)))
+    failed = main(args.commands, args.repeat, args.scale)
+    if failed:
+        sys.exit("Over the start-up budget: {}".format(", ".join(failed)))
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Synthetic grib2 fixtures for the benchmarks: GDPS style runs with one
+# field per file (CMC_glb_*.grib2, optionally in the folder layout of the
+# datamart) and GFS style runs with several fields per file (gfs_4_*.grb2)
+# packed into tar archives like the NCEI orders.
+# The messages use a regular lat/lon grid (template 3.0), an analysis or
+# forecast at a point in time (template 4.0) and 16 bit simple packing
+# (template 5.0), which pygrib/eccodes decode like the real files.
+
+
+import os
+import os.path
+import struct
+import tarfile
+import numpy as np
+
+
+# discipline 0 parameter category and number
+PARAMS = {
+    "TMP": (0, 0),
+    "DSWRF": (4, 7),
+    "TCDC": (6, 1),
+    "WIND": (2, 1),
+    "WDIR": (2, 0),
+}
+
+# type of the first fixed surface
+LEVELS = {"SFC": 1, "ISBL": 100, "TGL": 103}
+
+# range of the random values per parameter
+RANGES = {
+    "TMP": (220.0, 310.0),
+    "DSWRF": (0.0, 1000.0),
+    "TCDC": (0.0, 100.0),
+    "WIND": (0.0, 30.0),
+    "WDIR": (0.0, 360.0),
+}
+
+# (parameter, level type, level) of the files of a GDPS run
+GDPS_FIELDS = [("DSWRF", "SFC", 0), ("TCDC", "SFC", 0),
+               ("TMP", "ISBL", 850), ("TMP", "ISBL", 1000),
+               ("WIND", "TGL", 10), ("WDIR", "TGL", 10)]
+
+# fields in every file of a GFS run
+GFS_FIELDS = [("DSWRF", "SFC", 0), ("TMP", "ISBL", 850)]
+
+
+def _signed32(value):
+    # grib2 stores negative integers as sign bit and magnitude
+    value = int(round(value))
+    return struct.pack(">I", (abs(value) | 0x80000000) if value < 0 else value)
+
+
+def encode(values, run, step, param, level_type, level,
+           lat0=90.0, lon0=-180.0, dlat=1.0, dlon=1.0, centre=54):
+    '''
+    Encode a field as a grib2 message and return its bytes.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        2-D field (latitude, longitude), rows from lat0 southwards
+    run : datetime.datetime
+        Reference time of the forecast
+    step : int
+        Forecast hour
+    param, level_type, level :
+        Key of PARAMS, key of LEVELS and the level (hPa for ISBL)
+    lat0, lon0, dlat, dlon : float
+        First grid point and increments in degrees
+    centre : int
+        Originating centre, 54 is Montreal, 7 is NCEP
+    '''
+    nj, ni = values.shape
+    category, number = PARAMS[param]
+    sec1 = struct.pack(">IBHHBBBHBBBBBBB", 21, 1, centre, 0, 2, 0, 1,
+                       run.year, run.month, run.day, run.hour, 0, 0, 0, 1)
+
+    lat2, lon2 = lat0 - (nj - 1) * dlat, lon0 + (ni - 1) * dlon
+    template3 = (struct.pack(">BBIBIBI", 6, 0, 0, 0, 0, 0, 0)
+                 + struct.pack(">IIII", ni, nj, 0, 0)
+                 + _signed32(lat0 * 1e6) + _signed32((lon0 % 360) * 1e6)
+                 + struct.pack(">B", 48)
+                 + _signed32(lat2 * 1e6) + _signed32((lon2 % 360) * 1e6)
+                 + struct.pack(">II", int(round(dlon * 1e6)), int(round(dlat * 1e6)))
+                 + struct.pack(">B", 0))
+    sec3 = struct.pack(">IBBIBBH", 14 + len(template3), 3, 0, ni * nj, 0, 0, 0) + template3
+
+    value = level * 100 if level_type == "ISBL" else level
+    template4 = struct.pack(">BBBBBHBBIBBIBBI", category, number, 2, 0, 0, 0, 0, 1, step,
+                            LEVELS[level_type], 0, value, 255, 0, 0)
+    sec4 = struct.pack(">IBHH", 9 + len(template4), 4, 0, 0) + template4
+
+    # simple packing: value = (R + x * 2**E) / 10**D
+    decimal = 2
+    scaled = values.astype("f8").ravel() * 10 ** decimal
+    reference = np.float32(scaled.min())
+    span = scaled.max() - reference
+    binary = int(np.ceil(np.log2(span / 65535.0))) if span > 0 else 0
+    packed = np.round((scaled - reference) / 2.0 ** binary).clip(0, 65535).astype(">u2")
+    sec5 = (struct.pack(">IBIH", 21, 5, ni * nj, 0) + struct.pack(">f", reference)
+            + struct.pack(">HHBB", (abs(binary) | 0x8000) if binary < 0 else binary,
+                          decimal, 16, 0))
+    sec6 = struct.pack(">IBB", 6, 6, 255)
+    data = packed.tobytes()
+    sec7 = struct.pack(">IB", 5 + len(data), 7) + data
+
+    body = sec1 + sec3 + sec4 + sec5 + sec6 + sec7 + b"7777"
+    return b"GRIB" + struct.pack(">HBBQ", 0, 0, 2, 16 + len(body)) + body
+
+
+def random_field(rng, param, nj, ni):
+    '''
+    Smooth random field of shape (nj, ni) in the value range of param.
+    '''
+    low, high = RANGES[param]
+    y = np.linspace(0, np.pi, nj)[:, np.newaxis]
+    x = np.linspace(0, 2 * np.pi, ni)[np.newaxis, :]
+    field = 0.5 + 0.3 * np.sin(y) * np.cos(x + rng.uniform(0, 2 * np.pi))
+    field = field + 0.2 * rng.random((nj, ni))
+    return low + (high - low) * field
+
+
+def write_gdps_run(path, run, nj, ni, steps, datamart=False, seed=0):
+    '''
+    Write the grib files of a GDPS run on a global grid of nj x ni points
+    with the forecast hours steps (step 0 has no DSWRF, like the real runs).
+    With datamart=True the files are placed like on the datamart,
+    <path>/<HH>/<SSS>/CMC_glb_..., otherwise all into path.
+    Returns the list of files.
+    '''
+    rng = np.random.default_rng(seed)
+    dlat, dlon = 180.0 / (nj - 1), 360.0 / ni
+    files = []
+    for param, level_type, level in GDPS_FIELDS:
+        for step in steps:
+            if param == "DSWRF" and step == 0:
+                continue
+            folder = path
+            if datamart:
+                folder = os.path.join(path, run.strftime("%H"), "%03d" % step)
+            os.makedirs(folder, exist_ok=True)
+            name = "CMC_glb_%s_%s_%d_latlon.24x.24_%s_P%03d.grib2" % (
+                param, level_type, level, run.strftime("%Y%m%d%H"), step)
+            message = encode(random_field(rng, param, nj, ni), run, step, param, level_type,
+                             level, lat0=90.0, lon0=-180.0, dlat=dlat, dlon=dlon, centre=54)
+            with open(os.path.join(folder, name), "wb") as f:
+                f.write(message)
+            files.append(os.path.join(folder, name))
+    return files
+
+
+def write_gfs_run(path, run, nj, ni, steps, seed=0):
+    '''
+    Write the grib files of a GFS run (all GFS_FIELDS in every file) on a
+    global 0..360 grid of nj x ni points. Returns the list of files.
+    '''
+    rng = np.random.default_rng(seed)
+    dlat, dlon = 180.0 / (nj - 1), 360.0 / ni
+    os.makedirs(path, exist_ok=True)
+    files = []
+    for step in steps:
+        name = "gfs_4_%s_%s00_%03d.grb2" % (run.strftime("%Y%m%d"), run.strftime("%H"), step)
+        with open(os.path.join(path, name), "wb") as f:
+            for param, level_type, level in GFS_FIELDS:
+                f.write(encode(random_field(rng, param, nj, ni), run, step, param, level_type,
+                               level, lat0=90.0, lon0=0.0, dlat=dlat, dlon=dlon, centre=7))
+        files.append(os.path.join(path, name))
+    return files
+
+
+def write_tar(tarpath, files):
+    '''
+    Pack files into an uncompressed tar archive, like a GFS order.
+    '''
+    with tarfile.open(tarpath, "w") as tar:
+        for f in files:
+            tar.add(f, arcname=os.path.basename(f))
+    return tarpath
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# State of the converted outputs for incremental conversions. Next to every
+# output a sidecar file (<output>.state.json) records the grib files it was
+# built from, with their size and modification time, and the options of the
+# conversion. Comparing it with the files of the run tells whether the output
+# is up to date, only has to be extended by new files (e.g. steps of a GDPS
+# run that arrived since) or has to be built again.
+#
+# The state is removed before an output is changed and written after it is
+# complete, an interrupted conversion leaves no state and is redone.
+
+
+import os
+import os.path
+import json
+
+
+STATE_SUFFIX = ".state.json"
+
+CURRENT = "current"
+APPEND = "append"
+REBUILD = "rebuild"
+
+
+def state_path(output):
+    # sidecar file of output
+    return output + STATE_SUFFIX
+
+
+def input_state(files):
+    '''
+    {path: [size, modification time in ns]} of the input files.
+    '''
+    state = {}
+    for f in files:
+        st = os.stat(f)
+        state[f] = [st.st_size, st.st_mtime_ns]
+    return state
+
+
+def _normalize(options):
+    # as read back from json, e.g. tuples become lists
+    return json.loads(json.dumps(options, sort_keys=True))
+
+
+def load_state(output):
+    '''
+    State recorded for output, None if there is none.
+    '''
+    path = state_path(output)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_state(output, files, options):
+    '''
+    Record the input files and options output was built from, through
+    a temporary file.
+    '''
+    tmp = state_path(output) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"options": _normalize(options), "inputs": input_state(files)},
+                  f, indent=1, sort_keys=True)
+    os.replace(tmp, state_path(output))
+
+
+def clear_state(output):
+    '''
+    Remove the state of output, before output is changed.
+    '''
+    if os.path.exists(state_path(output)):
+        os.remove(state_path(output))
+
+
+def check(output, files, options):
+    '''
+    Compare output with the input files and options of a conversion.
+    Returns (status, new files): CURRENT if output exists and was built from
+    the same files with the same options, APPEND if files only adds files to
+    those (the new ones are returned, sorted), REBUILD otherwise.
+
+    Parameters:
+    --------------------
+    output: path of the converted file (string)
+    files: grib files of the run (list of strings)
+    options: options of the conversion that change the output (dict)
+    '''
+    state = load_state(output)
+    if state is None or not os.path.exists(output) \
+            or state["options"] != _normalize(options):
+        return REBUILD, list(files)
+    current = input_state(files)
+    recorded = state["inputs"]
+    if any(current.get(f) != info for f, info in recorded.items()):
+        # a file changed or is gone
+        return REBUILD, list(files)
+    new = sorted(f for f in current if f not in recorded)
+    return (APPEND if new else CURRENT), new
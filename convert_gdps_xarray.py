@@ -9,11 +9,18 @@ import pandas as pd
 import numpy as np
 import datetime
 import re
-import glob
-from pylab import rcParams
 import xarray as xr
 import pygrib
 from collections import OrderedDict
+import datamart_index
+import netcdf_output
+import batch
+import grid_index
+import grid_cache
+import instrument
+import file_catalog
+import file_filter
+import build_state
 
 VAR = {"GHI": "DSWRF_SFC",
        "Wind speed": "WIND_TGL",
@@ -23,26 +30,21 @@ VAR = {"GHI": "DSWRF_SFC",
 
 LOCATIONLIST = {"Freiburg": (48.00000000000081, 7.919999999999624)}
 
+# step and level dimension of each variable in the netcdf files
+DIMS = {"DSWRF_SFC": ('step_ghi', None),
+        "TCDC_SFC": ('step_cloud', None),
+        "TMP_ISBL": ('step_temp', 'air_pressure'),
+        "WIND_TGL": ('step_wind', 'ground_level'),
+        "WDIR_TGL": ('step_wind', 'ground_level')}
 
-def get_filenames(source):
-    '''
-    Create filenames for GDPS forecast files
-
-    Parameters
-    --------------------------------------
-    source: path to grib files
-    '''
-    fns = glob.glob(os.path.join(source, "CMC_*.grib2"))
-    fns.sort()
-    df = pd.DataFrame()
-    df["names"] = fns
-    df["dates"] = df["names"].apply(lambda x: pd.Timestamp(x[-21:-13]))
-    return df
 
-
-def extract_param(filename):
+def extract_param(filename, region=None):
     '''
     Extract parameters from grib files and return it as an array.
+    If region (lat1, lon1, lat2, lon2) is given, the field is cropped
+    to it right after decoding.
+    Raises ValueError if the file holds no readable message, so that a
+    broken file stops the forecast instead of leaving a hole in it.
     Note:
     ------
     As for GDPS there is only one variable in each file,
@@ -51,13 +53,30 @@ def extract_param(filename):
     try:
         with pygrib.open(filename) as grbs:
             grb = grbs.select()[0]
-            data, lats, lons = grb.data()
+            data = grb.values
+            if region is not None:
+                indexer, lats, lons = grid_index.index_for_message(grb).crop(region)
+                data = data[indexer]
         return data
-    except ValueError:
-        print("Parameter not found: {}".format(filename))
+    except (ValueError, OSError, IndexError) as err:
+        raise ValueError("Parameter not found: {} ({})".format(filename, err))
+
+
+def decode_and_stack(files, region=None, variable=None):
+    '''
+    Decode the grib files of one variable and stack the fields
+    along a new first axis, see extract_param.
+    '''
+    with instrument.span('decode', variable=variable) as span:
+        fields = [extract_param(f, region) for f in files]
+        span.add(messages=len(fields), bytes_in=instrument.file_bytes(files))
+    with instrument.span('stack', variable=variable) as span:
+        forecast = np.stack(fields)
+        span.add(bytes_out=forecast.nbytes)
+    return forecast
 
 
-def convert_to_netcdf(files, outfilepath):
+def convert_to_netcdf(files, outfilepath, profile=None, region=None):
 
     '''
     This function convert grib files to netcdf file
@@ -71,6 +90,8 @@ def convert_to_netcdf(files, outfilepath):
 
     files: path to grib files
     outfilepath: path to store the netcdf files
+    profile: encoding profile, see netcdf_output.load_profile
+    region: bounding box (lat1, lon1, lat2, lon2) to crop the fields to
 
     '''
 
@@ -82,16 +103,20 @@ def convert_to_netcdf(files, outfilepath):
     cloud_dims = ['forecastdate', 'forecasttime', 'step_cloud', 'x', 'y']
     temp_dims = ['forecastdate', 'forecasttime', 'step_temp', 'air_pressure', 'x', 'y']
     wind_dims = ['forecastdate', 'forecasttime', 'step_wind', 'ground_level', 'x', 'y']
-    g_level = set()
-    pressure_mb = set()
+    plan = file_plan(gribfiles)
     for v in VAR.values():
-        var_files = [file for file in gribfiles if v in file]
+        # ordered by step, then level, as the fields are reshaped
+        var_files = [plan[v][key] for key in sorted(plan[v])] if v in plan else []
         if len(var_files) != 0:
-            grb = pygrib.open(var_files[1]).select()[0]
-            data, lats, lons = grb.data()
+            grb = pygrib.open(var_files[0]).select()[0]
+            if region is None:
+                grid = grid_cache.get_grid(grb)
+                lats, lons = grid.lats, grid.lons
+            else:
+                indexer, lats, lons = grid_index.index_for_message(grb).crop(region)
             date = datetime.datetime(year=grb.year, month=grb.month, day=grb.day, hour=0)
             date = pd.Timestamp(date)
-            time = date - date
+            time = pd.Timedelta(hours=grb.hour, minutes=grb.minute)
             start = str(grb).find(':')
             end = str(grb).find(':', str(grb).find(":") + 1)
             coords['latitude'] = (['x', 'y'], lats)
@@ -100,85 +125,268 @@ def convert_to_netcdf(files, outfilepath):
             coords['time'] = time
             if v == "DSWRF_SFC":
                 var = str(grb)[start + 1:end]
-                forecast = np.stack([extract_param(f) for f in var_files[0:]])
+                forecast = decode_and_stack(var_files, region, v)
                 x = forecast.shape[1]
                 y = forecast.shape[2]
                 forecast = forecast.reshape((1, 1, forecast.shape[0], x, y))
-                coords['step_ghi'] = pd.timedelta_range('3h', freq='3h', periods=forecast.shape[2])
+                coords['step_ghi'] = plan_steps(plan[v])
                 data_variables[var] = (ghi_dims, forecast)
             elif v == "TCDC_SFC":
                 var = str(grb)[start + 1:end]
-                forecast = np.stack([extract_param(f) for f in var_files[0:]])
+                forecast = decode_and_stack(var_files, region, v)
                 x = forecast.shape[1]
                 y = forecast.shape[2]
                 forecast = forecast.reshape((1, 1, forecast.shape[0], x, y))
-                coords['step_cloud'] = pd.timedelta_range('0h', freq='3h', periods=forecast.shape[2])
+                coords['step_cloud'] = plan_steps(plan[v])
                 data_variables[var] = (cloud_dims, forecast)
             elif v == 'TMP_ISBL':
-                pressure_mb = set()
                 var = str(grb)[start+1:end]
-                for f in var_files:
-                    pressure_mb.add(int(f.split('_')[4]))
-                pressure_mb = list(pressure_mb)
-                forecast = np.stack([extract_param(f) for f in var_files[0:]])
+                pressure_mb = plan_levels(plan[v], v)
+                forecast = decode_and_stack(var_files, region, v)
                 x = forecast.shape[1]
                 y = forecast.shape[2]
                 print(forecast.shape)
                 forecast = forecast.reshape((1, 1, forecast.shape[0]//len(pressure_mb), len(pressure_mb), x, y))
                 coords['air_pressure'] = pressure_mb
-                coords['step_temp'] = pd.timedelta_range('0h', freq='3h', periods=forecast.shape[2])
+                coords['step_temp'] = plan_steps(plan[v])
                 data_variables[var] = (temp_dims, forecast)
             elif v == 'WIND_TGL':
                 var = str(grb)[start + 10:end]
-                for f in var_files:
-                    g_level.add(int(f.split('_')[4]))
-                g_level = list(g_level)
-                forecast = np.stack([extract_param(f) for f in var_files[0:]])
+                g_level = plan_levels(plan[v], v)
+                forecast = decode_and_stack(var_files, region, v)
                 x = forecast.shape[1]
                 y = forecast.shape[2]
                 forecast = forecast.reshape((1, 1, forecast.shape[0] // len(g_level), len(g_level), x, y))
                 coords['ground_level'] = g_level
-                coords['step_wind'] = pd.timedelta_range('0h', freq='3h', periods=forecast.shape[2])
+                coords['step_wind'] = plan_steps(plan[v])
                 data_variables[var] = (wind_dims, forecast)
             elif v == 'WDIR_TGL':
                 var = str(grb)[start + 10:end]
-                forecast = np.stack([extract_param(f) for f in var_files[0:]])
+                g_level = plan_levels(plan[v], v)
+                forecast = decode_and_stack(var_files, region, v)
                 x = forecast.shape[1]
                 y = forecast.shape[2]
                 forecast = forecast.reshape((1, 1, forecast.shape[0] // len(g_level), len(g_level), x, y))
-                coords['step_wind'] = pd.timedelta_range('0h', freq='3h', periods=forecast.shape[2])
+                coords['step_wind'] = plan_steps(plan[v])
                 data_variables[var] = (wind_dims, forecast)
     ds = xr.Dataset(data_variables, coords=coords)
-    print(ds)
     print(outfilepath)
-    ds.to_netcdf(outfilepath)
+    with instrument.span('write', file=outfilepath) as span:
+        ds.to_netcdf(outfilepath, encoding=netcdf_output.encoding(ds, profile or {}))
+        span.add(bytes_in=ds.nbytes, bytes_out=instrument.file_bytes([outfilepath]))
+
+
+def message_name(grb, v):
+    '''
+    Name of the variable in the netcdf file, taken from the grib message
+    the same way as in convert_to_netcdf, i.e. without the '10 metre '
+    prefix of the wind variables.
+    '''
+    start = str(grb).find(':')
+    end = str(grb).find(':', start + 1)
+    if v in ('WIND_TGL', 'WDIR_TGL'):
+        return str(grb)[start + 10:end]
+    return str(grb)[start + 1:end]
+
+
+def file_plan(files):
+    '''
+    Group the grib files of one GDPS forecast by variable and (step, level).
+    Steps and levels are taken from the file names, not from the order.
+    Returns an OrderedDict {variable: OrderedDict {(step, level): file}}.
+    '''
+    plan = OrderedDict((v, OrderedDict()) for v in VAR.values())
+    for f in sorted(files):
+        info = datamart_index.parse_gdps_name(f)
+        if info is not None and info['variable'] in plan:
+            plan[info['variable']][(info['step'], info['level'])] = f
+    plan = OrderedDict((v, slots) for v, slots in plan.items() if slots)
+    if not plan:
+        raise ValueError("No GDPS grib files found")
+    return plan
+
+
+def plan_steps(slots):
+    '''
+    Steps of the slots {(step, level): file} of file_plan as timedeltas, in order.
+    '''
+    return pd.to_timedelta(sorted(set(step for step, level in slots)), unit='h')
+
+
+def plan_levels(slots, variable):
+    '''
+    Levels of the slots {(step, level): file} of file_plan, in order.
+    Raises ValueError if not every step has all levels, the fields could
+    not be stacked into (step, level) then.
+    '''
+    steps = set(step for step, level in slots)
+    levels = sorted(set(level for step, level in slots))
+    if len(slots) != len(steps) * len(levels):
+        raise ValueError("Different levels at the steps of {}".format(variable))
+    return levels
+
+
+def stream_to_netcdf(files, outfilepath, dtype='f8', profile=None, region=None,
+                     extendable=False):
+    '''
+    Convert the grib files of one GDPS forecast to a netcdf file with the
+    same layout as convert_to_netcdf, without stacking the forecast in memory.
+    The file is created with all dimensions first, then every grib file is
+    decoded and written straight into its (step, level) slot, so only one
+    field is in memory at a time.
+
+    Parameter:
+    -----------------------------------
+
+    files: path to grib files
+    outfilepath: path of the netcdf file
+    dtype: storage type of the data, 'f8' or 'f4'
+    profile: encoding profile, see netcdf_output.load_profile
+    region: bounding box (lat1, lon1, lat2, lon2) to crop the fields to
+    extendable: create the steps unlimited, so that later steps can be
+                added with append_to_netcdf
+    '''
+    plan = file_plan(files)
+
+    dims = OrderedDict([('forecastdate', 1), ('forecasttime', 1)])
+    coords = OrderedDict()
+    variables = OrderedDict()
+    names = {}
+    for v, slots in plan.items():
+        with pygrib.open(next(iter(slots.values()))) as grbs:
+            grb = grbs.message(1)
+            if 'latitude' not in coords:
+                if region is None:
+                    grid = grid_cache.get_grid(grb)
+                    lats, lons = grid.lats, grid.lons
+                else:
+                    indexer, lats, lons = grid_index.index_for_message(grb).crop(region)
+                dims['x'], dims['y'] = lats.shape
+                date = pd.Timestamp(datetime.datetime(year=grb.year, month=grb.month,
+                                                      day=grb.day, hour=0))
+                coords['latitude'] = (['x', 'y'], lats)
+                coords['longitude'] = (['x', 'y'], lons)
+                coords['date'] = ([], date)
+                coords['time'] = ([], pd.Timedelta(hours=grb.hour, minutes=grb.minute))
+            names[v] = message_name(grb, v)
+
+        step_dim, level_dim = DIMS[v]
+        steps = sorted(set(step for step, level in slots))
+        levels = sorted(set(level for step, level in slots))
+        if step_dim in dims and dims[step_dim] != len(steps):
+            raise ValueError("Different number of steps for {}".format(step_dim))
+        dims[step_dim] = len(steps)
+        coords[step_dim] = ([step_dim], plan_steps(slots))
+        var_dims = ['forecastdate', 'forecasttime', step_dim]
+        if level_dim is not None:
+            dims[level_dim] = len(levels)
+            coords[level_dim] = ([level_dim], np.array(levels))
+            var_dims.append(level_dim)
+        variables[names[v]] = var_dims + ['x', 'y']
+
+    unlimited = [step_dim for step_dim, level_dim in DIMS.values()] if extendable else ()
+    nc = netcdf_output.create_netcdf(outfilepath, dims, coords, variables, dtype, profile,
+                                     unlimited)
+    try:
+        for v, slots in plan.items():
+            step_dim, level_dim = DIMS[v]
+            steps = sorted(set(step for step, level in slots))
+            levels = sorted(set(level for step, level in slots))
+            with instrument.span('stream', variable=v) as span:
+                for (step, level), f in slots.items():
+                    index = (0, 0, steps.index(step))
+                    if level_dim is not None:
+                        index += (levels.index(level),)
+                    nc.variables[names[v]][index] = extract_param(f, region)
+                span.add(messages=len(slots), bytes_in=instrument.file_bytes(slots.values()))
+    finally:
+        nc.close()
+    print(outfilepath)
+
+
+def append_to_netcdf(files, outfilepath, region=None):
+    '''
+    Write the fields of files, grib files of the forecast in outfilepath that
+    arrived after it was written with stream_to_netcdf(extendable=True), into
+    that file. Steps after the last step of a variable are appended, fields
+    of steps already in the file are filled in. Returns False, with the file
+    unchanged, if a file does not fit (a new variable or level, a step before
+    the last one), the forecast has to be converted again then.
+
+    Parameter:
+    -----------------------------------
+
+    files: path to the new grib files
+    outfilepath: path of the netcdf file
+    region: bounding box (lat1, lon1, lat2, lon2) the file was cropped to
+    '''
+    plan = file_plan(files)
+    nc = netcdf_output.open_netcdf(outfilepath)
+    try:
+        # check all files first, the file is only changed if all fit
+        steps = {}
+        writes = []
+        for v, slots in plan.items():
+            step_dim, level_dim = DIMS[v]
+            with pygrib.open(next(iter(slots.values()))) as grbs:
+                name = message_name(grbs.message(1), v)
+            if name not in nc.variables or not nc.dimensions[step_dim].isunlimited():
+                return False
+            if step_dim not in steps:
+                steps[step_dim] = [int(round(h)) for h in nc.variables[step_dim][:]]
+            levels = [int(l) for l in nc.variables[level_dim][:]] if level_dim else []
+            for (step, level), f in sorted(slots.items()):
+                if level_dim is not None and level not in levels:
+                    return False
+                if step not in steps[step_dim]:
+                    if steps[step_dim] and step < steps[step_dim][-1]:
+                        return False
+                    steps[step_dim].append(step)
+                index = (0, 0, steps[step_dim].index(step))
+                if level_dim is not None:
+                    index += (levels.index(level),)
+                writes.append((name, index, f))
+
+        for step_dim, hours in steps.items():
+            known = len(nc.variables[step_dim])
+            if len(hours) > known:
+                nc.variables[step_dim][known:len(hours)] = np.array(hours[known:], dtype='f8')
+        with instrument.span('append', file=outfilepath) as span:
+            for name, index, f in writes:
+                nc.variables[name][index] = extract_param(f, region)
+            span.add(messages=len(writes), bytes_in=instrument.file_bytes(files))
+    finally:
+        nc.close()
+    print(outfilepath)
+    return True
 
 
-def get_index(files, lon, lat):
+def get_index(files, lon, lat, region=None):
     '''
     This function fetches the index of a given Location in the LOCATIONLIST,
-    from the gribfiles
+    from the gribfiles, i.e. the index of the nearest grid point.
+    The grid index is built once per grid, see grid_index.get_grid_index.
+    With region the index refers to the grid cropped to that region.
 
     Paremeters:
     -----------------------
     files: list of grib files
     lon: longitude of the location we need to fetch data for
     lat: latitude of the location we need to fetch data for
+    region: bounding box (lat1, lon1, lat2, lon2) of the netcdf file
     
     '''
-    gribfiles = files
-    gribfiles.sort()
-    for v in VAR.values():
-        var_files = [file for file in gribfiles if v in file]
-        if len(var_files) != 0:
-            grb = pygrib.open(var_files[1]).select()[0]
-            data, lats, lons = grb.data()
-            lon_index = np.where(lons == lon)[1][0]
-            lat_index = np.where(lats == lat)[0][0]
-    return lon_index, lat_index
+    gribfiles = sorted(files)
+    with pygrib.open(gribfiles[0]) as grbs:
+        index = grid_index.index_for_message(grbs.message(1))
+    if region is not None:
+        indexer, lats, lons = index.crop(region)
+        index = grid_index.get_grid_index(lats, lons)
+    lat_index, lon_index = index.nearest(lat, lon)
+    return int(lon_index), int(lat_index)
 
 
-def extract_loc_forecast(gribfiles, nc_file, locfilename, longitude, latitude):
+def extract_loc_forecast(gribfiles, nc_file, locfilename, longitude, latitude, region=None):
     '''
     This function creates netcdf file with required forecast for the given location
     in the LOCATIONLIST. It fetches data from the netcdf file, created for the forecast
@@ -191,41 +399,235 @@ def extract_loc_forecast(gribfiles, nc_file, locfilename, longitude, latitude):
     locfilename: name of the output file
     longitude: longitude of the location we need to fetch data for
     latitude: latitude of the location we need to fetch data for
+    region: bounding box the netcdf file was cropped to, or None
     
     '''
-    lon_index, lat_index = get_index(gribfiles, longitude, latitude)
-    gdps_ds = xr.open_dataset(nc_file)
-    gdps_ds = gdps_ds.sel(x=lat_index, y=lon_index)
-    print(locfilename)
-    gdps_ds.to_netcdf(locfilename)
-
-
-def main(sourcepath, outfilepath):
-    df = get_filenames(sourcepath)
-    for date in df.dates.unique():
-        namelist = list(df[df.dates == date]["names"])
-        ncname = pd.Timestamp(date).strftime("CMC_%Y%m%d_00.nc")
-        outfilename = os.path.join(outfilepath, ncname)
-        print("processing ", date, " using %d gribfiles" % (len(namelist)))
-        try:
-            convert_to_netcdf(namelist, outfilename)
-        except Exception as err:
-            print(err)
-
-        # This part of code runs only when there is data in LOCATIONLIST dict
-        if bool(LOCATIONLIST):
-            for k, v in LOCATIONLIST.items():
-                location_name = k
-                longitude = v[0]
-                latitude = v[1]
-                locfilename = outfilename[:-3] + '_' + location_name + '.nc'
-                print(locfilename)
-                extract_loc_forecast(namelist, outfilename, locfilename, longitude, latitude)
+    lon_index, lat_index = get_index(gribfiles, longitude, latitude, region)
+    # closed afterwards, the forecast file may be extended later
+    with xr.open_dataset(nc_file) as gdps_ds:
+        gdps_ds = gdps_ds.sel(x=lat_index, y=lon_index)
+        print(locfilename)
+        gdps_ds.to_netcdf(locfilename)
+
+
+def read_locations(filename):
+    '''
+    Read locations from a csv file with the columns name, latitude and
+    longitude and return them in the format of LOCATIONLIST.
+    '''
+    df = pd.read_csv(filename)
+    return OrderedDict(zip(df['name'].astype(str), zip(df['latitude'], df['longitude'])))
+
+
+class SiteExtractor:
+    '''
+    Gather the values of many locations from the fields of one GDPS
+    forecast into an array (site, step, variable). The fields can be added
+    in any order, e.g. as they are decoded, see extract_sites.
+
+    Parameters:
+    ------------------------------
+    files: names (or urls) of all grib files of the forecast
+    locations: dict {name: (latitude, longitude)}, like LOCATIONLIST
+    '''
+
+    def __init__(self, files, locations):
+        self.plan = file_plan(files)
+        self.names = list(locations)
+        self.site_lats = np.array([locations[n][0] for n in self.names], dtype='f8')
+        self.site_lons = np.array([locations[n][1] for n in self.names], dtype='f8')
+
+        self.variables = []
+        steps = set()
+        for v, slots in self.plan.items():
+            for step, level in slots:
+                steps.add(step)
+                if '{}_{}'.format(v, level) not in self.variables:
+                    self.variables.append('{}_{}'.format(v, level))
+        self.steps = sorted(steps)
+        self.forecast = np.full((len(self.names), len(self.steps), len(self.variables)), np.nan)
+        self.index = None
+        self.date = None
+
+    def set_grid(self, index, date):
+        '''
+        Look up the nearest grid points of all locations once.
+        index is the grid_index.GridIndex of the fields, date the
+        reference time of the forecast.
+        '''
+        self.index = index
+        self.date = date
+        self.i, self.j = index.nearest(self.site_lats, self.site_lons)
+
+    def add(self, filename, data):
+        '''
+        Store the values of the locations from the field data of a grib file.
+        '''
+        info = datamart_index.parse_gdps_name(filename)
+        k = self.variables.index('{}_{}'.format(info['variable'], info['level']))
+        self.forecast[:, self.steps.index(info['step']), k] = data[self.i, self.j]
+
+    def dataset(self):
+        i, j = self.i, self.j
+        return xr.Dataset(
+            {'forecast': (['site', 'step', 'variable'], self.forecast)},
+            coords=OrderedDict([
+                ('site', self.names),
+                ('step', pd.to_timedelta(self.steps, unit='h')),
+                ('variable', self.variables),
+                ('latitude', ('site', self.site_lats)),
+                ('longitude', ('site', self.site_lons)),
+                ('grid_latitude', ('site', self.index.lats[i, j])),
+                ('grid_longitude', ('site', self.index.lons[i, j])),
+                ('date', self.date)]))
+
+
+def extract_sites(files, locations, outfilename):
+    '''
+    Extract the forecast of many locations straight from the grib files of
+    one GDPS forecast, without converting the whole globe first.
+    The nearest grid points of all locations are looked up once, afterwards
+    every grib file is decoded once and the values of all locations are
+    gathered with one fancy index.
+
+    The output holds one variable 'forecast' with the dimensions
+    (site, step, variable), variables are named like the grib files,
+    e.g. TMP_ISBL_850. Steps missing for a variable are nan.
+
+    Parameters:
+    ------------------------------
+    files: list of grib files of one forecast
+    locations: dict {name: (latitude, longitude)}, like LOCATIONLIST
+    outfilename: name of the output file
+    '''
+    extractor = SiteExtractor(files, locations)
+    first = next(iter(next(iter(extractor.plan.values())).values()))
+    with pygrib.open(first) as grbs:
+        grb = grbs.message(1)
+        extractor.set_grid(grid_index.index_for_message(grb),
+                           pd.Timestamp(datetime.datetime(year=grb.year, month=grb.month,
+                                                          day=grb.day, hour=grb.hour)))
+
+    with instrument.span('extract_sites', sites=len(extractor.names)) as span:
+        for v, slots in extractor.plan.items():
+            for f in slots.values():
+                extractor.add(f, extract_param(f))
+            span.add(messages=len(slots), bytes_in=instrument.file_bytes(slots.values()))
+
+    extractor.dataset().to_netcdf(outfilename)
+    print(outfilename)
+
+
+def convert_run(namelist, outfilename, stream=False, dtype='f8', profile=None,
+                archive=None, locations=None, sites_only=False, region=None,
+                incremental=False):
+    '''
+    Convert the grib files of one GDPS forecast and extract the forecast
+    for the locations in LOCATIONLIST, returns True if it was converted.
+    If archive is given, the forecast
+    is appended to that Zarr store instead of being kept as a NetCDF file.
+    A forecast that is already in the store is skipped (returns False), its
+    NetCDF file is kept.
+
+    If locations is given, the forecast of all of them is extracted in one
+    pass into a single <outfilename>_sites.nc instead, see extract_sites.
+    With sites_only the global forecast is not written at all.
+    With region the forecast is cropped to that bounding box.
+
+    With incremental the forecast is skipped (returns False) if its output
+    was built from the same files with the same options before, see
+    build_state. A forecast written with stream that only lacks new files
+    is extended by them (see append_to_netcdf), others are converted again.
+    The state is kept next to the NetCDF output, so incremental cannot be
+    combined with archive.
+    '''
+    if incremental and archive is not None:
+        raise ValueError("Incremental conversion is not supported with a Zarr archive")
+    print("processing ", outfilename, " using %d gribfiles" % (len(namelist)))
+    target = outfilename[:-3] + '_sites.nc' if locations is not None and sites_only \
+        else outfilename
+    options = {"stream": stream, "dtype": dtype, "profile": profile,
+               "locations": locations, "sites_only": sites_only, "region": region}
+    extended = False
+    if incremental:
+        status, new = build_state.check(target, namelist, options)
+        if status == build_state.CURRENT:
+            print(target, " is up to date")
+            return False
+        build_state.clear_state(target)
+        if status == build_state.APPEND and stream and not sites_only:
+            extended = append_to_netcdf(new, outfilename, region)
+    else:
+        # the output is replaced, its state would be outdated
+        build_state.clear_state(target)
+
+    if locations is not None:
+        extract_sites(namelist, locations, outfilename[:-3] + '_sites.nc')
+        if sites_only:
+            if incremental:
+                build_state.save_state(target, namelist, options)
+            return True
+
+    if not extended:
+        if stream:
+            stream_to_netcdf(namelist, outfilename, dtype, profile, region, incremental)
+        else:
+            convert_to_netcdf(namelist, outfilename, profile, region)
+
+    # This part of code runs only when there is data in LOCATIONLIST dict
+    if locations is None and bool(LOCATIONLIST):
+        for k, v in LOCATIONLIST.items():
+            location_name = k
+            latitude, longitude = v
+            locfilename = outfilename[:-3] + '_' + location_name + '.nc'
+            print(locfilename)
+            extract_loc_forecast(namelist, outfilename, locfilename, longitude, latitude,
+                                 region)
+
+    if archive is not None:
+        import zarr_archive
+        with instrument.span('archive', store=archive), xr.open_dataset(outfilename) as ds:
+            appended = zarr_archive.append_run(ds, archive, profile)
+        if not appended:
+            # the run is in the store, keep this copy rather than lose it
+            print(outfilename, " is already in ", archive, ", kept the NetCDF file")
+            return False
+        os.remove(outfilename)
+    elif incremental:
+        build_state.save_state(target, namelist, options)
+    return True
+
+
+def main(sourcepath, outfilepath, stream=False, dtype='f8', jobs=1, profile=None,
+         archive=None, locations=None, sites_only=False, region=None, filters=None,
+         incremental=False):
+    '''
+    Convert all GDPS forecasts in sourcepath, with jobs > 1 the forecasts
+    are converted in parallel processes. profile is the name of the encoding
+    profile in config.yml, archive the path of a Zarr store the forecasts
+    are appended to, locations a dict of sites extracted in one pass (see
+    convert_run), region a bounding box to crop the forecasts to and filters
+    the selection of the files (default from config.yml, see file_filter),
+    runs without any selected file are left out. With incremental only
+    forecasts with new or changed files are converted, see convert_run
+    (not together with archive).
+    Returns the summary of batch.run_batch.
+    '''
+    profile = netcdf_output.load_profile(profile)
+    if filters is None:
+        filters = file_filter.load_filters()
+    tasks = OrderedDict()
+    with file_catalog.open_catalog(sourcepath) as catalog:
+        for run in catalog.runs('gdps'):
+            namelist = file_filter.select(filters, catalog.files('gdps', run=run))
+            if not namelist:
+                continue
+            outfilename = os.path.join(outfilepath, run.strftime("CMC_%Y%m%d_%H.nc"))
+            tasks[str(run)] = (namelist, outfilename, stream, dtype, profile, archive,
+                               locations, sites_only, region, incremental)
+    return batch.run_batch(convert_run, tasks, jobs)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        sys.exit("Use with %s <source path> <target path>" % sys.argv[0])
-    sourcepath = sys.argv[1]
-    outfilepath = sys.argv[2]
-    main(sourcepath, outfilepath)
+    import grib_cli
+    grib_cli.main(['convert', 'gdps'] + sys.argv[1:])
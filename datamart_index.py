@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Crawler for the directory listings of the GDPS datamart.
+# The run tree is walked once and kept as an index
+# (run, step, variable, level) -> url, in memory and on disk.
+
+
+import os
+import os.path
+import re
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import instrument
+
+
+HREF_RE = re.compile(r'href="([^"?#]+)"', re.IGNORECASE)
+
+# e.g. CMC_glb_TMP_ISBL_850_latlon.24x.24_2020010100_P003.grib2
+GDPS_NAME_RE = re.compile(r'CMC_glb_(?P<variable>[A-Z0-9]+_[A-Z]+)_(?P<level>\d+)_'
+                          r'latlon[^_]*_(?P<run>\d{10})_P(?P<step>\d{3})\.grib2$')
+
+# index crawled in this process, per datamart url, runs and max_lead
+_INDEX_CACHE = {}
+
+
+def parse_hrefs(page):
+    '''
+    Return all link targets of a directory listing.
+    A regular expression on the href attributes is much faster
+    than building a html tree for the index pages of the datamart.
+
+    Parameters:
+    --------------------
+    page: html of the index page (string)
+    '''
+    return HREF_RE.findall(page)
+
+
+def parse_gdps_name(filename):
+    '''
+    Split the name of a GDPS grib file into its parts.
+    Returns a dict with run (yyyymmddhh string), step (hours),
+    variable (e.g. TMP_ISBL) and level (int), or None if the file
+    is not a GDPS grib file.
+
+    Parameters:
+    --------------------
+    filename: file name or path (string)
+    '''
+    m = GDPS_NAME_RE.search(os.path.basename(filename))
+    if m is None:
+        return None
+    return {"run": m.group("run"),
+            "step": int(m.group("step")),
+            "variable": m.group("variable"),
+            "level": int(m.group("level"))}
+
+
+def _list(session, url):
+    page = session.get(url).text
+    return parse_hrefs(page)
+
+
+def crawl(url, session, runs=('00/', '12/'), workers=8, max_lead=None):
+    '''
+    Walk the run folders and all forecast-hour folders below url
+    and return an index {(run, step, variable, level): file url}.
+    Folders are listed concurrently with the given session.
+    Forecast-hour folders beyond max_lead are not listed.
+
+    Parameters:
+    --------------------
+    url: base url of the model, e.g. .../25km/grib2/lat_lon/ (string)
+    session: requests.Session
+    runs: run folders to crawl (sequence of strings)
+    workers: number of folders listed concurrently (int)
+    max_lead: last forecast hour to list, None for all (int)
+    '''
+    if not url.endswith('/'):
+        url += '/'
+    run_urls = [url + r for r in runs]
+    with instrument.span('listing', url=url) as span, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        folders = []
+        for run_url, hrefs in zip(run_urls, pool.map(lambda u: _list(session, u), run_urls)):
+            folders.extend(run_url + h for h in hrefs if h[0].isdigit()
+                           and (max_lead is None or not h.strip('/').isdigit()
+                                or int(h.strip('/')) <= max_lead))
+        listings = pool.map(lambda u: _list(session, u), folders)
+
+        index = {}
+        for folder, hrefs in zip(folders, listings):
+            for h in hrefs:
+                info = parse_gdps_name(h)
+                if info is not None:
+                    key = (info["run"], info["step"], info["variable"], info["level"])
+                    index[key] = folder + h
+        span.add(files=len(index))
+    return index
+
+
+def save_index(index, path, url, runs=('00/', '12/'), max_lead=None):
+    '''
+    Write the index to a json file, through a temporary file, with the
+    runs and max_lead it was crawled with.
+    '''
+    entries = [list(key) + [link] for key, link in sorted(index.items())]
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"url": url, "runs": list(runs), "max_lead": max_lead,
+                   "created": time.time(), "entries": entries}, f)
+    os.replace(tmp, path)
+
+
+def load_index(path, url, ttl, runs=('00/', '12/'), max_lead=None):
+    '''
+    Read an index written by save_index. Returns None if the file does not
+    exist, belongs to another url, was crawled with other runs or max_lead
+    or is older than ttl seconds.
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        cached = json.load(f)
+    if cached["url"] != url or cached.get("runs") != list(runs) \
+            or cached.get("max_lead") != max_lead \
+            or time.time() - cached["created"] > ttl:
+        return None
+    return {tuple(e[:4]): e[4] for e in cached["entries"]}
+
+
+def get_index(url, session, ttl=600, cache_path=None, refresh=False, workers=8,
+              runs=('00/', '12/'), max_lead=None):
+    '''
+    Return the index of the datamart at url. The index of this process is
+    reused, then the one stored at cache_path if it is younger than ttl
+    seconds, only otherwise the run tree is crawled again. Indices are
+    only reused for the same runs and max_lead, see crawl.
+
+    Parameters:
+    --------------------
+    url: base url of the model (string)
+    session: requests.Session
+    ttl: maximum age of a cached index in seconds (int)
+    cache_path: json file to persist the index, or None (string)
+    refresh: ignore all cached indices (bool)
+    workers: number of folders listed concurrently (int)
+    runs: run folders to crawl (sequence of strings)
+    max_lead: last forecast hour to list, None for all (int)
+    '''
+    now = time.time()
+    key = (url, tuple(runs), max_lead)
+    if not refresh:
+        if key in _INDEX_CACHE and now - _INDEX_CACHE[key][0] <= ttl:
+            return _INDEX_CACHE[key][1]
+        if cache_path is not None:
+            index = load_index(cache_path, url, ttl, runs, max_lead)
+            if index is not None:
+                _INDEX_CACHE[key] = (now, index)
+                return index
+    index = crawl(url, session, runs, workers, max_lead)
+    _INDEX_CACHE[key] = (now, index)
+    if cache_path is not None:
+        save_index(index, cache_path, url, runs, max_lead)
+    return index
+
+
+def select(index, variable=None, run=None, step=None, level=None):
+    '''
+    Return the sorted urls of the index matching all given parts.
+    Parts that are None are not filtered.
+    '''
+    wanted = (run, step, variable, level)
+    links = [link for key, link in index.items()
+             if all(w is None or w == k for w, k in zip(wanted, key))]
+    return sorted(links)
@@ -1,10 +1,18 @@
 import sys
 import os
 from os.path import join, dirname
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 import re
 import yaml
+import transfer
+import datamart_index
+import file_filter
+import instrument
 
 with open(join(dirname(__file__), "config.yml"), "r") as yfile:
     CFG = yaml.load(yfile, Loader=yaml.FullLoader)
@@ -22,10 +30,9 @@ def listFD(url):
     '''
     folders = []
     page = requests.get(url, proxies=CFG["proxies"]).text
-    soup = BeautifulSoup(page, 'html.parser')
-    for node in soup.find_all('a'):
-        if node.get('href')[0].isdigit():
-            folders.append(node.get('href'))
+    for href in datamart_index.parse_hrefs(page):
+        if href[0].isdigit():
+            folders.append(href)
     return folders
 
 
@@ -43,18 +50,17 @@ def get_file_links(url, var):
 
     '''
     r = requests.get(url)
-    soup = BeautifulSoup(r.content, 'html')
-    links = soup.findAll('a')
+    links = datamart_index.parse_hrefs(r.text)
     new_link = []
     for link in links:
-        if re.search(var, link['href']):
+        if re.search(var, link):
                 new_link.append(link)
-    file_links = [url + link['href'] for link in new_link
-                  if link['href'].endswith('.grib2')]
+    file_links = [url + link for link in new_link
+                  if link.endswith('.grib2')]
     return file_links
 
 
-def download_grib_files(file_link, dest_path):
+def download_grib_files(file_link, dest_path, manifest=None):
     '''
     Downloads grib file and save it in mentioned folder
 
@@ -62,38 +68,171 @@ def download_grib_files(file_link, dest_path):
     -------------------------
     file_link: string
     dest_path: string
+    manifest: transfer.Manifest for incremental downloads, or None
     '''
     if not os.path.exists(dest_path):
         os.mkdir(dest_path)
 
-    for link in file_link:
-
-        '''
-        iterate through all links
-        and download them one by one
-        '''
-
-        # obtain filename by splitting url and getting
-        # last string
-        file_name = link.split('/')[-1]
-        target_path = os.path.join(dest_path, file_name)
-        # create response object
-        r = requests.get(link, stream=True)
-        with open(target_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024*1024):
-                if chunk:
-                    f.write(chunk)
+    with instrument.span('download') as span:
+        for link in file_link:
+
+            '''
+            iterate through all links
+            and download them one by one
+            '''
+
+            # obtain filename by splitting url and getting
+            # last string
+            file_name = link.split('/')[-1]
+            target_path = os.path.join(dest_path, file_name)
+            span.add(files=1, bytes_in=transfer.fetch_file(requests, link, target_path, manifest))
     return
 
-def main(url, file_destination, var):
-    runs = ['00/', '12/']
-    for r in runs:
-        fd = listFD(os.path.join(url, r))
-        for f in fd:
-            filepath = os.path.join(url, r, f)
-            filelinks = get_file_links(filepath, var)
-            download_grib_files(filelinks, file_destination)
 
+def make_session(connections_per_host=None):
+    '''
+    Create a keep-alive session shared by all download workers.
+    The connection pool of the session is capped at connections_per_host
+    connections per host, proxies are taken from config.yml.
+
+    Parameters:
+    -------------------------
+    connections_per_host: maximum number of pooled connections per host (int)
+    '''
+    if connections_per_host is None:
+        connections_per_host = CFG["download"]["connections_per_host"]
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=connections_per_host,
+                          pool_maxsize=connections_per_host,
+                          pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.proxies.update({k: v for k, v in CFG["proxies"].items() if v})
+    return session
+
+
+def download_file(session, link, dest_path, manifest=None):
+    '''
+    Download a single file with the shared session and return
+    the number of bytes transferred.
+
+    Parameters:
+    -------------------------
+    session: requests.Session
+    link: url of the file (string)
+    dest_path: folder to store the file (string)
+    manifest: transfer.Manifest for incremental downloads, or None
+    '''
+    file_name = link.split('/')[-1]
+    target_path = os.path.join(dest_path, file_name)
+    return transfer.fetch_file(session, link, target_path, manifest)
+
+
+def download_grib_files_concurrent(file_link, dest_path, workers=None,
+                                   connections_per_host=None, session=None,
+                                   manifest=None, download=None):
+    '''
+    Downloads grib files with a bounded pool of worker threads sharing
+    one keep-alive session and prints the aggregate throughput.
+    Failed downloads are reported and returned, they do not stop the others.
+
+    Parameters:
+    -------------------------
+    file_link: list of urls (list of strings)
+    dest_path: string
+    workers: number of concurrent downloads (int)
+    connections_per_host: maximum number of concurrent connections
+                          to a single host (int)
+    session: optional requests.Session to reuse
+    manifest: transfer.Manifest for incremental downloads, or None
+    download: function (session, link, dest_path, manifest) fetching one
+              file, download_file by default
+    '''
+    if download is None:
+        download = download_file
+    if workers is None:
+        workers = CFG["download"]["workers"]
+    if connections_per_host is None:
+        connections_per_host = CFG["download"]["connections_per_host"]
+    if session is None:
+        session = make_session(connections_per_host)
+    os.makedirs(dest_path, exist_ok=True)
+
+    # one semaphore per host, so that many workers do not
+    # open more connections to a single server than allowed
+    host_limits = {urlsplit(link).netloc: threading.BoundedSemaphore(connections_per_host)
+                   for link in file_link}
+
+    def fetch(link):
+        with host_limits[urlsplit(link).netloc]:
+            return download(session, link, dest_path, manifest)
+
+    failed = []
+    total_bytes = 0
+    start = time.perf_counter()
+    with instrument.span('download', workers=workers) as span, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fetch, link): link for link in file_link}
+        for future in as_completed(futures):
+            try:
+                total_bytes += future.result()
+            except Exception as err:
+                print("Download failed: {} ({})".format(futures[future], err))
+                failed.append(futures[future])
+        span.add(files=len(file_link) - len(failed), bytes_in=total_bytes)
+    elapsed = time.perf_counter() - start
+    report_throughput(len(file_link) - len(failed), total_bytes, elapsed)
+    return failed
+
+
+def report_throughput(nfiles, nbytes, elapsed):
+    '''
+    Print number of files, transferred volume and throughput of a download.
+    '''
+    rate = nbytes / elapsed / 1024**2 if elapsed > 0 else 0.0
+    print("Downloaded %d files, %.1f MB in %.1f s (%.2f MB/s)"
+          % (nfiles, nbytes / 1024**2, elapsed, rate))
+
+
+def main(url, file_destination, var, workers=None, connections_per_host=None,
+         incremental=False, filters=None):
+    '''
+    Download all files of variable var from the 00 and 12 runs.
+    If workers is None files are downloaded one by one,
+    otherwise the links are taken from the crawled datamart index
+    (see datamart_index.get_index) and fetched concurrently.
+    With incremental=True files that are unchanged since the last run
+    are skipped and interrupted downloads are resumed.
+    Only files passing filters (default the filters of config.yml, see
+    file_filter.load_filters) are downloaded.
+    '''
+    if filters is None:
+        filters = file_filter.load_filters()
+    runs = ['%02d/' % h for h in file_filter.run_hours(filters)]
+    manifest = transfer.Manifest(file_destination) if incremental else None
+    if workers is None:
+        for r in runs:
+            fd = listFD(os.path.join(url, r))
+            for f in fd:
+                # the folders are the steps, later ones are not even listed
+                step = f.strip('/')
+                if filters["max_lead"] is not None and step.isdigit() and \
+                        int(step) > filters["max_lead"]:
+                    continue
+                filepath = os.path.join(url, r, f)
+                filelinks = file_filter.select(filters, get_file_links(filepath, var))
+                download_grib_files(filelinks, file_destination, manifest)
+        return
+
+    session = make_session(connections_per_host)
+    os.makedirs(file_destination, exist_ok=True)
+    index = datamart_index.get_index(
+        url, session, ttl=CFG["index"]["ttl"],
+        cache_path=os.path.join(file_destination, CFG["index"]["cache"]),
+        workers=workers, runs=runs, max_lead=filters["max_lead"])
+    filelinks = file_filter.select(filters, datamart_index.select(index, variable=var))
+    download_grib_files_concurrent(filelinks, file_destination, workers,
+                                   connections_per_host, session, manifest)
 
 
 if __name__ == '__main__':
@@ -118,10 +257,5 @@ if __name__ == '__main__':
     https://weather.gc.ca/grib/GLB_HR/GLB_latlonp24xp24_P000_deterministic_e.html
     '''
 
-    if len(sys.argv) < 4:
-        sys.exit("Use with %s <url> <target path> <variable>" % sys.argv[0])
-    #url = sys.argv[1]
-    url = CFG["url"]["gdps"]
-    file_destination = sys.argv[2]
-    var = sys.argv[3]
-    main(url, file_destination, var)
+    import grib_cli
+    grib_cli.main(['download', 'gdps'] + sys.argv[1:])
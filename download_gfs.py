@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Download of GFS orders from the NCEI archive (tar files of grib files).
+# Only the download itself lives here, the decoding of the archives is in
+# fileDownload.py, which is imported only when it is needed.
+
+
+import os
+import os.path
+import tarfile
+import requests
+from bs4 import BeautifulSoup
+import transfer
+import instrument
+
+
+def get_file_links(url):
+
+    # create response object
+    r = requests.get(url)
+    # create beautiful-soup object
+    soup = BeautifulSoup(r.content,'html')
+    # find all links on web-page
+    links = soup.findAll('a')
+    # filter the link sending with .grb2
+    tar_links = [url + link['href'] for link in links if link['href'].endswith('.tar')]
+    return tar_links
+
+def download_tar_files(file_link, dest_path, incremental=False):
+    '''
+    Download the tar files of a GFS order.
+    With incremental=True a manifest is kept in dest_path, archives that were
+    already fetched (and possibly extracted) are skipped and interrupted
+    downloads are resumed where they stopped.
+    '''
+
+    try:
+        os.mkdir(dest_path)
+    except OSError:
+        print ("Path %s already exists" % dest_path)
+    else:
+        print ("Successfully created the directory %s " % dest_path)
+
+    manifest = transfer.Manifest(dest_path) if incremental else None
+    session = requests.Session()
+
+    with instrument.span('download') as span:
+        for link in file_link:
+
+            '''iterate through all links in video_links
+            and download them one by one'''
+            # obtain filename by splitting url and getting
+            # last string
+            file_name = link.split('/')[-1]
+            target_path = os.path.join(dest_path, file_name)
+
+            # archives are deleted after extraction, the manifest remembers them
+            if manifest is not None and manifest.get(file_name).get("extracted"):
+                continue
+
+            # download started
+            span.add(files=1, bytes_in=transfer.fetch_file(session, link, target_path, manifest))
+
+    print("All files are downloaded!")
+    return
+
+def extract_grib_files(dir_name, file_ext):
+
+    manifest = transfer.Manifest(dir_name)
+    for item in os.listdir(dir_name): # loop through items in dir
+        if item.endswith(file_ext): # check for ".zip" extension
+            file_name = item # get full path of files
+            print(file_name)
+            tar=tarfile.open(os.path.join(dir_name, file_name))
+            tar.extractall(dir_name)
+            tar.close()
+            os.remove(os.path.join(dir_name,file_name))
+            if manifest.get(file_name):
+                manifest.update(file_name, extracted=True)
+
+
+def main(url, grb_filepath, incremental=False, csv=None, parquet=None, bbox=None):
+    '''
+    Download all tar files of the GFS order at url to grb_filepath. The
+    archives are extracted, or with csv/parquet decoded in-stream into a
+    csv file or a parquet dataset for the bounding box bbox
+    (lat1, lon1, lat2, lon2), see fileDownload.stream_tars_to_csv.
+    '''
+    tar_links = get_file_links(url)
+    download_tar_files(tar_links, grb_filepath, incremental)
+    if parquet is not None:
+        import fileDownload
+        # one file per order in every partition, orders can share a dataset
+        order = url.rstrip('/').split('/')[-1]
+        fileDownload.stream_tars_to_parquet(grb_filepath, parquet, bbox, remove=True, name=order)
+    elif csv is not None:
+        import fileDownload
+        fileDownload.stream_tars_to_csv(grb_filepath, csv, bbox, remove=True)
+    else:
+        extract_grib_files(grb_filepath, '.tar')
+
+
+if __name__ == '__main__':
+    import sys
+    import grib_cli
+    grib_cli.main(['download', 'gfs'] + sys.argv[1:])
@@ -3,73 +3,65 @@
 import sys
 import os
 import os.path
-import requests
-from bs4 import BeautifulSoup
 import pygrib
-import tarfile
-from pvlib.forecast import GFS
 import pandas as pd
 import numpy as np
 import datetime
-from pvlib.location import Location
 import glob
-import matplotlib.pyplot as plt
-from pylab import rcParams
+import transfer
+import grib_stream
+import grid_cache
+import instrument
+# the download of the orders, kept here for the scripts importing them from fileDownload
+from download_gfs import get_file_links, download_tar_files, extract_grib_files
 
 
 
-def get_file_links(url):
-
-    # create response object
-    r = requests.get(url)
-    # create beautiful-soup object
-    soup = BeautifulSoup(r.content,'html')
-    # find all links on web-page
-    links = soup.findAll('a')
-    # filter the link sending with .grb2
-    tar_links = [url + link['href'] for link in links if link['href'].endswith('.tar')]
-    return tar_links
-
-def download_tar_files(file_link, dest_path):
-
-    try:
-        os.mkdir(dest_path)
-    except OSError:
-        print ("Path %s already exists" % dest_path)
-    else:
-        print ("Successfully created the directory %s " % dest_path)
-
-    for link in file_link:
-
-        '''iterate through all links in video_links
-        and download them one by one'''
-        # obtain filename by splitting url and getting
-        # last string
-        file_name = link.split('/')[-1]
-        target_path = os.path.join(dest_path, file_name)
-
-        # create response object
-        r = requests.get(link, stream = True)
-
-        # download started
-        with open(target_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size = 1024*1024):
-                if chunk:
-                    f.write(chunk)
-
-    print("All files are downloaded!")
-    return
+def messages_to_df(grbs, filename, location, var, var2):
+    '''
+    Converts the grib messages of one file to a dataframe for given location
 
-def extract_grib_files(dir_name, file_ext):
+    Parameters
+    -------------------------------------------------
+    grbs: iterable of grib messages, e.g. an open pygrib file
+    filename: name of the grib file, the forecast step is taken from it
+    location: bounding box of the location you are looking for
+    var, var2: names of the variables
+    '''
+    lat1 = location[0]
+    lat2 = location[2]
+    lon1 = location[1]
+    lon2 = location[3]
 
-    for item in os.listdir(dir_name): # loop through items in dir
-        if item.endswith(file_ext): # check for ".zip" extension
-            file_name = item # get full path of files
-            print(file_name)
-            tar=tarfile.open(os.path.join(dir_name, file_name))
-            tar.extractall(dir_name)
-            tar.close()
-            os.remove(os.path.join(dir_name,file_name))
+    found = {}
+    for grb in grbs:
+        if grb.name in (var, var2) and grb.name not in found:
+            found[grb.name] = grb
+    if var not in found or var2 not in found:
+        raise ValueError("Parameter not found: {}".format(filename))
+    grb = found[var]
+    # same selection as grb.data(lat1=...), on the coordinates of grid_cache
+    grid = grid_cache.get_grid(grb)
+    mask = grid.mask(lat1, lat2, lon1, lon2)
+    lats, lons = grid.lats[mask], grid.lons[mask]
+    data = grb.values[mask]
+    grid2 = grid_cache.get_grid(found[var2])
+    data2 = found[var2].values[grid2.mask(lat1, lat2, lon1, lon2)]
+
+    #datetime1 = pd.to_datetime("%d0%d0%d 0"  str(data.year)+str('0')+str(data.month)+str('0') + str(data.day)+str(' 0')+str(data.hour))
+
+    name2step = lambda name :pd.Timedelta(hours=int(name[-8:-5]))
+    base = datetime.datetime(year=grb.year, month=grb.month, day=grb.day, hour=grb.hour)
+    valid = base + name2step(filename)
+
+    df = pd.DataFrame({'validtime': valid,
+                       'basetime': base,
+                       'latitude': np.ravel(lats),
+                       'longitude': np.ravel(lons),
+                        var: np.ravel(data),
+                        var2: np.ravel(data2)})
+    #df['datetime'] = pd.to_datetime(df['datetime'], format='%m/%d/%Y %I:%M:%S %p')
+    return df
 
 
 def grib_to_df(filename, location, var, var2):
@@ -81,48 +73,31 @@ def grib_to_df(filename, location, var, var2):
     filename: complete path of grib file
     location: bounding box of the location you are looking for
     '''
-    lat1 = location[0]
-    lat2 = location[2]
-    lon1 = location[1]
-    lon2 = location[3]
-
-    grbs = pygrib.open(filename)
-
     try:
         with pygrib.open(filename) as grbs:
-            grb = grbs.select(name=var)[0]
-            data, lats, lons = grb.data(lat1=lat1, lat2=lat2, lon1=lon1, lon2=lon2)
-            data_flat = np.reshape(data, (np.product(data.shape),))
-
-            grb_2 = grbs.select(name=var2)[0]
-            data2 = grb_2.data(lat1=lat1, lat2=lat2, lon1=lon1, lon2=lon2)[0]
-            data2_flat = np.reshape(data2, (np.product(data2.shape),))
-
-            lats_flat = np.reshape(lats, (np.product(lats.shape),))
-            lons_flat = np.reshape(lons, (np.product(lons.shape),))
-
-            #datetime1 = pd.to_datetime("%d0%d0%d 0"  str(data.year)+str('0')+str(data.month)+str('0') + str(data.day)+str(' 0')+str(data.hour))
+            return messages_to_df(grbs, filename, location, var, var2)
+    except ValueError:
+        	print("Parameter not found: {}".format(filename))
 
-            name2step = lambda name :pd.Timedelta(hours=int(name[-8:-5]))
-            base = datetime.datetime(year=grb.year, month=grb.month, day=grb.day, hour=grb.hour)
-            valid = base + name2step(filename)
 
-            df = pd.DataFrame({'validtime': valid,
-                               'basetime': base,
-                               'latitude': lats_flat,
-                               'longitude': lons_flat,
-                                var:data_flat,
-                                var2: data2_flat})
-            #df['datetime'] = pd.to_datetime(df['datetime'], format='%m/%d/%Y %I:%M:%S %p')
-            return df
+def tar_to_dfs(tarpath, location, var, var2):
+    '''
+    Decode the grib files of a tar archive in-stream, without extracting
+    it to disk, and yield one dataframe per grib file (see grib_to_df).
+    Only one member of the archive is held in memory at a time.
+    '''
+    for name, content in grib_stream.iter_tar_members(tarpath):
+        grbs = (pygrib.fromstring(bytes(msg)) for msg in grib_stream.iter_messages(content))
+        try:
+            yield messages_to_df(grbs, name, location, var, var2)
+        except ValueError as err:
+            print(err)
 
-    except ValueError:
-        	print("Parameter not found: {}".format(filename))
 
 def convert_tar_to_csv(sourcepath, destinationpath, filename, location):
     files = glob.glob(os.path.join(sourcepath, "*grb2"))
     files.sort()
-    outfile = glob.glob(os.path.join(destinationpath, filename))
+    outfile = os.path.join(destinationpath, filename)
     dflist = [grib_to_df(file, location, "Downward short-wave radiation flux", "Temperature") for file in files]
     df = pd.concat(dflist).set_index("validtime")
     df.to_csv(outfile, index=False)
@@ -130,22 +105,97 @@ def convert_tar_to_csv(sourcepath, destinationpath, filename, location):
         os.remove(file)
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        sys.exit("Use with %s <url> <target path>" % sys.argv[0])
-    url = sys.argv[1]
-    grb_filepath = sys.argv[2]
-#    url = "https://www1.ncdc.noaa.gov/pub/has/model/HAS011478636/"
-#    grb_filepath = '/home/saptaparni/gfsdata/'
-    tar_links = get_file_links(url)
-    download_tar_files(tar_links, grb_filepath)
-    extract_grib_files(grb_filepath, '.tar')
-
-    # bounding box of the location for which you want to get GHI values
-    #location = [48,8,48.1,8]
-    # csv file name format: <YYYY_STARTMONTH_ENDMONTH.csv>
-    #filename = '2018_01_03.csv'
-    # file path to save the csv files
-    #csv_filepath = '/scratch/data/gfscsvfiles/'
-    #convert_tar_to_csv(grb_filepath, csv_filepath, filename)
+def convert_to_parquet(sourcepath, outpath, location,
+                       var="Downward short-wave radiation flux", var2="Temperature",
+                       remove=False, name='part-0'):
+    '''
+    Convert the extracted grib files in sourcepath to a parquet dataset
+    partitioned by base date (see parquet_output). The files are written
+    one by one, only one of them is held in memory.
+
+    Parameters
+    -------------------------------------------------
+    sourcepath: folder with the grib files
+    outpath: folder of the parquet dataset
+    location: bounding box [lat1, lon1, lat2, lon2]
+    remove: delete each grib file once it is converted
+    name: file name used in the partitions
+    '''
+    import parquet_output
+    files = sorted(glob.glob(os.path.join(sourcepath, "*grb2")))
+    with parquet_output.PartitionedWriter(outpath, name=name) as writer:
+        for file in files:
+            df = grib_to_df(file, location, var, var2)
+            if df is not None:
+                writer.write(df)
+            if remove:
+                os.remove(file)
+
+
+def iter_tar_dfs(sourcepath, location, var, var2, remove=False):
+    '''
+    Decode all tar archives in sourcepath in-stream and yield the
+    dataframe of every grib file (see tar_to_dfs). With remove=True every
+    archive is deleted once it is converted and marked as extracted in the
+    manifest, so an incremental download skips it.
+    '''
+    manifest = transfer.Manifest(sourcepath)
+    for tarpath in sorted(glob.glob(os.path.join(sourcepath, "*.tar"))):
+        print(tarpath)
+        # decoding and writing of the rows, the dataframes are consumed lazily
+        with instrument.span('tar', file=os.path.basename(tarpath)) as span:
+            for df in tar_to_dfs(tarpath, location, var, var2):
+                span.add(files=1, rows=len(df))
+                yield df
+            span.add(bytes_in=instrument.file_bytes([tarpath]))
+        if remove:
+            os.remove(tarpath)
+            file_name = os.path.basename(tarpath)
+            if manifest.get(file_name):
+                manifest.update(file_name, extracted=True)
+
+
+def stream_tars_to_csv(sourcepath, outfile, location,
+                       var="Downward short-wave radiation flux", var2="Temperature",
+                       remove=False):
+    '''
+    Convert all tar archives in sourcepath to one csv file as a single
+    pipeline: the grib members are decoded from memory and every grib
+    file is appended to the csv as soon as it is converted, so neither the
+    extracted files nor the complete table are ever held on disk or in memory.
 
+    Parameters
+    -------------------------------------------------
+    sourcepath: folder with the downloaded tar archives
+    outfile: path of the csv file
+    location: bounding box [lat1, lon1, lat2, lon2]
+    remove: delete each archive once it is converted
+    '''
+    header = True
+    for df in iter_tar_dfs(sourcepath, location, var, var2, remove):
+        df.to_csv(outfile, mode='w' if header else 'a', header=header, index=False)
+        header = False
+
+
+def stream_tars_to_parquet(sourcepath, outpath, location,
+                           var="Downward short-wave radiation flux", var2="Temperature",
+                           remove=False, name='part-0'):
+    '''
+    Same as stream_tars_to_csv, but the rows are written to a parquet
+    dataset partitioned by base date (see parquet_output).
+
+    Parameters
+    -------------------------------------------------
+    outpath: folder of the parquet dataset
+    name: file name used in the partitions, use different names to add
+          further orders to the same dataset
+    '''
+    import parquet_output
+    with parquet_output.PartitionedWriter(outpath, name=name) as writer:
+        for df in iter_tar_dfs(sourcepath, location, var, var2, remove):
+            writer.write(df)
+
+
+if __name__ == '__main__':
+    import grib_cli
+    grib_cli.main(['download', 'gfs'] + sys.argv[1:])
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Catalog of the grib files in a folder, kept as a SQLite database next to
+# the files. Every file name is parsed once into model, run, variable, level
+# type, level and step; later scans only parse the files that are new and
+# are skipped completely if the folder has not changed. The converters
+# select the files of a run or variable with indexed queries instead of
+# globbing the folder and slicing the names.
+
+
+import os
+import os.path
+from os.path import join, dirname
+import re
+import sqlite3
+import pandas as pd
+import yaml
+import datamart_index
+
+
+# e.g. gfs_4_20200101_0000_003.grb2, any resolution (gfs_3_, gfs_4_, ...)
+GFS_NAME_RE = re.compile(r'gfs_\d+_(?P<date>\d{8})_(?P<time>\d{4})_(?P<step>\d{3})\.grb2$')
+
+# 2: GFS files of all resolutions, before only gfs_4_
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    model TEXT,
+    run TEXT,
+    variable TEXT,
+    level_type TEXT,
+    level INTEGER,
+    step INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_run ON files (model, run);
+CREATE INDEX IF NOT EXISTS files_variable ON files (model, variable, level_type, run);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+def catalog_name():
+    '''
+    File name of the catalog in the grib folders from config.yml.
+    '''
+    with open(join(dirname(__file__), "config.yml"), "r") as yfile:
+        cfg = yaml.load(yfile, Loader=yaml.FullLoader).get("catalog") or {}
+    return cfg.get("name") or ".grib_catalog.sqlite"
+
+
+def parse_name(name):
+    '''
+    Split a GDPS or GFS file name into its parts. Returns a dict with
+    model ('gdps' or 'gfs'), run (pd.Timestamp), variable and level_type
+    (e.g. TMP and ISBL, None for GFS files, which hold all variables),
+    level (int or None) and step (hours), or None for other files.
+
+    Parameters:
+    --------------------
+    name: file name or path (string)
+    '''
+    info = datamart_index.parse_gdps_name(name)
+    if info is not None:
+        variable, level_type = info['variable'].split('_')
+        return {"model": "gdps",
+                "run": pd.Timestamp(info['run'][:8] + 'T' + info['run'][8:]),
+                "variable": variable,
+                "level_type": level_type,
+                "level": info['level'],
+                "step": info['step']}
+    m = GFS_NAME_RE.search(os.path.basename(name))
+    if m is not None:
+        return {"model": "gfs",
+                "run": pd.Timestamp(m.group('date') + 'T' + m.group('time')),
+                "variable": None,
+                "level_type": None,
+                "level": None,
+                "step": int(m.group('step'))}
+    return None
+
+
+def _run_text(run):
+    # runs are stored as ISO strings, so that they sort and compare as text
+    return str(pd.Timestamp(run))
+
+
+class Catalog:
+    '''
+    Catalog of the grib files in source, see open_catalog.
+
+    Parameters:
+    --------------------
+    source: folder of the grib files (string)
+    path: database file, by default catalog_name() in source (string)
+    '''
+
+    def __init__(self, source, path=None):
+        self.source = source
+        self.path = path or join(source, catalog_name())
+        try:
+            self.conn = sqlite3.connect(self.path)
+            # no journal files, they would change the modification time of
+            # the folder; a broken catalog can be deleted, the next scan rebuilds it
+            self.conn.execute("PRAGMA journal_mode = MEMORY")
+            self.conn.executescript(SCHEMA)
+        except sqlite3.OperationalError:
+            # read only folder, the catalog is only kept for this process
+            self.conn = sqlite3.connect(':memory:')
+            self.conn.executescript(SCHEMA)
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            with self.conn:
+                self.conn.execute("DELETE FROM files")
+                self.conn.execute("DELETE FROM meta")
+                self.conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self.conn.close()
+
+    def scan(self):
+        '''
+        Add the new files of the folder to the catalog and remove the
+        deleted ones. Only new names are parsed, if the modification time
+        of the folder is unchanged the folder is not even listed.
+        Returns the number of new files.
+        '''
+        mtime = str(os.stat(self.source).st_mtime_ns)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'mtime'").fetchone()
+        if row is not None and row[0] == mtime:
+            return 0
+
+        with os.scandir(self.source) as entries:
+            names = set(e.name for e in entries if e.is_file())
+        known = set(name for name, in self.conn.execute("SELECT name FROM files"))
+        rows = []
+        for name in sorted(names - known):
+            info = parse_name(name)
+            if info is None:
+                if name.endswith(('.grb2', '.grib2')):
+                    print("Unknown grib file name, not converted:", name)
+                # kept with model NULL, so that it is not parsed again
+                rows.append((name, None, None, None, None, None, None))
+            else:
+                rows.append((name, info['model'], _run_text(info['run']), info['variable'],
+                             info['level_type'], info['level'], info['step']))
+        with self.conn:
+            self.conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.executemany("DELETE FROM files WHERE name = ?",
+                                  [(name,) for name in known - names])
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('mtime', ?)", (mtime,))
+        return len(rows)
+
+    def _where(self, model, run=None, variable=None, start=None, end=None, time=None):
+        # conditions shared by runs and files
+        where = ["model = ?"]
+        params = [model]
+        if run is not None:
+            where.append("run = ?")
+            params.append(_run_text(run))
+        if variable is not None:
+            # GDPS variables are given as in the file names, e.g. TMP_ISBL
+            name, level_type = variable.split('_')
+            where.append("variable = ? AND level_type = ?")
+            params += [name, level_type]
+        if start is not None:
+            where.append("run >= ?")
+            params.append(_run_text(pd.Timestamp(start).floor('1d')))
+        if end is not None:
+            where.append("run < ?")
+            params.append(_run_text(pd.Timestamp(end).floor('1d') + pd.Timedelta('1d')))
+        if time is not None:
+            # time of day of the run, the part after the date in the ISO string
+            where.append("substr(run, 12) = ?")
+            params.append(str(pd.Timestamp(0) + pd.Timedelta(time))[11:])
+        return " AND ".join(where), params
+
+    def runs(self, model, start=None, end=None, time=None):
+        '''
+        Runs of model in the catalog, in order, as pd.Timestamp.
+        start and end select the days of the runs (inclusive, anything
+        pd.Timestamp understands), time the time of day of the runs
+        (anything pd.Timedelta understands, e.g. '12:00:00').
+        '''
+        where, params = self._where(model, start=start, end=end, time=time)
+        return [pd.Timestamp(run) for run, in self.conn.execute(
+            "SELECT DISTINCT run FROM files WHERE " + where + " ORDER BY run", params)]
+
+    def files(self, model, run=None, variable=None, start=None, end=None, time=None):
+        '''
+        Paths of the files of model, sorted by name, optionally only of
+        one run and/or variable (e.g. TMP_ISBL), see runs for the others.
+        '''
+        where, params = self._where(model, run, variable, start, end, time)
+        return [join(self.source, name) for name, in self.conn.execute(
+            "SELECT name FROM files WHERE " + where + " ORDER BY name", params)]
+
+    def frame(self, model, variable=None, start=None, end=None, time=None):
+        '''
+        Files of model as a DataFrame with the columns names, run,
+        variable, level_type, level and step, sorted by name, selected
+        like in files.
+        '''
+        where, params = self._where(model, None, variable, start, end, time)
+        df = pd.read_sql_query(
+            "SELECT name AS names, run, variable, level_type, level, step FROM files "
+            "WHERE " + where + " ORDER BY name", self.conn, params=params)
+        df['names'] = [join(self.source, name) for name in df['names']]
+        df['run'] = pd.to_datetime(df['run'])
+        return df
+
+
+def open_catalog(source, path=None):
+    '''
+    Open the catalog of the grib files in source and scan the folder
+    for new files. Use as context manager or close it.
+
+    Parameters:
+    --------------------
+    source: folder of the grib files (string)
+    path: database file, by default catalog_name() in source (string)
+    '''
+    catalog = Catalog(source, path)
+    catalog.scan()
+    return catalog
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Selection of the GDPS files by run hour, lead time, step stride and level,
+# set in the filters section of config.yml. The same selection is applied to
+# the links before they are downloaded and to the files before they are
+# converted, so files that are not needed are never transferred, decoded
+# or stored.
+
+
+from os.path import join, dirname
+import yaml
+import datamart_index
+
+
+def load_filters(model='gdps', **overrides):
+    '''
+    Filters of model from config.yml as a dict with runs (run hours),
+    max_lead (hours), step_stride (hours) and levels ({variable: levels}),
+    None for no restriction. Keyword arguments that are not None replace
+    the configured values.
+    '''
+    with open(join(dirname(__file__), "config.yml"), "r") as yfile:
+        cfg = (yaml.load(yfile, Loader=yaml.FullLoader).get("filters") or {}).get(model) or {}
+    filters = {"runs": cfg.get("runs"),
+               "max_lead": cfg.get("max_lead"),
+               "step_stride": cfg.get("step_stride"),
+               "levels": cfg.get("levels") or {}}
+    filters.update((k, v) for k, v in overrides.items() if v is not None)
+    return filters
+
+
+def run_hours(filters, default=(0, 12)):
+    '''
+    Run hours selected by filters, default if they are not restricted.
+    '''
+    return sorted(filters["runs"]) if filters.get("runs") else list(default)
+
+
+def accept(filters, run_hour, step, variable, level):
+    '''
+    True if the field of variable (e.g. TMP_ISBL) at level of the run
+    starting at run_hour, step hours ahead, passes the filters.
+    '''
+    if filters.get("runs") and run_hour not in filters["runs"]:
+        return False
+    if filters.get("max_lead") is not None and step > filters["max_lead"]:
+        return False
+    if filters.get("step_stride") and step % filters["step_stride"] != 0:
+        return False
+    levels = (filters.get("levels") or {}).get(variable)
+    return not levels or level in levels
+
+
+def accept_name(filters, name):
+    '''
+    True if the GDPS file name or url passes the filters, names that
+    are no GDPS file names never do.
+    '''
+    info = datamart_index.parse_gdps_name(name)
+    if info is None:
+        return False
+    return accept(filters, int(info["run"][8:]), info["step"], info["variable"], info["level"])
+
+
+def select(filters, names):
+    '''
+    The GDPS file names or urls of names passing the filters, in order.
+    filters None selects all names.
+    '''
+    if filters is None:
+        return list(names)
+    return [name for name in names if accept_name(filters, name)]
@@ -11,8 +11,28 @@ This can e.g. be done using a cronjob i.e.
 
 0 */12 * * * python get_current_gdps.py
 
+Download, decoding and the extraction of the locations run at the same time
+as stages of a pipeline (see pipeline.run_pipeline): the files are fetched
+in order of the forecast steps and every file is decoded and its values are
+extracted while the later steps are still downloading. The forecast of the
+locations is written as soon as the last file has arrived, the conversion
+of the whole globe follows afterwards.
+
 """
+import os
+import os.path
+import signal
+import threading
+import datetime
+import pandas as pd
+import pygrib
 import download_gdps_grib
+import datamart_index
+import file_filter
+import transfer
+import pipeline
+import grid_index
+import convert_gdps_xarray
 
 VAR = {"GHI": "DSWRF_SFC",
        "Wind speed": "WIND_TGL",
@@ -28,32 +48,112 @@ GRIBDST = "path/to/gribfiles"
 NCDST = "path/to/ncfiles"
 RESULTDST = "path/to/resultfiles"
 
-def get_current_forecast():
-    """ Download current forecasts for all defined variables """
-    for val in VAR.values():
-        download_gdps_grib.main()
-
-
-def convert_current_forecast():
-    # PLACEHOLDER
-    pass
-
-
-def extract_current_forecast(locationlist):
-    # PLACEHOLDER
-    pass
-
+CFG = download_gdps_grib.CFG
+
+
+def current_links(session):
+    """ Return the urls of all files of the defined variables from the
+    latest run on the datamart, ordered by forecast step, so that the
+    first steps are available first. Only files passing the filters of
+    config.yml are taken (see file_filter) """
+    os.makedirs(GRIBDST, exist_ok=True)
+    filters = file_filter.load_filters()
+    index = datamart_index.get_index(
+        URL, session, ttl=CFG["index"]["ttl"],
+        cache_path=os.path.join(GRIBDST, CFG["index"]["cache"]),
+        workers=CFG["download"]["workers"],
+        runs=['%02d/' % h for h in file_filter.run_hours(filters)],
+        max_lead=filters["max_lead"])
+    keys = [key for key in index if key[2] in VAR.values()
+            and file_filter.accept(filters, int(key[0][8:]), key[1], key[2], key[3])]
+    if not keys:
+        raise ValueError("No forecast found at {}".format(URL))
+    run = max(key[0] for key in keys)
+    keys = sorted((key for key in keys if key[0] == run), key=lambda k: (k[1], k[2], k[3]))
+    return [index[key] for key in keys]
+
+
+def decode_field(filename):
+    """ Decode the field of a GDPS grib file, returns the file name,
+    the field, the grid index and the date of the forecast """
+    with pygrib.open(filename) as grbs:
+        grb = grbs.message(1)
+        date = pd.Timestamp(datetime.datetime(year=grb.year, month=grb.month,
+                                              day=grb.day, hour=grb.hour))
+        return filename, grb.values, grid_index.index_for_message(grb), date
+
+
+def extract_current_forecast(locationlist, cancel=None):
+    """ Download the latest forecast and extract it for all locations in
+    locationlist, as a pipeline of download, decode and extraction.
+    The number of workers of the stages and the size of the queues between
+    them are set in the pipeline section of config.yml.
+    Returns the downloaded files and the file with the forecast of the
+    locations (see convert_gdps_xarray.extract_sites) """
+    cfg = CFG["pipeline"]
+    session = download_gdps_grib.make_session()
+    manifest = transfer.Manifest(GRIBDST)
+    links = current_links(session)
+    extractor = convert_gdps_xarray.SiteExtractor(links, locationlist)
+    files = []
+
+    def download(link):
+        target = os.path.join(GRIBDST, link.split('/')[-1])
+        transfer.fetch_file(session, link, target, manifest)
+        files.append(target)
+        return target
+
+    def extract(decoded):
+        filename, data, index, date = decoded
+        if extractor.index is None:
+            extractor.set_grid(index, date)
+        extractor.add(filename, data)
+
+    summary = pipeline.run_pipeline(
+        links,
+        [('download', download, cfg["download_workers"]),
+         ('decode', decode_field, cfg["decode_workers"]),
+         # one worker, it owns the array of the locations
+         ('extract', extract, 1)],
+        maxsize=cfg["queue_size"], cancel=cancel)
+    for stage, result in summary.items():
+        if stage != 'cancelled':
+            print("%s: %d done, %d failed" % (stage, result['done'], len(result['failed'])))
+    if summary['cancelled'] or extractor.index is None:
+        return sorted(files), None
+
+    os.makedirs(RESULTDST, exist_ok=True)
+    outfilename = os.path.join(RESULTDST, extractor.date.strftime("CMC_%Y%m%d_%H_sites.nc"))
+    extractor.dataset().to_netcdf(outfilename)
+    print(outfilename)
+    return sorted(files), outfilename
+
+
+def convert_current_forecast(files):
+    """ Convert the downloaded forecast of the whole globe to netCDF,
+    field by field (see convert_gdps_xarray.stream_to_netcdf) """
+    if not files:
+        return None
+    os.makedirs(NCDST, exist_ok=True)
+    run = datamart_index.parse_gdps_name(files[0])["run"]
+    outfilename = os.path.join(NCDST, "CMC_{}_{}.nc".format(run[:8], run[8:]))
+    convert_gdps_xarray.stream_to_netcdf(files, outfilename)
+    return outfilename
 
 
 def main():
-    # Download grib files
-    get_current_forecast()
+    # SIGTERM (e.g. from a timeout of the cron job) stops all stages cleanly,
+    # interrupted downloads are resumed by the next run
+    cancel = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: cancel.set())
 
-    # Convert grib to netCDF.
-    convert_current_forecast()
+    # Download grib files and extract relevant data for specified locations
+    files, sitesfile = extract_current_forecast(LOCATIONLIST, cancel)
+    if cancel.is_set():
+        return
 
-    # Extract relevant data for specified locations
-    extract_current_forecast(LOCATIONLIST)
+    # Convert grib to netCDF.
+    convert_current_forecast(files)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# One entry point for the download and conversion scripts:
+#
+#   python grib_cli.py download gdps <url> <file destination> <variable>
+#   python grib_cli.py download gfs <order url> path/to/files/
+#   python grib_cli.py download subset path/to/files <url> [<url> ...]
+#   python grib_cli.py convert gdps path/to/source/files path/to/output/files/
+#   python grib_cli.py convert gfs path/to/source/files path/to/output/files/
+#   python grib_cli.py extract path/to/source/files path/to/output/files/ --sites sites.csv
+#
+# Only the standard library is imported here. Every command imports the
+# module doing the work when it runs, so the downloads never load numpy,
+# pandas, xarray or pygrib and --help answers at once. The old scripts
+# (download_gdps_grib.py, fileDownload.py, ...) still work, they hand their
+# arguments to this parser. benchmarks/startup.py checks the start-up time
+# of every command.
+
+
+import argparse
+import importlib
+import instrument
+
+
+# command: module doing the work, imported only when the command runs
+COMMANDS = {
+    "download gdps": "download_gdps_grib",
+    "download gfs": "download_gfs",
+    "download subset": "grib_subset",
+    "convert gdps": "convert_gdps_xarray",
+    "convert gfs": "grib_to_xarray",
+    "extract": "convert_gdps_xarray",
+}
+
+
+def _load(command):
+    return importlib.import_module(COMMANDS[command])
+
+
+def _region(args):
+    import grid_index
+    return grid_index.load_region(args.region, args.bbox)
+
+
+def download_gdps(args):
+    download_gdps_grib = _load("download gdps")
+    #url = args.url
+    url = download_gdps_grib.CFG["url"]["gdps"]
+    download_gdps_grib.main(url, args.file_destination, args.var, args.workers,
+                            args.connections_per_host, args.incremental)
+
+
+def download_gfs(args):
+    _load("download gfs").main(args.url, args.grb_filepath, args.incremental,
+                               args.csv, args.parquet, args.bbox)
+
+
+def download_subset(args):
+    grib_subset = _load("download subset")
+    grib_subset.download_subsets(args.urls, args.file_destination,
+                                 args.message or grib_subset.CFG["subset"]["messages"],
+                                 args.workers, args.incremental,
+                                 args.connections_per_host)
+
+
+def convert_gdps(args):
+    convert_gdps_xarray = _load("convert gdps")
+    locations = convert_gdps_xarray.read_locations(args.sites) if args.sites else None
+    convert_gdps_xarray.main(args.sourcepath, args.outfilepath, args.stream,
+                             'f4' if args.float32 else 'f8', args.jobs, args.profile,
+                             args.zarr, locations, args.sites_only, _region(args),
+                             incremental=args.incremental)
+    if args.site_store is not None:
+        import site_store
+        site_store.update(args.site_store, args.outfilepath)
+
+
+def convert_gfs(args):
+    _load("convert gfs").main(args.sourcepath, args.outfilepath, args.start, args.end,
+                              args.time, args.stream, 'f4' if args.float32 else 'f8',
+                              args.jobs, args.profile, args.zarr, _region(args),
+                              args.incremental)
+
+
+def extract(args):
+    convert_gdps_xarray = _load("extract")
+    convert_gdps_xarray.main(args.sourcepath, args.outfilepath, jobs=args.jobs,
+                             locations=convert_gdps_xarray.read_locations(args.sites),
+                             sites_only=True, incremental=args.incremental)
+    if args.site_store is not None:
+        import site_store
+        site_store.update(args.site_store, args.outfilepath)
+
+
+def _add_conversion(parser, unit):
+    # options shared by the converters
+    parser.add_argument("sourcepath", help="source file path")
+    parser.add_argument("outfilepath", help="output file path")
+    parser.add_argument("--stream", action="store_true",
+                        help="Write each {} to the output as soon as it "
+                             "is decoded, with bounded memory".format(unit))
+    parser.add_argument("--float32", action="store_true",
+                        help="Store data as float32 (only with --stream)")
+    parser.add_argument("-p", "--profile", default=None,
+                        help="Encoding profile of the output from config.yml")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of runs converted in parallel processes")
+    parser.add_argument("--zarr", default=None,
+                        help="Append the runs to this Zarr store instead of "
+                             "writing one NetCDF file per run")
+    _add_incremental(parser)
+    _add_region(parser)
+
+
+def _add_incremental(parser):
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="Skip runs converted before from the same files, "
+                             "add new steps to streamed outputs (not with --zarr)")
+
+
+def _add_region(parser):
+    parser.add_argument("-r", "--region", default=None,
+                        help="Crop the forecast to a region from config.yml")
+    parser.add_argument("--bbox", nargs=4, type=float, default=None,
+                        metavar=("LAT1", "LON1", "LAT2", "LON2"),
+                        help="Crop the forecast to a bounding box")
+
+
+def build_parser():
+    '''
+    Parser of all commands, the function running a command is set as
+    func of the parsed arguments.
+    '''
+    parser = argparse.ArgumentParser(description="Download and convert GDPS and GFS forecasts")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    download = commands.add_parser("download", help="Download grib files")
+    models = download.add_subparsers(dest="model", metavar="model")
+    models.required = True
+
+    p = models.add_parser("gdps", help="Download GDPS files from the datamart")
+    p.add_argument("url", help="source url (the url from config.yml is used)")
+    p.add_argument("file_destination", help="target path")
+    p.add_argument("var", help="variable to download, e.g. DSWRF_SFC")
+    p.add_argument("-j", "--workers", type=int, default=None,
+                   help="Download files concurrently with this many workers")
+    p.add_argument("--connections-per-host", type=int, default=None,
+                   help="Maximum number of connections to one host")
+    p.add_argument("-i", "--incremental", action="store_true",
+                   help="Skip unchanged files and resume partial downloads")
+    instrument.add_argument(p)
+    p.set_defaults(func=download_gdps)
+
+    p = models.add_parser("gfs", help="Download a GFS order from the NCEI archive")
+    p.add_argument("url", help="url of the GFS order")
+    p.add_argument("grb_filepath", help="target path")
+    p.add_argument("--incremental", action="store_true",
+                   help="Skip archives fetched before, resume partial downloads")
+    output = p.add_mutually_exclusive_group()
+    output.add_argument("--csv", default=None,
+                        help="Decode the archives in-stream into this csv file "
+                             "instead of extracting them")
+    output.add_argument("--parquet", default=None,
+                        help="Decode the archives in-stream into a parquet dataset "
+                             "in this folder, partitioned by base date")
+    p.add_argument("--bbox", nargs=4, type=float, default=None,
+                   metavar=("LAT1", "LON1", "LAT2", "LON2"),
+                   help="Bounding box of the location for --csv/--parquet")
+    instrument.add_argument(p)
+    p.set_defaults(func=download_gfs)
+
+    p = models.add_parser("subset", help="Download some messages of remote grib files")
+    p.add_argument("file_destination", help="target path")
+    p.add_argument("urls", nargs='+', help="urls of the grib files")
+    p.add_argument("-m", "--message", action="append", default=None,
+                   help="VAR or VAR:LEVEL of a message to download, e.g. "
+                        "'TMP:2 m above ground' (default from config.yml)")
+    p.add_argument("-j", "--workers", type=int, default=None,
+                   help="Number of concurrent downloads")
+    p.add_argument("--connections-per-host", type=int, default=None,
+                   help="Maximum number of connections to one host")
+    p.add_argument("-i", "--incremental", action="store_true",
+                   help="Skip files downloaded with the same messages before")
+    instrument.add_argument(p)
+    p.set_defaults(func=download_subset)
+
+    convert = commands.add_parser("convert", help="Convert grib files to NetCDF")
+    models = convert.add_subparsers(dest="model", metavar="model")
+    models.required = True
+
+    p = models.add_parser("gdps", help="Convert GDPS files, one file per run")
+    _add_conversion(p, "field")
+    p.add_argument("--sites", default=None,
+                   help="csv file (name, latitude, longitude) of locations, "
+                        "extracted in one pass into one file per forecast")
+    p.add_argument("--sites-only", action="store_true",
+                   help="Only extract the locations of --sites, do not "
+                        "write the global forecast")
+    p.add_argument("--site-store", default=None,
+                   help="Append the extracted locations of --sites to this "
+                        "location-major store (see site_store.py)")
+    instrument.add_argument(p)
+    p.set_defaults(func=convert_gdps)
+
+    p = models.add_parser("gfs", help="Convert GFS files, one file per run")
+    _add_conversion(p, "step")
+    p.add_argument("-s", "--start", default=None,
+                   help="Start date of files to convert")
+    p.add_argument("-e", "--end", default=None,
+                   help="End date of files to convert")
+    p.add_argument("-t", "--time", default=None,
+                   help="Time of day of files to convert")
+    instrument.add_argument(p)
+    p.set_defaults(func=convert_gfs)
+
+    p = commands.add_parser("extract", help="Extract the forecast of locations from GDPS files")
+    p.add_argument("sourcepath", help="source file path")
+    p.add_argument("outfilepath", help="output file path")
+    p.add_argument("--sites", required=True,
+                   help="csv file (name, latitude, longitude) of the locations")
+    p.add_argument("-j", "--jobs", type=int, default=1,
+                   help="Number of runs extracted in parallel processes")
+    p.add_argument("--site-store", default=None,
+                   help="Append the extracted locations to this "
+                        "location-major store (see site_store.py)")
+    _add_incremental(p)
+    instrument.add_argument(p)
+    p.set_defaults(func=extract)
+
+    return parser
+
+
+def main(argv=None):
+    '''
+    Parse argv (default the command line) and run the command.
+    '''
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.func is download_gfs and (args.csv or args.parquet) and args.bbox is None:
+        parser.error("--csv and --parquet require --bbox")
+    instrument.configure(args.metrics)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Read grib messages from memory, e.g. from the members of a GFS tar
+# archive, without extracting them to disk first.
+
+
+import struct
+import tarfile
+
+
+def message_length(buf, offset=0):
+    '''
+    Total length of the grib message starting at offset, read from
+    section 0 (3 bytes for grib edition 1, 8 bytes for edition 2).
+    '''
+    if bytes(buf[offset:offset + 4]) != b'GRIB':
+        raise ValueError("No grib message at byte {}".format(offset))
+    edition = buf[offset + 7]
+    if edition == 1:
+        return int.from_bytes(bytes(buf[offset + 4:offset + 7]), 'big')
+    if edition == 2:
+        return struct.unpack('>Q', bytes(buf[offset + 8:offset + 16]))[0]
+    raise ValueError("Unknown grib edition {} at byte {}".format(edition, offset))
+
+
+def iter_messages(buf):
+    '''
+    Split a buffer holding one or more grib messages into the single
+    messages. Each message is checked for its '7777' end marker.
+
+    Parameters
+    ----------
+    buf : bytes
+        Content of a grib file
+
+    Yields
+    ------
+    message : memoryview
+        One complete grib message, e.g. for pygrib.fromstring(bytes(message))
+    '''
+    view = memoryview(buf)
+    offset = buf.find(b'GRIB')
+    while offset >= 0:
+        end = offset + message_length(view, offset)
+        if end > len(buf) or buf[end - 4:end] != b'7777':
+            raise ValueError("Truncated grib message at byte {}".format(offset))
+        yield view[offset:end]
+        offset = buf.find(b'GRIB', end)
+
+
+def iter_tar_members(tarpath, suffix='grb2'):
+    '''
+    Iterate the members of a tar archive as a stream and yield the name
+    and content of every member ending with suffix. Only one member is
+    held in memory at a time, nothing is written to disk.
+
+    Parameters
+    ----------
+    tarpath : str
+        Path of the tar archive
+    suffix : str
+        Ending of the member names to read
+    '''
+    with tarfile.open(tarpath, mode='r|*') as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith(suffix):
+                yield member.name, tar.extractfile(member).read()
+
+
+class GribValidator:
+    '''
+    Check the structure of grib data while it arrives, chunk by chunk:
+    the 'GRIB' indicator, the total length, for edition 2 the length and
+    order of every section, and the '7777' end marker of every message.
+    Only the few header bytes are kept, the data sections are skipped.
+    feed and close raise ValueError for data that is not a sequence of
+    complete grib messages.
+    '''
+
+    # sections that may follow a section, 0 is the indicator; sections
+    # 2 to 7 can be repeated for several fields in one message
+    NEXT_SECTION = {0: (1,), 1: (2, 3), 2: (3,), 3: (4,), 4: (5,), 5: (6,), 6: (7,),
+                    7: (2, 3, 4)}
+
+    def __init__(self):
+        self.messages = 0
+        self.offset = 0
+        self.skip = 0
+        self._expect('indicator', 8)
+
+    def _expect(self, state, need):
+        if state == 'indicator':
+            # offset of the next message, for the errors
+            self.start = self.offset
+        self.state = state
+        self.need = need
+        self.head = b''
+
+    def feed(self, data):
+        view = memoryview(data)
+        i = 0
+        while i < len(view):
+            if self.skip:
+                n = min(self.skip, len(view) - i)
+                self.skip -= n
+            else:
+                n = min(self.need - len(self.head), len(view) - i)
+                self.head += bytes(view[i:i + n])
+            i += n
+            self.offset += n
+            if not self.skip and len(self.head) == self.need:
+                self._parse()
+
+    def _error(self, reason):
+        raise ValueError("{} in grib message at byte {}".format(reason, self.start))
+
+    def _parse(self):
+        head = self.head
+        if self.state == 'indicator':
+            if head[:4] != b'GRIB':
+                self._error("No 'GRIB' indicator")
+            if head[7] == 1:
+                length = int.from_bytes(head[4:7], 'big')
+                if length < 12:
+                    self._error("Invalid length {}".format(length))
+                self.skip = length - 12
+                self._expect('end', 4)
+            elif head[7] == 2:
+                self._expect('length', 8)
+            else:
+                self._error("Unknown edition {}".format(head[7]))
+        elif self.state == 'length':
+            self.left = struct.unpack('>Q', head)[0] - 16
+            self.last = 0
+            self._expect('section', 4)
+        elif self.state == 'section':
+            if head == b'7777':
+                if self.left != 4 or self.last != 7:
+                    self._error("Unexpected end marker")
+                self.messages += 1
+                self._expect('indicator', 8)
+                return
+            self.section_length = struct.unpack('>I', head)[0]
+            if not 5 <= self.section_length <= self.left - 4:
+                self._error("Invalid section length {}".format(self.section_length))
+            self._expect('number', 1)
+        elif self.state == 'number':
+            if head[0] not in self.NEXT_SECTION[self.last]:
+                self._error("Section {} after section {}".format(head[0], self.last))
+            self.last = head[0]
+            self.left -= self.section_length
+            self.skip = self.section_length - 5
+            self._expect('section', 4)
+        elif self.state == 'end':
+            if head != b'7777':
+                self._error("No end marker")
+            self.messages += 1
+            self._expect('indicator', 8)
+
+    def close(self):
+        '''
+        Check that the data ended after a complete message.
+        '''
+        if self.skip or self.head or self.state != 'indicator':
+            self._error("Truncated data")
+        if self.messages == 0:
+            raise ValueError("No grib message found")
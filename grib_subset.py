@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Download only some messages of remote grib files. The byte offsets of the
+# messages are taken from the .idx inventory next to the file (as written by
+# wgrib2, "1:0:d=2020010100:TMP:2 m above ground:6 hour fcst:") or, for
+# servers without one, read from the message headers with small Range
+# requests. The selected messages are fetched with Range requests, adjacent
+# ones in a single request, and concatenated into a valid grib file.
+#
+#   python grib_cli.py download subset path/to/files https://.../gfs_4_20200101_0000_003.grb2 \
+#       -m DSWRF:surface -m "TMP:2 m above ground"
+
+
+import os
+import os.path
+import re
+import struct
+import transfer
+import grib_stream
+import download_gdps_grib
+
+CFG = download_gdps_grib.CFG
+
+# bytes read from the start of a message to build an inventory locally,
+# enough for sections 0 to 4 of the usual grids
+HEAD_BYTES = 4096
+
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+# wgrib2 names of (discipline, parameter category, parameter number)
+PARAMS = {
+    (0, 0, 0): "TMP",
+    (0, 0, 4): "TMAX",
+    (0, 0, 5): "TMIN",
+    (0, 0, 6): "DPT",
+    (0, 1, 0): "SPFH",
+    (0, 1, 1): "RH",
+    (0, 1, 8): "APCP",
+    (0, 2, 0): "WDIR",
+    (0, 2, 1): "WIND",
+    (0, 2, 2): "UGRD",
+    (0, 2, 3): "VGRD",
+    (0, 2, 22): "GUST",
+    (0, 3, 0): "PRES",
+    (0, 3, 1): "PRMSL",
+    (0, 3, 5): "HGT",
+    (0, 4, 7): "DSWRF",
+    (0, 4, 8): "USWRF",
+    (0, 5, 3): "DLWRF",
+    (0, 5, 4): "ULWRF",
+    (0, 6, 1): "TCDC",
+}
+
+# wgrib2 names of the types of the first fixed surface, {} is the level
+LEVELS = {
+    1: "surface",
+    10: "entire atmosphere",
+    100: "{:g} mb",
+    101: "mean sea level",
+    103: "{:g} m above ground",
+    200: "entire atmosphere (considered as a single layer)",
+}
+
+
+def parse_idx(text):
+    '''
+    Parse a wgrib2 style inventory. Returns a list of dicts with offset,
+    end (last byte, None for the last message, which ends with the file)
+    and name ('VAR:LEVEL', e.g. 'TMP:2 m above ground') of every message.
+
+    Parameters:
+    --------------------
+    text: content of the .idx file (string)
+    '''
+    entries = []
+    for line in text.splitlines():
+        fields = line.split(':')
+        if len(fields) < 5:
+            continue
+        entries.append({"offset": int(fields[1]), "end": None,
+                        "name": "{}:{}".format(fields[3], fields[4])})
+    entries.sort(key=lambda e: e["offset"])
+    for entry, following in zip(entries, entries[1:]):
+        entry["end"] = following["offset"] - 1
+    return entries
+
+
+def _scaled(scale, value):
+    # scale factor and value are stored as sign bit and magnitude
+    if value == 0xFFFFFFFF:
+        return None
+    scale = -(scale & 0x7F) if scale & 0x80 else scale
+    value = -(value & 0x7FFFFFFF) if value & 0x80000000 else value
+    return value / 10.0 ** scale
+
+
+def parse_head(buf):
+    '''
+    Read length and name ('VAR:LEVEL' as in the .idx files) of the grib2
+    message at the start of buf. Returns (length, name), name is None if
+    buf ends before section 4.
+
+    Parameters:
+    --------------------
+    buf: first bytes of the message (bytes)
+    '''
+    length = grib_stream.message_length(buf)
+    if buf[7] != 2:
+        raise ValueError("Only grib edition 2 inventories can be built")
+    discipline = buf[6]
+    offset = 16
+    while offset + 5 <= min(len(buf), length):
+        size, number = struct.unpack('>IB', buf[offset:offset + 5])
+        if number == 4:
+            if offset + 28 > len(buf):
+                return length, None
+            sec = buf[offset:offset + 28]
+            key = (discipline, sec[9], sec[10])
+            var = PARAMS.get(key, "var{}_{}_{}".format(*key))
+            surface = sec[22]
+            level = _scaled(sec[23], struct.unpack('>I', sec[24:28])[0])
+            if surface == 100 and level is not None:
+                level = level / 100.0
+            fmt = LEVELS.get(surface, "level {} {{}}".format(surface))
+            return length, "{}:{}".format(var, fmt.format(level) if '{' in fmt else fmt)
+        offset += size
+    return length, None
+
+
+def _get_range(session, url, start, end=None):
+    # GET bytes start-end (inclusive, open ended if None), the server
+    # has to answer with 206, a complete file is not read
+    headers = {"Range": "bytes={}-{}".format(start, "" if end is None else end)}
+    r = session.get(url, headers=headers, stream=True)
+    if r.status_code != 206:
+        r.close()
+        r.raise_for_status()
+        raise ValueError("{} does not support Range requests".format(url))
+    return r
+
+
+def build_inventory(session, url):
+    '''
+    Build the inventory of a remote grib2 file without .idx from the
+    headers of its messages, one small Range request per message.
+    Returns entries like parse_idx.
+
+    Parameters:
+    --------------------
+    session: requests.Session
+    url: url of the grib file (string)
+    '''
+    entries = []
+    offset = 0
+    size = None
+    while size is None or offset < size:
+        head_bytes = HEAD_BYTES
+        while True:
+            r = _get_range(session, url, offset, offset + head_bytes - 1)
+            buf = r.content
+            total = CONTENT_RANGE_RE.match(r.headers.get("Content-Range", ""))
+            if total is not None and total.group(3) != '*':
+                size = int(total.group(3))
+            length, name = parse_head(buf)
+            if name is not None or len(buf) >= length:
+                break
+            head_bytes *= 4
+        if name is None:
+            raise ValueError("No product definition in message at byte {} of {}"
+                             .format(offset, url))
+        entries.append({"offset": offset, "end": offset + length - 1, "name": name})
+        offset += length
+        if size is None:
+            # no total size in the response, the file ends with a short read
+            size = offset if len(buf) < head_bytes else None
+    return entries
+
+
+def get_inventory(session, url, suffixes=None):
+    '''
+    Inventory of a remote grib file from the first of the suffixes
+    (e.g. .idx) found on the server, else built from the messages
+    with build_inventory.
+
+    Parameters:
+    --------------------
+    session: requests.Session
+    url: url of the grib file (string)
+    suffixes: endings of the inventory files (list of strings)
+    '''
+    if suffixes is None:
+        suffixes = CFG["subset"]["idx_suffixes"]
+    for suffix in suffixes:
+        r = session.get(url + suffix)
+        if r.status_code == 200:
+            return parse_idx(r.text)
+    return build_inventory(session, url)
+
+
+def select_messages(entries, messages):
+    '''
+    Entries of the inventory matching one of messages, given as
+    'VAR' (all levels) or 'VAR:LEVEL', e.g. 'TMP:2 m above ground'.
+    '''
+    selected = []
+    for entry in entries:
+        var = entry["name"].split(':', 1)[0]
+        if any(m == entry["name"] or m == var for m in messages):
+            selected.append(entry)
+    return selected
+
+
+def merge_ranges(entries, max_gap=0):
+    '''
+    Merge the byte ranges of the selected entries into as few requests
+    as possible: ranges closer than max_gap bytes are fetched together
+    and the bytes in between are dropped afterwards.
+    Returns a list of (start, end, entries), end None for the end of file.
+    '''
+    merged = []
+    for entry in sorted(entries, key=lambda e: e["offset"]):
+        if merged:
+            start, end, members = merged[-1]
+            if end is not None and entry["offset"] <= end + 1 + max_gap:
+                merged[-1] = (start, entry["end"], members + [entry])
+                continue
+        merged.append((entry["offset"], entry["end"], [entry]))
+    return merged
+
+
+def fetch_subset(session, link, target_path, messages, manifest=None,
+                 suffixes=None, max_gap=None):
+    '''
+    Download the messages of a remote grib file to target_path and return
+    the number of bytes transferred. Every message is checked before
+    target_path is written, so it always holds complete messages.
+
+    Parameters:
+    -------------------------
+    session: requests.Session
+    link: url of the grib file (string)
+    target_path: path of the subset (string)
+    messages: 'VAR' or 'VAR:LEVEL' of the messages (list of strings)
+    manifest: transfer.Manifest for incremental downloads, or None
+    suffixes: endings of the inventory files (list of strings)
+    max_gap: bytes between two messages still fetched in one request (int)
+    '''
+    name = os.path.basename(target_path)
+    if max_gap is None:
+        max_gap = CFG["subset"]["max_gap"]
+    if manifest is not None:
+        entry = manifest.get(name)
+        if (entry.get("complete") and entry.get("messages") == sorted(messages)
+                and os.path.exists(target_path)
+                and os.path.getsize(target_path) == entry.get("size")):
+            return 0
+
+    selected = select_messages(get_inventory(session, link, suffixes), messages)
+    if not selected:
+        raise ValueError("None of {} found in {}".format(", ".join(messages), link))
+
+    part_path = target_path + transfer.PART_SUFFIX
+    nbytes = 0
+    with open(part_path, "wb") as f:
+        for start, end, members in merge_ranges(selected, max_gap):
+            data = _get_range(session, link, start, end).content
+            nbytes += len(data)
+            for member in members:
+                stop = None if member["end"] is None else member["end"] - start + 1
+                message = data[member["offset"] - start:stop]
+                # raises for truncated messages, e.g. after an outdated .idx
+                if len(list(grib_stream.iter_messages(message))) != 1:
+                    raise ValueError("Message {} at byte {} of {} is not a single grib "
+                                     "message".format(member["name"], member["offset"], link))
+                f.write(message)
+
+    os.replace(part_path, target_path)
+    if manifest is not None:
+        manifest.update(name, url=link, complete=True, messages=sorted(messages),
+                        size=os.path.getsize(target_path))
+    return nbytes
+
+
+def download_subsets(file_link, dest_path, messages, workers=None, incremental=False,
+                     connections_per_host=None):
+    '''
+    Download the messages of all grib files in file_link concurrently
+    with at most connections_per_host connections to one server (see
+    download_gdps_grib.download_grib_files_concurrent), returns the
+    failed links.
+    '''
+    manifest = transfer.Manifest(dest_path) if incremental else None
+
+    def download(session, link, dest_path, manifest=None):
+        target = os.path.join(dest_path, link.split('/')[-1])
+        return fetch_subset(session, link, target, messages, manifest)
+
+    return download_gdps_grib.download_grib_files_concurrent(
+        file_link, dest_path, workers, connections_per_host, manifest=manifest,
+        download=download)
+
+
+if __name__ == '__main__':
+    import sys
+    import grib_cli
+    grib_cli.main(['download', 'subset'] + sys.argv[1:])
@@ -9,40 +9,105 @@ import os.path
 import pygrib
 import pandas as pd
 import numpy as np
-import glob
 import xarray as xr
 from collections import OrderedDict
-import argparse
+import netcdf_output
+import batch
+import grid_index
+import grid_cache
+import instrument
+import file_catalog
+import build_state
 
 
-def extract_param(filename, var):
+def read_messages(filename, names, latlons=False, region=None):
+    '''
+    Read all variables in names from a grib file in a single pass over its
+    messages, instead of one grbs.select(name=...) scan per variable.
+
+    Returns a dict {name: data array} and a dict with the inventory of the
+    file (the names of all messages, in file order), the date and time of the
+    forecast and, if latlons is True, the lats and lons of the grid and
+    whether it is regular. The coordinates come from grid_cache, only the
+    values of the messages are decoded.
+    Raises ValueError if a variable is missing or found more than once.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the grib file
+    names : sequence of str
+        Names of the variables to read
+    latlons : bool
+        Also return the coordinates of the grid
+    region : tuple
+        Bounding box (lat1, lon1, lat2, lon2), fields are cropped to it
+        right after decoding (see grid_index.GridIndex.crop)
+    '''
+    fields = OrderedDict()
+    info = {'inventory': []}
+    with pygrib.open(filename) as grbs:
+        for grb in grbs:
+            info['inventory'].append(grb.name)
+            if grb.name not in names:
+                continue
+            if grb.name in fields:
+                raise ValueError('File contains more than one variable '
+                                 'with name {}'.format(grb.name))
+            fields[grb.name] = grb.values
+            if region is not None:
+                indexer, lats, lons = grid_index.index_for_message(grb).crop(region)
+                fields[grb.name] = fields[grb.name][indexer]
+            if 'date' not in info:
+                info['date'] = pd.Timestamp(year=grb.year, month=grb.month, day=grb.day)
+                info['time'] = pd.Timedelta(hours=grb.hour, minutes=grb.minute)
+                if latlons:
+                    grid = grid_cache.get_grid(grb)
+                    if region is None:
+                        lats, lons = grid.lats, grid.lons
+                    info['lats'], info['lons'] = lats, lons
+                    info['regular'] = grid.regular
+
+    missing = [name for name in names if name not in fields]
+    if missing:
+        raise ValueError("Variable not found: {} in {} (available: {})".format(
+            ', '.join(missing), filename, ', '.join(sorted(set(info['inventory'])))))
+    return fields, info
+
+
+def extract_param(filename, var, region=None):
     '''
     extract specified parameters from grib files and return it as an array
     '''
-#    try:
-#        with pygrib.open(filename) as grbs:
-#            grb = grbs.select(name = var)[0]
-#            data, lats, lons = grb.data()
-#        return data
-#    except ValueError: # This wont work, even if the exception is caught, the function now returns None.
-#        print("Parameter not found: {}".format(var))
+    fields, info = read_messages(filename, [var], region=region)
+    return fields[var]
 
-    with pygrib.open(filename) as grbs:
-        try:
-            grb = grbs.select(name=var)
-        except ValueError:
-            raise ValueError("Variable not found: {}".format(var))
 
-        if len(grb) > 1:
-            raise ValueError('File contains more than one variable'
-                             'with name {}'.format(var))
-        else:
-            data, lats, lons = grb[0].data()
-    return data
 
+def grid_coords(lats, lons, regular=None):
+    '''
+    Return the dimension labels of a forecast and the latitude/longitude
+    coordinates, 1-D axes for a regular grid and 2-D arrays otherwise.
+    regular is checked with grid_cache.is_regular if it is not given.
+    '''
+    # check if data has regular lat, lon grid, i.e. do lats change only
+    # in 0th dimension and lons only in 1st dimension?
+    if regular is None:
+        regular = grid_cache.is_regular(lats, lons)
+
+    coords = OrderedDict()
+    if regular:
+        dim_labels = ['date', 'time', 'step', 'latitude', 'longitude']
+        coords['latitude'] =  lats[:, 0]
+        coords['longitude'] = lons[0, :]
+    else:
+        dim_labels = ['date', 'time', 'step', 'x', 'y']
+        coords['latitude'] =  (['x', 'y'], lats)
+        coords['longitude'] = (['x', 'y'], lons)
+    return dim_labels, coords
 
 
-def convert_to_netcdf(files, outfilename,  var1, var2):
+def convert_to_netcdf(files, outfilename,  var1, var2, profile=None, region=None):
 
     '''
     Fetch var1 and var2 from grib files and converts it to netcdf file
@@ -52,130 +117,177 @@ def convert_to_netcdf(files, outfilename,  var1, var2):
     outfilename: file name to store the netcdf files
     var1: Downward short-wave radiation flux
     var2: Temperature
+    profile: encoding profile, see netcdf_output.load_profile
+    region: bounding box (lat1, lon1, lat2, lon2) to crop the fields to
 
     '''
     gribfiles = files #glob.glob(os.path.join(filepath, "*grb2"))
     gribfiles.sort()
+    variables = [var1, var2]
 
     # start extracting variables at step 3h, since step 0h does not contain all
     # variables, e.g. no 'Downward short-wave radiation flux'
     # maybe step 0h contains only instant values and no averages?
-    grb = pygrib.open(gribfiles[1]).select(name=var1)[0]
-    data, lats, lons = grb.data()
-    date = pd.Timestamp(year=grb.year, month=grb.month, day=grb.day)
-    time = pd.Timedelta(hours=grb.hour, minutes=grb.minute)
-    var1_forecast = np.stack([extract_param(file, var1) for file in gribfiles[1:]])
-    var2_forecast = np.stack([extract_param(file, var2) for file in gribfiles[1:]])
-    #var3_forecast = np.stack([extract_param(file, var3) for file in gribfiles[1:]])
-
-    x = var1_forecast.shape[1]
-    y = var1_forecast.shape[2]
-    var1_forecast = var1_forecast.reshape((1, 1, var1_forecast.shape[0], x, y))
-    var2_forecast = var2_forecast.reshape((1, 1, var2_forecast.shape[0], x, y))
-    #var3_forecast = var3_forecast.reshape((1, 1, var3_forecast.shape[0], x, y))
-
-    # check if data has regular lat, lon grid
-    # do lats change only in 0th dimension?
-    lat0 = (lats[:, 0:1] * np.ones(lats.shape[1]) == lats).all()
-    # do lons change only in 1st dimension?
-    lon1 = (lons[0:1, :].T * np.ones(lons.shape[0]) == lons.T).all()
-
-
+    # Each file is read once for all variables, the first one also
+    # provides date, time and grid.
+    with instrument.span('decode') as span:
+        fields, info = read_messages(gribfiles[1], variables, latlons=True, region=region)
+        lats, lons = info['lats'], info['lons']
+        date = info['date']
+        time = info['time']
+        forecasts = OrderedDict((var, [fields[var]]) for var in variables)
+        for file in gribfiles[2:]:
+            fields, _ = read_messages(file, variables, region=region)
+            for var in variables:
+                forecasts[var].append(fields[var])
+        span.add(messages=len(variables) * (len(gribfiles) - 1),
+                 bytes_in=instrument.file_bytes(gribfiles[1:]))
+
+    dim_labels, coords = grid_coords(lats, lons, info['regular'])
     data_variables = OrderedDict()
-    coords = OrderedDict()
-    if lat0 and lon1:
-        dim_labels = ['date', 'time', 'step', 'latitude', 'longitude']
-        coords['latitude'] =  lats[:, 0]
-        coords['longitude'] = lons[0, :]
-    else:
-        dim_labels = ['date', 'time', 'step', 'x', 'y']
-        coords['latitude'] =  (['x', 'y'], lats)
-        coords['longitude'] = (['x', 'y'], lons)
     coords['date'] = [date]
     coords['time'] = [time]
-    coords['step'] = pd.timedelta_range('3h', freq='3h', periods=var1_forecast.shape[2])
+    coords['step'] = pd.timedelta_range('3h', freq='3h', periods=len(gribfiles) - 1)
 
-    data_variables[var1] = (dim_labels, var1_forecast)
-    data_variables[var2] = (dim_labels, var2_forecast)
-    #data_variables[var3] = (dim_labels, var3_forecast)
+    for var in variables:
+        with instrument.span('stack', variable=var) as span:
+            forecast = np.stack(forecasts[var])
+            span.add(bytes_out=forecast.nbytes)
+        data_variables[var] = (dim_labels, forecast[np.newaxis, np.newaxis])
     ds = xr.Dataset(data_variables, coords=coords)
-    ds.to_netcdf(outfilename)
-
-def get_filenames(source):
-    fns = glob.glob(os.path.join(source, "*.grb2"))
-    fns.sort()
-
-    df = pd.DataFrame()
-    df["names"] = fns
-    df['datetimes'] = df["names"].apply(
-            lambda x: pd.Timestamp('{}T{}'.format(x[-22:-14], x[-13:-9])))
+    with instrument.span('write', file=outfilename) as span:
+        ds.to_netcdf(outfilename, encoding=netcdf_output.encoding(ds, profile or {}))
+        span.add(bytes_in=ds.nbytes, bytes_out=instrument.file_bytes([outfilename]))
 
-    return df
 
-def filter_filenames(df, startdate, enddate, time):
-    """Filter DataFrame of filenames by date and/or time, set parameters
-    to None for no filtering.
+def stream_to_netcdf(files, outfilename, var1, var2, dtype='f8', profile=None,
+                     region=None):
+    '''
+    Same output as convert_to_netcdf, but the NetCDF file is created first
+    and every decoded step is written straight into its slot, so only the
+    fields of one grib file are in memory at a time.
 
     Parameters
     ----------
-    df : pd.DataFrame
-        Dataframe with columns 'names' and 'datetimes'
-    startdate : str / None
-        Format should be convertible to pd.Timestamp
-    enddate : str / None
-        Format should be convertible to pd.Timestamp
-    time : str / None
-        Format should be convertible to pd.Timedelta
-
-    Returns
-    -------
-    df : pd.DataFrame
-        Filtered DataFrame
-    """
-    if startdate is not None:
-        sd = pd.Timestamp(startdate)
-        df = df[df['datetimes'].dt.floor('1d') >= sd]
-    if enddate is not None:
-        ed = pd.Timestamp(enddate)
-        df = df[df['datetimes'].dt.floor('1d') <= ed]
-    if time is not None:
-        t = pd.Timedelta(time)
-        df = df[df['datetimes']-df['datetimes'].dt.floor('1d') == t]
-    return df
-
+    files : list of str
+        grib files of one forecast
+    outfilename : str
+        file name to store the netcdf file
+    var1, var2 : str
+        names of the variables, e.g. 'Downward short-wave radiation flux'
+    dtype : str
+        storage type of the data, 'f8' or 'f4'
+    profile : dict
+        encoding profile, see netcdf_output.load_profile
+    region : tuple
+        bounding box (lat1, lon1, lat2, lon2) to crop the fields to
+    '''
+    gribfiles = sorted(files)
+    variables = [var1, var2]
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("sourcepath", help="source file path")
-    parser.add_argument("outfilepath", help="output file path")
-    parser.add_argument("-s", "--start", default=None,
-                        help="Start date of files to convert")
-    parser.add_argument("-e", "--end", default=None,
-                        help="End date of files to convert")
-    parser.add_argument("-t", "--time", default=None,
-                        help="Time of day of files to convert")
-    args = parser.parse_args()
-
-    sourcepath = args.sourcepath
-    outfilepath = args.outfilepath
+    # see convert_to_netcdf, step 0h is skipped
+    fields, info = read_messages(gribfiles[1], variables, latlons=True, region=region)
+    dim_labels, grid = grid_coords(info['lats'], info['lons'], info['regular'])
+    del info['lats'], info['lons']
 
+    dims = OrderedDict([('date', 1), ('time', 1), ('step', len(gribfiles) - 1)])
+    dims[dim_labels[3]], dims[dim_labels[4]] = fields[var1].shape
+    coords = OrderedDict()
+    for name, coord in grid.items():
+        coords[name] = coord if isinstance(coord, tuple) else ([name], coord)
+    coords['date'] = (['date'], [info['date'].to_numpy()])
+    coords['time'] = (['time'], [info['time'].to_numpy()])
+    coords['step'] = (['step'], pd.timedelta_range('3h', freq='3h', periods=dims['step']))
+
+    nc = netcdf_output.create_netcdf(outfilename, dims, coords,
+                                     OrderedDict((var, dim_labels) for var in variables),
+                                     dtype, profile)
+    try:
+        with instrument.span('stream') as span:
+            for i, file in enumerate(gribfiles[1:]):
+                if i > 0:
+                    fields, _ = read_messages(file, variables, region=region)
+                for var in variables:
+                    nc.variables[var][0, 0, i] = fields[var]
+            span.add(messages=len(variables) * (len(gribfiles) - 1),
+                     bytes_in=instrument.file_bytes(gribfiles[1:]))
+    finally:
+        nc.close()
+
+
+def convert_run(namelist, outfilename, var1, var2, stream=False, dtype='f8',
+                profile=None, archive=None, region=None, incremental=False):
+    """Convert the grib files of one forecast run, returns False if the run
+    was skipped because it has no forecast steps after 0h.
+    If archive is given, the run is appended to that Zarr store instead of
+    being kept as a NetCDF file. A run that is already in the store is
+    skipped, its NetCDF file is kept.
+    With incremental the run is also skipped if its output was built from
+    the same files with the same options before (see build_state), runs
+    with new or changed files are converted again. The state is kept next
+    to the NetCDF output, so incremental cannot be combined with archive.
+    """
+    if incremental and archive is not None:
+        raise ValueError("Incremental conversion is not supported with a Zarr archive")
+    print("processing ", outfilename, " using %d gribfiles" % (len(namelist)))
+    if len(namelist) < 2:
+        return False
+    options = {"var1": var1, "var2": var2, "stream": stream, "dtype": dtype,
+               "profile": profile, "region": region}
+    if incremental:
+        status, _ = build_state.check(outfilename, namelist, options)
+        if status == build_state.CURRENT:
+            print(outfilename, " is up to date")
+            return False
+    # the output is replaced, its state would be outdated
+    build_state.clear_state(outfilename)
+    if stream:
+        stream_to_netcdf(namelist, outfilename, var1, var2, dtype, profile, region)
+    else:
+        convert_to_netcdf(namelist, outfilename, var1, var2, profile, region)
+    if archive is not None:
+        import zarr_archive
+        with instrument.span('archive', store=archive), xr.open_dataset(outfilename) as ds:
+            appended = zarr_archive.append_run(ds, archive, profile)
+        if not appended:
+            # the run is in the store, keep this copy rather than lose it
+            print(outfilename, " is already in ", archive, ", kept the NetCDF file")
+            return False
+        os.remove(outfilename)
+    elif incremental:
+        build_state.save_state(outfilename, namelist, options)
+    return True
+
+
+def main(sourcepath, outfilepath, start=None, end=None, time=None, stream=False,
+         dtype='f8', jobs=1, profile=None, archive=None, region=None, incremental=False):
+    """Convert the GFS runs in sourcepath selected by start, end and time
+    (see file_catalog.Catalog.runs), with jobs > 1 in parallel processes. profile is
+    the name of the encoding profile in config.yml, archive the path of a
+    Zarr store the runs are appended to and region a bounding box to crop
+    the forecasts to. With incremental only runs with new or changed files
+    are converted, see convert_run (not together with archive).
+    Returns the summary of batch.run_batch.
+    """
     var1 = 'Downward short-wave radiation flux'
     var2 = '2 metre temperature'
     #var2 = 'Temperature'
 
     print(sourcepath)
 
-    df = get_filenames(sourcepath)
-    df = filter_filenames(df, startdate=args.start, enddate=args.end,
-                          time=args.time)
-    for dati in df.datetimes.unique():
-        namelist = list(df[df.datetimes == dati]["names"])
-        ncname = pd.Timestamp(dati).strftime("GFS_%Y%m%d_%H%M.nc")
-        outfilename = os.path.join(outfilepath, ncname)
-        print("processing ", dati, " using %d gribfiles" % (len(namelist)))
-        try:
-            convert_to_netcdf(namelist, outfilename, var1, var2)
-        except Exception as err:
-            print(err)
+    profile = netcdf_output.load_profile(profile)
+    tasks = OrderedDict()
+    with file_catalog.open_catalog(sourcepath) as catalog:
+        for run in catalog.runs('gfs', start=start, end=end, time=time):
+            namelist = catalog.files('gfs', run=run)
+            ncname = run.strftime("GFS_%Y%m%d_%H%M.nc")
+            outfilename = os.path.join(outfilepath, ncname)
+            tasks[str(run)] = (namelist, outfilename, var1, var2, stream, dtype, profile,
+                               archive, region, incremental)
+    return batch.run_batch(convert_run, tasks, jobs)
 
 
+if __name__ == '__main__':
+    import sys
+    import grib_cli
+    grib_cli.main(['convert', 'gfs'] + sys.argv[1:])
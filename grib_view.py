@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Lazy xarray view of a folder of grib files, for looking at the data
+# without converting it first. The layout is built from the file catalog
+# (see file_catalog) and one header per variable; every (run, step, level)
+# field is a dask chunk that is decoded only when it is accessed, so
+#
+#   ds = grib_view.open_gdps("path/to/gribfiles")
+#   ds["Temperature"].sel(air_pressure=850, step="6h").load()
+#
+# only decodes the files of that level and step.
+
+
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pygrib
+import yaml
+from os.path import join, dirname
+import file_catalog
+import file_filter
+import grid_cache
+import grid_index
+import grib_to_xarray
+import convert_gdps_xarray
+
+with open(join(dirname(__file__), "config.yml"), "r") as yfile:
+    CFG = yaml.load(yfile, Loader=yaml.FullLoader)
+
+# level dimension of the GDPS level types and of the GFS typeOfLevel
+LEVEL_DIMS = {"ISBL": "air_pressure", "TGL": "ground_level",
+              "isobaricInhPa": "air_pressure", "heightAboveGround": "ground_level"}
+
+
+def _field(filename, indexer, chunk, name=None, type_of_level=None, level=None):
+    # decode one field on access, name selects the message of a GFS file,
+    # a message missing in the file is returned as nan
+    with pygrib.open(filename) as grbs:
+        if name is None:
+            grb = grbs.message(1)
+        else:
+            grb = next((g for g in grbs if g.name == name
+                        and (type_of_level is None or g.typeOfLevel == type_of_level)
+                        and (level is None or g.level == level)), None)
+            if grb is None:
+                return np.full(chunk, np.nan)
+        data = grb.values
+    if indexer is not None:
+        data = data[indexer]
+    return data.reshape(chunk)
+
+
+def _header(filename, region):
+    # grid of the first message, cropped to region
+    with pygrib.open(filename) as grbs:
+        grb = grbs.message(1)
+        grid = grid_cache.get_grid(grb)
+        if region is None:
+            return grb, None, grid.lats, grid.lons, grid.regular
+        indexer, lats, lons = grid_index.index_for_message(grb).crop(region)
+        return grb, indexer, lats, lons, grid_cache.is_regular(lats, lons)
+
+
+def _lazy_variable(slots, axes, shape, indexer):
+    '''
+    Dask array of the fields in slots {key: (file, message selection)},
+    keys are tuples of the labels along axes (date, time, step and the
+    level), fields that are missing are filled with nan.
+    '''
+    import dask
+    import dask.array as da
+
+    def build(labels, depth):
+        # nested lists of the chunks, down to the two axes of the grid
+        if depth == len(axes):
+            chunk = (1,) * depth + shape
+            if tuple(labels) not in slots:
+                return [[da.full(chunk, np.nan, chunks=chunk)]]
+            f, select = slots[tuple(labels)]
+            field = dask.delayed(_field, pure=True)(f, indexer, chunk, **select)
+            return [[da.from_delayed(field, chunk, dtype='f8')]]
+        return [build(labels + [label], depth + 1) for label in axes[depth]]
+
+    return da.block(build([], 0))
+
+
+def _dataset(variables, region):
+    '''
+    Lazy Dataset of variables, a list of (name, level dimension, slots,
+    file of the header) as built by open_gdps and open_gfs, slots
+    {(run, step, level): (file, message selection)}.
+    '''
+    runs = sorted(set(key[0] for _, _, slots, _ in variables for key in slots))
+    dates = sorted(set(run.floor('1D') for run in runs))
+    times = sorted(set(run - run.floor('1D') for run in runs))
+    steps = sorted(set(key[1] for _, _, slots, _ in variables for key in slots))
+
+    coords = OrderedDict()
+    data_vars = OrderedDict()
+    for name, level_dim, slots, header in variables:
+        grb, indexer, lats, lons, regular = _header(header, region)
+        dim_labels, grid = grib_to_xarray.grid_coords(lats, lons, regular)
+        coords.update(grid)
+        axes = [dates, times, steps]
+        keyed = OrderedDict()
+        for (run, step, level), slot in slots.items():
+            key = (run.floor('1D'), run - run.floor('1D'), step)
+            keyed[key + ((level,) if level_dim else ())] = slot
+        if level_dim:
+            levels = sorted(set(key[2] for key in slots))
+            coords[level_dim] = levels
+            axes.append(levels)
+            dim_labels = dim_labels[:3] + [level_dim] + dim_labels[3:]
+        data_vars[name] = (dim_labels, _lazy_variable(keyed, axes, lats.shape, indexer))
+
+    coords['date'] = dates
+    coords['time'] = times
+    coords['step'] = steps
+    return xr.Dataset(data_vars, coords=coords)
+
+
+def open_gdps(source, variables=None, region=None, start=None, end=None, time=None,
+              filters=None):
+    '''
+    Lazy Dataset of the GDPS files in source with the dimensions date,
+    time, step, air_pressure/ground_level and latitude, longitude (x, y
+    for grids that are not regular). Variables are named like in the
+    converted files, fields are decoded on access.
+
+    Parameters:
+    --------------------
+    source: folder of the grib files (string)
+    variables: GDPS variables, e.g. ['TMP_ISBL'], default all of
+               convert_gdps_xarray.VAR (list of strings)
+    region: bounding box (lat1, lon1, lat2, lon2) the fields are cropped to
+    start, end, time: days and time of day of the runs, see file_catalog.Catalog.runs
+    filters: selection of the files, default from config.yml (see file_filter)
+    '''
+    if variables is None:
+        variables = list(convert_gdps_xarray.VAR.values())
+    if filters is None:
+        filters = file_filter.load_filters()
+    with file_catalog.open_catalog(source) as catalog:
+        df = catalog.frame('gdps', start=start, end=end, time=time)
+    df = df[[file_filter.accept_name(filters, name) for name in df['names']]]
+    plan = []
+    for v in variables:
+        rows = df[df['variable'] + '_' + df['level_type'] == v]
+        if rows.empty:
+            continue
+        level_dim = LEVEL_DIMS.get(v.split('_')[1])
+        slots = OrderedDict(((pd.Timestamp(r.run), pd.Timedelta(hours=r.step), r.level),
+                             (r.names, {})) for r in rows.itertuples())
+        with pygrib.open(rows['names'].iloc[0]) as grbs:
+            var_name = convert_gdps_xarray.message_name(grbs.message(1), v)
+        plan.append((var_name, level_dim, slots, rows['names'].iloc[0]))
+    if not plan:
+        raise ValueError("No GDPS grib files found in {}".format(source))
+    return _dataset(plan, region)
+
+
+def open_gfs(source, names=None, region=None, start=None, end=None, time=None):
+    '''
+    Lazy Dataset of the GFS files in source, like open_gdps. The messages
+    of every name are looked up in the files of the first run, variables
+    with several levels of the same type of level get a level dimension.
+    Fields missing in a file (e.g. the radiation at step 0) are nan.
+
+    Parameters:
+    --------------------
+    source: folder of the grib files (string)
+    names: names of the grib messages, default the gfs variables of config.yml
+    region: bounding box (lat1, lon1, lat2, lon2) the fields are cropped to
+    start, end, time: days and time of day of the runs, see file_catalog.Catalog.runs
+    '''
+    if names is None:
+        names = list(CFG["variables"]["gfs"].values())
+    with file_catalog.open_catalog(source) as catalog:
+        df = catalog.frame('gfs', start=start, end=end, time=time)
+    if df.empty:
+        raise ValueError("No GFS grib files found in {}".format(source))
+
+    # the inventory of the first file holding a name (e.g. the radiation is
+    # missing at step 0), the type of level of its first message selects
+    # the levels
+    inventory = OrderedDict()
+    headers = {}
+    first_run = df[df['run'] == df['run'].iloc[0]]
+    for f in first_run.sort_values('step')['names']:
+        found = OrderedDict()
+        with pygrib.open(f) as grbs:
+            for grb in grbs:
+                if grb.name in names and grb.name not in inventory:
+                    type_of_level = found.setdefault(grb.name, (grb.typeOfLevel, []))[0]
+                    if grb.typeOfLevel == type_of_level:
+                        found[grb.name][1].append(grb.level)
+        for name in found:
+            headers[name] = f
+        inventory.update(found)
+        if len(inventory) == len(set(names)):
+            break
+
+    plan = []
+    for name, (type_of_level, levels) in inventory.items():
+        level_dim = LEVEL_DIMS.get(type_of_level, 'level') if len(levels) > 1 else None
+        slots = OrderedDict()
+        for r in df.itertuples():
+            for level in levels:
+                select = {'name': name, 'type_of_level': type_of_level, 'level': level}
+                slots[(pd.Timestamp(r.run), pd.Timedelta(hours=r.step), level)] = (r.names, select)
+                if level_dim is None:
+                    break
+        plan.append((name, level_dim, slots, headers[name]))
+    if not plan:
+        raise ValueError("None of {} found in {}".format(", ".join(names), source))
+    return _dataset(plan, region)
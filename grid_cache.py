@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Shared cache of the grid definitions of the forecast models. All messages
+# of a model use a handful of grids, so the lat/lon arrays are computed only
+# once per grid and stored as .npy files in the folder set in the grid_cache
+# section of config.yml. Other processes map these files into memory
+# instead of recomputing them, decoding a message then only needs its values.
+
+
+import os
+import os.path
+from os.path import join, dirname
+import hashlib
+import json
+import threading
+import numpy as np
+import yaml
+
+
+# grids used in this process, see get_grid
+_GRIDS = {}
+
+# keys of a grib message defining its grid
+GRID_KEYS = ('gridType', 'Ni', 'Nj',
+             'latitudeOfFirstGridPointInDegrees', 'longitudeOfFirstGridPointInDegrees',
+             'latitudeOfLastGridPointInDegrees', 'longitudeOfLastGridPointInDegrees',
+             'iDirectionIncrementInDegrees', 'jDirectionIncrementInDegrees')
+
+
+def is_regular(lats, lons):
+    '''
+    Check if lats only change along the 0th and lons only along the
+    1st dimension, see grib_to_xarray.grid_coords.
+    '''
+    lat0 = (lats[:, 0:1] * np.ones(lats.shape[1]) == lats).all()
+    lon1 = (lons[0:1, :].T * np.ones(lons.shape[0]) == lons.T).all()
+    return bool(lat0 and lon1)
+
+
+def grid_key(grb):
+    '''
+    Grid definition of a grib message, keys missing for its grid type are None.
+    '''
+    return tuple(grb[k] if grb.has_key(k) else None for k in GRID_KEYS)
+
+
+def cache_path():
+    '''
+    Folder of the persisted grids from config.yml, relative paths are
+    relative to config.yml. None if the grids are not persisted.
+    '''
+    with open(join(dirname(__file__), "config.yml"), "r") as yfile:
+        cfg = yaml.load(yfile, Loader=yaml.FullLoader).get("grid_cache") or {}
+    path = cfg.get("path")
+    if not path:
+        return None
+    return join(dirname(os.path.abspath(__file__)), path)
+
+
+class Grid:
+    '''
+    Coordinates of one grid.
+
+    Attributes
+    ----------
+    lats, lons : np.ndarray
+        2-D coordinates of the grid points, as returned by grb.latlons(),
+        read-only memory maps if the grid was loaded from the cache
+    regular : bool
+        lats only change along rows and lons along columns
+    lat_axis, lon_axis : np.ndarray
+        1-D coordinates of a regular grid, None otherwise
+    index : grid_index.GridIndex
+        Set by grid_index.index_for_message
+    '''
+
+    def __init__(self, lats, lons, regular=None):
+        self.lats = lats
+        self.lons = lons
+        self.regular = is_regular(lats, lons) if regular is None else regular
+        self.lat_axis = lats[:, 0] if self.regular else None
+        self.lon_axis = lons[0, :] if self.regular else None
+        self.index = None
+        self._masks = {}
+
+    def mask(self, lat1, lat2, lon1, lon2):
+        '''
+        Boolean mask of the grid points with lat1 <= lat <= lat2 and
+        lon1 <= lon <= lon2, the selection of grb.data(lat1=...). Cached
+        per bounding box.
+        '''
+        bbox = (lat1, lat2, lon1, lon2)
+        if bbox not in self._masks:
+            self._masks[bbox] = ((self.lats >= lat1) & (self.lats <= lat2)
+                                 & (self.lons >= lon1) & (self.lons <= lon2))
+        return self._masks[bbox]
+
+
+def _file_names(path, key):
+    name = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    return [join(path, name + suffix) for suffix in ('.lats.npy', '.lons.npy', '.json')]
+
+
+def _load(path, key):
+    lats_file, lons_file, info_file = _file_names(path, key)
+    # the info file is written last, it marks a complete grid
+    if not os.path.exists(info_file):
+        return None
+    with open(info_file) as f:
+        info = json.load(f)
+    if info["key"] != json.loads(json.dumps(key)):
+        return None
+    return Grid(np.load(lats_file, mmap_mode='r'), np.load(lons_file, mmap_mode='r'),
+                info["regular"])
+
+
+def _save(path, key, grid):
+    os.makedirs(path, exist_ok=True)
+    lats_file, lons_file, info_file = _file_names(path, key)
+    # processes (or threads) converting in parallel may write the same
+    # grid, every one writes its own files and moves them into place
+    tmp = '.{}.{}.tmp'.format(os.getpid(), threading.get_ident())
+    for filename, values in ((lats_file, grid.lats), (lons_file, grid.lons)):
+        with open(filename + tmp, 'wb') as f:
+            np.save(f, values)
+        os.replace(filename + tmp, filename)
+    with open(info_file + tmp, 'w') as f:
+        json.dump({"key": key, "regular": grid.regular}, f)
+    os.replace(info_file + tmp, info_file)
+
+
+def get_grid(grb):
+    '''
+    Return the Grid of a grib message. The coordinates are only computed
+    for the first message of a grid, afterwards they are taken from this
+    process or from the persisted cache.
+    '''
+    key = grid_key(grb)
+    if key not in _GRIDS:
+        path = cache_path()
+        grid = _load(path, key) if path is not None else None
+        if grid is None:
+            lats, lons = grb.latlons()
+            grid = Grid(lats, lons)
+            if path is not None:
+                try:
+                    _save(path, key, grid)
+                except OSError as err:
+                    print("Grid not cached: {}".format(err))
+        _GRIDS[key] = grid
+    return _GRIDS[key]
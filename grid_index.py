@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Nearest grid point lookups and regional cropping for the lat/lon grids of
+# the forecast models. Regular grids are handled with index arithmetic,
+# other grids with a KD-tree on the unit sphere (scipy).
+
+
+from os.path import join, dirname
+import numpy as np
+import yaml
+import grid_cache
+from grid_cache import is_regular
+
+
+# grid indices built in this process, see get_grid_index
+_INDEX_CACHE = {}
+
+
+def _uniform_axis(axis):
+    # first value and increment of an evenly spaced axis, None otherwise
+    if len(axis) < 2:
+        return None
+    step = (axis[-1] - axis[0]) / (len(axis) - 1)
+    if step == 0 or not np.allclose(np.diff(axis), step, rtol=1e-6, atol=1e-6):
+        return None
+    return axis[0], step
+
+
+def _xyz(lats, lons):
+    lat = np.radians(np.asarray(lats, dtype='f8'))
+    lon = np.radians(np.asarray(lons, dtype='f8'))
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class GridIndex:
+    '''
+    Index of a lat/lon grid answering nearest neighbour and bilinear
+    lookups for many coordinates in one vectorized call.
+
+    Parameters
+    ----------
+    lats, lons : np.ndarray
+        2-D coordinates of the grid points, as returned by grb.latlons()
+    regular : bool
+        Result of is_regular(lats, lons) if already known
+    '''
+
+    def __init__(self, lats, lons, regular=None):
+        self.shape = lats.shape
+        self.lats = lats
+        self.lons = lons
+        self.regular = False
+        self.cyclic = False
+        self.tree = None
+        self._crops = {}
+        if is_regular(lats, lons) if regular is None else regular:
+            lat_axis = _uniform_axis(lats[:, 0])
+            lon_axis = _uniform_axis(lons[0, :])
+            if lat_axis is not None and lon_axis is not None:
+                self.regular = True
+                self.lat0, self.dlat = lat_axis
+                self.lon0, self.dlon = lon_axis
+                # the grid wraps around the globe in longitude
+                self.cyclic = abs(abs(self.dlon) * self.shape[1] - 360) < 1e-6
+
+    def _fractional(self, lats, lons):
+        '''
+        Fractional row and column of the coordinates on a regular grid.
+        Longitudes can be given as -180..180 or 0..360.
+        '''
+        fi = (np.asarray(lats, dtype='f8') - self.lat0) / self.dlat
+        dlon = (np.asarray(lons, dtype='f8') - self.lon0) * np.sign(self.dlon)
+        fj = np.mod(dlon, 360) / abs(self.dlon)
+        return fi, fj
+
+    def _outside(self, i, j):
+        return (i < 0) | (i >= self.shape[0]) | (j < 0) | (j >= self.shape[1])
+
+    @staticmethod
+    def _raise_outside(outside, lats, lons):
+        if outside.any():
+            k = np.flatnonzero(outside)[0]
+            raise ValueError("Location ({}, {}) is outside of the grid".format(
+                np.ravel(lats)[k], np.ravel(lons)[k]))
+
+    def nearest(self, lats, lons):
+        '''
+        Row and column indices of the grid points nearest to the given
+        coordinates.
+
+        Parameters
+        ----------
+        lats, lons : array_like
+            Coordinates in degrees
+
+        Returns
+        -------
+        i, j : np.ndarray
+            Row (latitude) and column (longitude) indices
+        '''
+        if self.regular:
+            fi, fj = self._fractional(lats, lons)
+            i = np.rint(fi).astype(int)
+            j = np.rint(fj).astype(int)
+            if self.cyclic:
+                j = np.mod(j, self.shape[1])
+            self._raise_outside(self._outside(i, j), lats, lons)
+            return i, j
+
+        if self.tree is None:
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(_xyz(self.lats, self.lons).reshape(-1, 3))
+        _, k = self.tree.query(_xyz(lats, lons))
+        return np.unravel_index(k, self.shape)
+
+    def bilinear(self, lats, lons):
+        '''
+        Indices and weights of the four grid points surrounding each
+        coordinate, for bilinear interpolation on a regular grid:
+        value = (field[i, j] * w).sum(axis=-1)
+
+        Returns
+        -------
+        i, j, w : np.ndarray
+            Arrays of shape (..., 4)
+        '''
+        if not self.regular:
+            raise ValueError("Bilinear weights are only available for regular grids")
+        fi, fj = self._fractional(lats, lons)
+        # points on the last row/column use the last cell
+        i0 = np.minimum(np.floor(fi).astype(int), self.shape[0] - 2)
+        j0 = np.floor(fj).astype(int)
+        if not self.cyclic:
+            j0 = np.minimum(j0, self.shape[1] - 2)
+        di = fi - i0
+        dj = fj - j0
+        i = np.stack([i0, i0, i0 + 1, i0 + 1], axis=-1)
+        j = np.stack([j0, j0 + 1, j0, j0 + 1], axis=-1)
+        if self.cyclic:
+            j = np.mod(j, self.shape[1])
+        self._raise_outside(self._outside(i, j).any(axis=-1), lats, lons)
+        w = np.stack([(1 - di) * (1 - dj), (1 - di) * dj, di * (1 - dj), di * dj], axis=-1)
+        return i, j, w
+
+
+    def crop(self, bbox):
+        '''
+        Select the grid points inside a bounding box.
+        Returns an indexer for fields of this grid (field[indexer]) and the
+        latitudes and longitudes of the selected points. The result is
+        cached per bounding box.
+
+        Parameters
+        ----------
+        bbox : sequence
+            (lat1, lon1, lat2, lon2) in degrees, the box reaches eastwards
+            from lon1 to lon2, so it can cross the date line
+        '''
+        bbox = tuple(float(b) for b in bbox)
+        if bbox not in self._crops:
+            lat_min, lat_max = sorted((bbox[0], bbox[2]))
+            lon1 = bbox[1]
+            width = np.mod(bbox[3] - lon1, 360) or 360
+
+            if self.regular:
+                lat_axis = self.lats[:, 0]
+                lon_axis = self.lons[0, :]
+                rows = np.flatnonzero((lat_axis >= lat_min) & (lat_axis <= lat_max))
+                cols = np.flatnonzero(np.mod(lon_axis - lon1, 360) <= width)
+                # columns in eastward order, starting at lon1
+                cols = cols[np.argsort(np.mod(lon_axis[cols] - lon1, 360), kind='stable')]
+            else:
+                mask = ((self.lats >= lat_min) & (self.lats <= lat_max)
+                        & (np.mod(self.lons - lon1, 360) <= width))
+                rows = np.flatnonzero(mask.any(axis=1))
+                cols = np.flatnonzero(mask.any(axis=0))
+                cols = np.arange(cols[0], cols[-1] + 1) if len(cols) else cols
+            if len(rows) == 0 or len(cols) == 0:
+                raise ValueError("Region {} does not overlap the grid".format(bbox))
+
+            rows = slice(rows[0], rows[-1] + 1)
+            if (np.diff(cols) == 1).all():
+                cols = slice(cols[0], cols[-1] + 1)
+            indexer = (rows, cols)
+            self._crops[bbox] = (indexer, self.lats[indexer], self.lons[indexer])
+        return self._crops[bbox]
+
+
+def get_grid_index(lats, lons):
+    '''
+    Return the GridIndex for the grid of lats and lons, built only once per
+    grid in this process.
+    '''
+    key = (lats.shape, float(lats[0, 0]), float(lats[-1, -1]),
+           float(lons[0, 0]), float(lons[-1, -1]))
+    if key not in _INDEX_CACHE:
+        _INDEX_CACHE[key] = GridIndex(lats, lons)
+    return _INDEX_CACHE[key]
+
+
+def index_for_message(grb):
+    '''
+    Return the GridIndex for the grid of a grib message, built only once
+    per grid on the coordinates of grid_cache.
+    '''
+    grid = grid_cache.get_grid(grb)
+    if grid.index is None:
+        grid.index = GridIndex(grid.lats, grid.lons, grid.regular)
+    return grid.index
+
+
+def load_region(name=None, bbox=None):
+    '''
+    Return the bounding box (lat1, lon1, lat2, lon2) of a named region from
+    the regions section of config.yml, or bbox if it is given.
+    Returns None if neither is given.
+    '''
+    if bbox is not None:
+        return tuple(float(b) for b in bbox)
+    if name is None:
+        return None
+    with open(join(dirname(__file__), "config.yml"), "r") as yfile:
+        regions = yaml.load(yfile, Loader=yaml.FullLoader)["regions"]
+    try:
+        return tuple(float(b) for b in regions[name])
+    except KeyError:
+        raise ValueError("Unknown region: {} (available: {})".format(
+            name, ", ".join(regions)))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Timing and resource spans for the download and conversion pipeline.
+#
+#   with instrument.span('decode', variable='TMP_ISBL') as s:
+#       ...
+#       s.add(messages=1, bytes_in=size)
+#
+# Every span records wall and CPU time, the counters added to it and the
+# peak RSS of the process. The spans are written as json lines or, for a
+# path ending with .prom, summed up per name as a Prometheus textfile.
+# Without configure (or the GRIB_METRICS environment variable) span returns
+# a shared no-op object, so instrumented code runs at almost no cost.
+
+
+import os
+import os.path
+import sys
+import time
+import json
+import resource
+import threading
+from collections import OrderedDict
+
+
+# environment variable holding the metrics path, set by configure so
+# that worker processes of batch.run_batch write to the same output
+ENV_VAR = "GRIB_METRICS"
+
+_SINK = None
+_local = threading.local()
+
+
+class _NoSpan:
+    # returned by span while instrumentation is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **counters):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Span:
+    '''
+    One timed section of the pipeline, see span.
+    '''
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.counters = OrderedDict()
+
+    def add(self, **counters):
+        '''
+        Add to counters of the span, e.g. bytes_in, bytes_out, messages, files.
+        '''
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        _local.stack.pop()
+        record = OrderedDict([
+            ('span', self.name),
+            ('parent', self.parent),
+            ('start', self.start),
+            ('wall_s', wall),
+            ('cpu_s', cpu),
+            ('peak_rss_mb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0),
+            ('pid', os.getpid()),
+            ('error', exc_type.__name__ if exc_type is not None else None),
+        ])
+        record.update(self.labels)
+        record.update(self.counters)
+        if _SINK is not None:
+            _SINK.write(record)
+        return False
+
+
+class JsonLinesSink:
+    '''
+    Append every span as one json line to path ('-' for stderr).
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pid = None
+        self.file = None
+
+    def write(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self.lock:
+            if self.path == '-':
+                sys.stderr.write(line)
+                return
+            # forked worker processes open the file again
+            if self.pid != os.getpid():
+                self.file = open(self.path, 'a', buffering=1)
+                self.pid = os.getpid()
+            self.file.write(line)
+
+
+class PrometheusSink:
+    '''
+    Sum up the spans per name and write them as a Prometheus textfile (for
+    the textfile collector of the node exporter). The file is replaced
+    after every span, the spans are coarse enough for that.
+    Worker processes write their own file <path without .prom>.<pid>.prom.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.totals = OrderedDict()
+
+    def write(self, record):
+        with self.lock:
+            if self.pid != os.getpid():
+                # inherited from the parent by fork
+                self.pid = os.getpid()
+                self.totals = OrderedDict()
+            total = self.totals.setdefault(record['span'], OrderedDict(
+                [('count', 0), ('errors', 0), ('wall_seconds', 0.0),
+                 ('cpu_seconds', 0.0), ('peak_rss_bytes', 0.0)]))
+            total['count'] += 1
+            total['errors'] += record['error'] is not None
+            total['wall_seconds'] += record['wall_s']
+            total['cpu_seconds'] += record['cpu_s']
+            total['peak_rss_bytes'] = max(total['peak_rss_bytes'],
+                                          record['peak_rss_mb'] * 1024**2)
+            for key in ('bytes_in', 'bytes_out', 'messages', 'files'):
+                if key in record:
+                    total[key] = total.get(key, 0) + record[key]
+        self.flush()
+
+    def flush(self):
+        path = self.path
+        if os.environ.get(ENV_VAR + "_PID", str(os.getpid())) != str(os.getpid()):
+            path = "{}.{}.prom".format(path[:-len('.prom')], os.getpid())
+        with self.lock:
+            if not self.totals:
+                return
+            lines = []
+            metrics = sorted(set(key for total in self.totals.values() for key in total))
+            # the files of worker processes need a distinct label set
+            pid = '' if path == self.path else ',pid="{}"'.format(os.getpid())
+            for metric in metrics:
+                kind = 'gauge' if metric == 'peak_rss_bytes' else 'counter'
+                suffix = '' if kind == 'gauge' else '_total'
+                name = "grib_pipeline_span_{}{}".format(metric, suffix)
+                lines.append("# TYPE {} {}".format(name, kind))
+                for span_name, total in self.totals.items():
+                    if metric in total:
+                        lines.append('{}{{span="{}"{}}} {}'.format(name, span_name, pid,
+                                                                  total[metric]))
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+
+def configure(path):
+    '''
+    Enable the instrumentation. Spans are written as json lines to path,
+    or as a Prometheus textfile if path ends with .prom. None disables it.
+    Worker processes started afterwards inherit the setting.
+    '''
+    global _SINK
+    if path is None:
+        _SINK = None
+        os.environ.pop(ENV_VAR, None)
+        return
+    _SINK = PrometheusSink(path) if path.endswith('.prom') else JsonLinesSink(path)
+    os.environ[ENV_VAR] = path
+    os.environ.setdefault(ENV_VAR + "_PID", str(os.getpid()))
+
+
+def enabled():
+    return _SINK is not None
+
+
+def span(name, **labels):
+    '''
+    Context manager timing a section of the pipeline, labels are written
+    with the span (e.g. variable, file). Counters are added to the
+    returned span with add(bytes_in=..., messages=...).
+    '''
+    if _SINK is None:
+        return _NO_SPAN
+    return Span(name, labels)
+
+
+def file_bytes(files):
+    '''
+    Total size of files for the bytes counters, 0 while disabled.
+    '''
+    if _SINK is None:
+        return 0
+    return sum(os.path.getsize(f) for f in files)
+
+
+def add_argument(parser):
+    '''
+    Add the --metrics option to an argparse parser of an entry point.
+    '''
+    parser.add_argument("--metrics", default=os.environ.get(ENV_VAR),
+                        help="Write timing spans to this file as json lines, "
+                             "or as Prometheus textfile if it ends with .prom")
+
+
+# worker processes started with spawn import this module again
+if os.environ.get(ENV_VAR):
+    configure(os.environ[ENV_VAR])
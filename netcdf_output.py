@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# NetCDF output of the converters: encoding profiles from config.yml
+# (compression, packing, chunk shapes) and a streaming writer. For streaming
+# the output file is created with all dimensions and coordinates first,
+# afterwards every decoded field is written straight into its slot, so only
+# one field is held in memory.
+
+
+from os.path import join, dirname
+import numpy as np
+import pandas as pd
+import netCDF4
+import yaml
+
+
+DATE_UNITS = "hours since 1970-01-01 00:00:00"
+INT16_FILL = -32767
+
+
+def load_profile(name=None):
+    '''
+    Return the encoding profile name from the netcdf section of config.yml,
+    the default profile of config.yml if name is None.
+    '''
+    with open(join(dirname(__file__), "config.yml"), "r") as yfile:
+        cfg = yaml.load(yfile, Loader=yaml.FullLoader)["netcdf"]
+    if name is None:
+        name = cfg["profile"]
+    try:
+        return dict(cfg["profiles"][name] or {})
+    except KeyError:
+        raise ValueError("Unknown netcdf profile: {} (available: {})".format(
+            name, ", ".join(cfg["profiles"])))
+
+
+def chunk_shape(dims, sizes, chunks):
+    '''
+    Chunk shape for a variable with the given dimensions and sizes.
+    chunks maps dimension names to chunk lengths, 'step' also matches
+    step_ghi, step_temp, ...; dimensions not listed get a single chunk.
+    '''
+    shape = []
+    for dim, size in zip(dims, sizes):
+        length = chunks.get(dim, chunks.get(dim.split('_')[0], size))
+        shape.append(max(1, min(int(length), size)))
+    return tuple(shape)
+
+
+def variable_encoding(name, dims, sizes, profile, data=None, dtype="f8"):
+    '''
+    Encoding of one data variable for a profile, with the keys of the
+    encoding argument of xr.Dataset.to_netcdf: dtype, zlib, complevel,
+    shuffle, chunksizes and for int16 packing scale_factor, add_offset
+    and _FillValue.
+
+    Packing parameters are taken from the packing section of the profile,
+    otherwise computed from data. Without either the variable is stored
+    as float32.
+    '''
+    enc = {"dtype": np.dtype(profile.get("dtype", dtype))}
+    for key in ("zlib", "complevel", "shuffle"):
+        if key in profile:
+            enc[key] = profile[key]
+    if "chunks" in profile:
+        enc["chunksizes"] = chunk_shape(dims, sizes, profile["chunks"])
+
+    if enc["dtype"] == np.int16:
+        packing = profile.get("packing", {}).get(name)
+        if packing is None and data is not None:
+            vmin, vmax = float(np.nanmin(data)), float(np.nanmax(data))
+            packing = {"scale_factor": (vmax - vmin) / (2 ** 16 - 4) or 1.0,
+                       "add_offset": (vmax + vmin) / 2}
+        if packing is None:
+            enc["dtype"] = np.dtype("f4")
+        else:
+            enc["scale_factor"] = packing["scale_factor"]
+            enc["add_offset"] = packing["add_offset"]
+            enc["_FillValue"] = INT16_FILL
+    return enc
+
+
+def encoding(ds, profile):
+    '''
+    Encoding of all data variables of ds for xr.Dataset.to_netcdf.
+    '''
+    return {name: variable_encoding(name, var.dims, var.shape, profile, var.values)
+            for name, var in ds.data_vars.items()}
+
+
+def _encode_coord(values):
+    '''
+    Convert coordinate values to numbers and attributes in the same
+    encoding xarray uses, so that xr.open_dataset decodes them again.
+    '''
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        hours = (values - np.datetime64("1970-01-01")) / np.timedelta64(1, "h")
+        return hours.astype("f8"), {"units": DATE_UNITS, "calendar": "proleptic_gregorian"}
+    if np.issubdtype(values.dtype, np.timedelta64):
+        hours = values / np.timedelta64(1, "h")
+        return hours.astype("f8"), {"units": "hours", "dtype": "timedelta64[ns]"}
+    return values, {}
+
+
+def create_netcdf(outfilename, dims, coords, variables, dtype="f8", profile=None,
+                  unlimited=()):
+    '''
+    Create a NetCDF file with all dimensions, coordinates and empty data
+    variables and return it opened for writing. Data is written later with
+    nc.variables[name][index] = field, one field at a time.
+
+    Parameters
+    ----------
+    outfilename : str
+        Path of the NetCDF file
+    dims : OrderedDict
+        {dimension name: size}
+    coords : OrderedDict
+        {coordinate name: (dimension names, values)}, values can be
+        numbers, datetime64 or timedelta64 (also pandas types)
+    variables : OrderedDict
+        {variable name: dimension names}
+    dtype : str
+        Storage type of the data variables, e.g. 'f8' or 'f4'
+    profile : dict
+        Encoding profile (see load_profile), its dtype overrides dtype
+    unlimited : sequence of str
+        Dimensions created unlimited, so that they can be extended later
+
+    Returns
+    -------
+    nc : netCDF4.Dataset
+    '''
+    nc = netCDF4.Dataset(outfilename, "w", format="NETCDF4")
+    for name, size in dims.items():
+        nc.createDimension(name, None if name in unlimited else size)
+
+    # coordinates that are not dimensions have to be listed on the
+    # data variables, so that xarray reads them as coordinates
+    aux_coords = []
+    for name, (coord_dims, values) in coords.items():
+        if isinstance(values, (pd.Timestamp, pd.Timedelta)):
+            values = values.to_numpy()
+        data, attrs = _encode_coord(values)
+        var = nc.createVariable(name, data.dtype, tuple(coord_dims))
+        var.setncatts(attrs)
+        if any(d in unlimited for d in coord_dims):
+            var[:len(data)] = data
+        else:
+            var[...] = data
+        if tuple(coord_dims) != (name,):
+            aux_coords.append(name)
+
+    for name, var_dims in variables.items():
+        sizes = [dims[d] for d in var_dims]
+        enc = variable_encoding(name, var_dims, sizes, profile or {}, dtype=dtype)
+        fill_value = enc.pop("_FillValue", np.nan)
+        packing = {k: enc.pop(k) for k in ("scale_factor", "add_offset") if k in enc}
+        var = nc.createVariable(name, enc.pop("dtype"), tuple(var_dims),
+                                fill_value=fill_value, **enc)
+        # netCDF4 packs the data written to the variable with these
+        var.setncatts(packing)
+        if aux_coords:
+            var.coordinates = " ".join(aux_coords)
+    return nc
+
+
+def open_netcdf(outfilename):
+    '''
+    Open a NetCDF file written by create_netcdf to write more data,
+    e.g. along the dimensions it was created with as unlimited.
+    '''
+    return netCDF4.Dataset(outfilename, "a")
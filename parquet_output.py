@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Parquet output of the GFS point/bbox extraction. The table is partitioned
+# by base date (basedate=YYYY-MM-DD folders) and written incrementally, one
+# dataframe of a grib file after the other, so memory use does not grow with
+# the number of files. Times are stored as timestamps, the repeated
+# coordinates dictionary encoded. Needs pyarrow.
+
+
+import os
+import os.path
+import numpy as np
+import pandas as pd
+
+
+# columns repeated on many rows, stored dictionary encoded
+DICTIONARY_COLUMNS = ['validtime', 'basetime', 'latitude', 'longitude']
+
+# rows collected per partition before a row group is written
+ROW_GROUP_ROWS = 1000000
+
+
+def partition_path(outpath, basetime, name):
+    '''
+    Path of the parquet file name in the partition of basetime.
+    '''
+    basedate = pd.Timestamp(basetime).strftime('%Y-%m-%d')
+    return os.path.join(outpath, 'basedate={}'.format(basedate), name + '.parquet')
+
+
+class PartitionedWriter:
+    '''
+    Write dataframes of grib_to_df (columns validtime, basetime, latitude,
+    longitude and the variables) to a parquet dataset partitioned by base
+    date. Every partition gets one file named name, so several writers with
+    different names can add to the same dataset. The file of a partition is
+    closed as soon as rows of another base date arrive, so an interrupted
+    writer leaves at most the current partition unreadable. Rows of a base
+    date that arrive again later go to a further file name-<n>.
+    The dataset is read with pd.read_parquet(outpath), the base date
+    partition becomes the column basedate.
+
+    Parameters
+    ----------
+    outpath : str
+        Folder of the dataset
+    name : str
+        File name (without suffix) used in every partition
+    row_group_rows : int
+        Rows buffered per partition before a row group is written
+    '''
+
+    def __init__(self, outpath, name='part-0', row_group_rows=ROW_GROUP_ROWS):
+        import pyarrow as pa
+        self.pa = pa
+        self.outpath = outpath
+        self.name = name
+        self.row_group_rows = row_group_rows
+        self.schema = None
+        self._writers = {}
+        self._buffers = {}
+        # partition path: number of files of the partition closed so far
+        self._closed = {}
+
+    def _table(self, df):
+        # float32 covers the precision of the grib fields and coordinates
+        df = df.astype({col: np.float32 for col in df.columns
+                        if col not in ('validtime', 'basetime')})
+        df = df.astype({'validtime': 'datetime64[ns]', 'basetime': 'datetime64[ns]'})
+        table = self.pa.Table.from_pandas(df, preserve_index=False)
+        if self.schema is None:
+            self.schema = table.schema
+        return table.cast(self.schema)
+
+    def write(self, df):
+        '''
+        Add the rows of df to the partitions of their base dates.
+        '''
+        if len(df) == 0:
+            return
+        for basetime, part in df.groupby('basetime', sort=False):
+            path = partition_path(self.outpath, basetime, self.name)
+            # only the current partition is buffered and open, the runs
+            # usually arrive one after the other
+            for other in [p for p in set(self._buffers) | set(self._writers) if p != path]:
+                self._close_partition(other)
+            buffer = self._buffers.setdefault(path, [])
+            buffer.append(self._table(part))
+            if sum(len(t) for t in buffer) >= self.row_group_rows:
+                self._flush(path)
+
+    def _flush(self, path):
+        import pyarrow.parquet as pq
+        buffer = self._buffers.pop(path, [])
+        if not buffer:
+            return
+        if path not in self._writers:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            filename = path
+            if path in self._closed:
+                # the partition was closed before, do not overwrite its file
+                filename = path[:-len('.parquet')] + '-{}.parquet'.format(self._closed[path])
+            self._writers[path] = pq.ParquetWriter(
+                filename, self.schema, compression='zstd',
+                use_dictionary=DICTIONARY_COLUMNS)
+        self._writers[path].write_table(self.pa.concat_tables(buffer))
+
+    def _close_partition(self, path):
+        # write the rows of the partition and its footer
+        self._flush(path)
+        writer = self._writers.pop(path, None)
+        if writer is not None:
+            writer.close()
+            self._closed[path] = self._closed.get(path, 0) + 1
+
+    def close(self):
+        '''
+        Write the remaining rows and close all partition files.
+        '''
+        for path in set(self._buffers) | set(self._writers):
+            self._close_partition(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
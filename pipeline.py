@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Run stages of work concurrently, linked by bounded queues: every stage
+# has its own worker threads and passes its results on to the next stage
+# as soon as they are ready. A full queue blocks the stage before it
+# (back-pressure), so only a bounded number of items is in flight.
+
+
+import threading
+import queue
+from collections import OrderedDict
+import instrument
+
+
+# end of the input of a worker
+_DONE = object()
+
+
+def _label(item):
+    # items are passed as tuples with a short label first, or as strings
+    return item[0] if isinstance(item, tuple) else item
+
+
+def run_pipeline(source, stages, maxsize=8, cancel=None):
+    '''
+    Pass every item of source through the stages. Each stage calls its
+    function in its own worker threads, the result is put into the queue
+    of the next stage (None drops the item). Items failing in a stage are
+    printed and counted, they do not stop the others.
+
+    Setting cancel (or Ctrl-C) stops all stages after the items they are
+    working on, the threads are joined before returning (or re-raising
+    KeyboardInterrupt).
+
+    Parameters
+    ----------
+    source : iterable
+        Items for the first stage, consumed lazily
+    stages : list of tuples
+        (name, function, number of workers) of every stage
+    maxsize : int
+        Size of the queues between the stages
+    cancel : threading.Event
+        Set to stop the pipeline
+
+    Returns
+    -------
+    summary : OrderedDict
+        {stage name: {'done': number of items, 'failed': labels of failed items}},
+        and 'cancelled'
+    '''
+    cancel = cancel or threading.Event()
+    queues = [queue.Queue(maxsize) for _ in stages]
+    summary = OrderedDict((name, {'done': 0, 'failed': []}) for name, _, _ in stages)
+    running = [workers for _, _, workers in stages]
+    lock = threading.Lock()
+
+    def put(q, item):
+        # block while the queue is full, unless the pipeline is cancelled
+        while not cancel.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def close(k):
+        # the last worker of stage k ends the input of stage k + 1
+        with lock:
+            running[k] -= 1
+            last = running[k] == 0
+        if last and k + 1 < len(stages):
+            for _ in range(stages[k + 1][2]):
+                put(queues[k + 1], _DONE)
+
+    def feed():
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+        finally:
+            for _ in range(stages[0][2]):
+                put(queues[0], _DONE)
+
+    def work(k):
+        name, func, _ = stages[k]
+        try:
+            while not cancel.is_set():
+                try:
+                    item = queues[k].get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    break
+                try:
+                    with instrument.span(name):
+                        result = func(item)
+                except Exception as err:
+                    print("{} failed: {} ({})".format(name, _label(item), err))
+                    with lock:
+                        summary[name]['failed'].append(_label(item))
+                    continue
+                with lock:
+                    summary[name]['done'] += 1
+                if result is not None and k + 1 < len(stages):
+                    if not put(queues[k + 1], result):
+                        break
+        finally:
+            close(k)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for k, (name, _, workers) in enumerate(stages):
+        threads += [threading.Thread(target=work, args=(k,), name="{}-{}".format(name, i),
+                                     daemon=True) for i in range(workers)]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(0.1)
+    except KeyboardInterrupt:
+        cancel.set()
+        for t in threads:
+            t.join()
+        raise
+
+    summary['cancelled'] = cancel.is_set()
+    return summary
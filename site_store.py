@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Location-major store of the site forecasts (the *_sites.nc files of
+# convert_gdps_xarray.extract_sites). All runs are kept in one Zarr array
+# (site, run, step, variable) chunked by site, so the history of one site
+# is a few contiguous chunks and
+#
+#   site_store.query("sites.zarr", "Freiburg", "2020-01-01", "2020-12-31")
+#
+# reads only those instead of opening every run file. New runs are
+# appended in batches by update, which is run after the conversion.
+#
+# The number of runs in the store is kept in the attributes and written
+# last, readers ignore runs beyond it, so an interrupted append is simply
+# overwritten by the next one.
+
+
+import os
+import os.path
+from os.path import join, dirname
+import re
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+import zarr
+import zarr_archive
+import instrument
+
+with open(join(dirname(__file__), "config.yml"), "r") as yfile:
+    CFG = yaml.load(yfile, Loader=yaml.FullLoader)
+
+# e.g. CMC_20200101_00_sites.nc
+SITES_NAME_RE = re.compile(r'_(\d{8})_(\d{2})_sites\.nc$')
+
+
+def _run_of_file(filename):
+    # run of a site file from its name, None if it does not match
+    m = SITES_NAME_RE.search(filename)
+    if m is None:
+        return None
+    return pd.Timestamp(m.group(1) + 'T' + m.group(2))
+
+
+def _create(store_path, ds, run_chunk):
+    group = zarr.open_group(store_path, mode='w')
+    nstep, nvar = ds.sizes['step'], ds.sizes['variable']
+    group.create_array('forecast', shape=(ds.sizes['site'], 0, nstep, nvar),
+                       chunks=(1, run_chunk, nstep, nvar), dtype='f4', fill_value=np.nan,
+                       dimension_names=('site', 'run', 'step', 'variable'))
+    group.create_array('run', shape=(0,), chunks=(4096,), dtype='i8',
+                       fill_value=0, dimension_names=('run',))
+    group.attrs.update({
+        'sites': [str(s) for s in ds['site'].values],
+        'latitude': [float(x) for x in ds['latitude'].values],
+        'longitude': [float(x) for x in ds['longitude'].values],
+        'steps': [int(s) for s in ds['step'].values // np.timedelta64(1, 'h')],
+        'variables': [str(v) for v in ds['variable'].values],
+        'nruns': 0})
+    return group
+
+
+def stored_runs(store_path):
+    '''
+    Runs in the store, in the order they were appended, as datetime64.
+    '''
+    group = zarr.open_group(store_path, mode='r')
+    return group['run'][:group.attrs['nruns']].astype('datetime64[ns]')
+
+
+def _new_runs(datasets, known):
+    # {run as int64 nanoseconds: dataset} of the runs not in known, by run
+    runs = {}
+    for ds in datasets:
+        run = int(pd.Timestamp(ds['date'].values).value)
+        if run not in known:
+            runs[run] = ds
+    return dict(sorted(runs.items()))
+
+
+def append_runs(store_path, datasets, run_chunk=None):
+    '''
+    Append site forecasts of several runs to the store at store_path, it
+    is created with the first run. Runs already in the store are skipped,
+    sites that are new are added. Steps and variables are fixed by the
+    first run, later runs may have fewer (filled with nan) but no others.
+    Returns the number of runs appended.
+
+    Parameters
+    ----------
+    store_path : str
+        Path of the Zarr store
+    datasets : list of xr.Dataset
+        Outputs of convert_gdps_xarray.extract_sites
+    run_chunk : int
+        Runs per chunk, only used when the store is created
+    '''
+    if run_chunk is None:
+        run_chunk = CFG["site_store"]["run_chunk"]
+    if not datasets:
+        return 0
+    with zarr_archive._append_lock(store_path):
+        if os.path.exists(store_path):
+            group = zarr.open_group(store_path, mode='r+')
+        else:
+            group = _create(store_path, datasets[0], run_chunk)
+        attrs = group.attrs.asdict()
+        nruns = attrs['nruns']
+        known = set(group['run'][:nruns].tolist())
+        new = _new_runs(datasets, known)
+        if not new:
+            return 0
+
+        sites = list(attrs['sites'])
+        lats, lons = list(attrs['latitude']), list(attrs['longitude'])
+        for ds in new.values():
+            for site, lat, lon in zip(ds['site'].values, ds['latitude'].values,
+                                      ds['longitude'].values):
+                if str(site) not in sites:
+                    sites.append(str(site))
+                    lats.append(float(lat))
+                    lons.append(float(lon))
+        steps = pd.to_timedelta(attrs['steps'], unit='h')
+        variables = attrs['variables']
+
+        position = {site: k for k, site in enumerate(sites)}
+        block = np.full((len(sites), len(new), len(steps), len(variables)), np.nan, dtype='f4')
+        for k, ds in enumerate(new.values()):
+            if not ds.indexes['step'].isin(steps).all() or \
+                    not ds.indexes['variable'].isin(variables).all():
+                raise ValueError("Steps or variables of run {} do not match the store {}"
+                                 .format(ds['date'].values, store_path))
+            forecast = ds['forecast'].reindex(step=steps, variable=variables)
+            rows = [position[str(s)] for s in ds['site'].values]
+            block[rows, k] = forecast.values
+
+        with instrument.span('site_store', runs=len(new)) as span:
+            forecast = group['forecast']
+            forecast.resize((len(sites), nruns + len(new)) + forecast.shape[2:])
+            forecast[:, nruns:] = block
+            group['run'].resize((nruns + len(new),))
+            group['run'][nruns:] = np.array(list(new), dtype='i8')
+            span.add(bytes_out=block.nbytes)
+        # committed with the number of runs
+        group.attrs.update({'sites': sites, 'latitude': lats, 'longitude': lons,
+                            'nruns': nruns + len(new)})
+    return len(new)
+
+
+def update(store_path, source, batch=None):
+    '''
+    Append all site files (*_sites.nc) in source that are not yet in the
+    store, batch runs at a time. The runs are taken from the file names,
+    so files already in the store are not opened.
+    Returns the number of runs appended.
+
+    Parameters
+    ----------
+    store_path : str
+        Path of the Zarr store
+    source : str
+        Folder of the site files
+    batch : int
+        Number of runs read and appended together
+    '''
+    if batch is None:
+        batch = CFG["site_store"]["batch"]
+    known = set()
+    if os.path.exists(store_path):
+        known = set(stored_runs(store_path).astype('i8').tolist())
+    files = [f for f in sorted(glob.glob(join(source, "*_sites.nc")))
+             if _run_of_file(f) is not None and _run_of_file(f).value not in known]
+    appended = 0
+    for k in range(0, len(files), batch):
+        datasets = []
+        for f in files[k:k + batch]:
+            with xr.open_dataset(f) as ds:
+                datasets.append(ds.load())
+        appended += append_runs(store_path, datasets)
+        print("{} runs appended to {}".format(appended, store_path))
+    return appended
+
+
+def query(store_path, site, start=None, end=None, variables=None):
+    '''
+    All forecasts of a site issued between start and end (inclusive).
+    Returns a DataFrame with the columns issue_time, valid_time and one
+    column per variable, sorted by issue and valid time. Steps without
+    any value are left out.
+
+    Parameters
+    ----------
+    store_path : str
+        Path of the Zarr store
+    site : str
+        Name of the site
+    start, end : str / pd.Timestamp / None
+        First and last issue time
+    variables : list of str
+        Variables to return, default all
+    '''
+    group = zarr.open_group(store_path, mode='r')
+    attrs = group.attrs.asdict()
+    if site not in attrs['sites']:
+        raise ValueError("Site {} not in {}".format(site, store_path))
+    runs = group['run'][:attrs['nruns']].astype('datetime64[ns]')
+    selected = np.ones(len(runs), dtype=bool)
+    if start is not None:
+        selected &= runs >= np.datetime64(pd.Timestamp(start))
+    if end is not None:
+        selected &= runs <= np.datetime64(pd.Timestamp(end))
+    index = np.flatnonzero(selected)
+    if variables is None:
+        variables = attrs['variables']
+    columns = [attrs['variables'].index(v) for v in variables]
+    if len(index) == 0:
+        return pd.DataFrame(columns=['issue_time', 'valid_time'] + list(variables))
+
+    # one contiguous read of the site, runs outside are dropped afterwards
+    values = group['forecast'][attrs['sites'].index(site), index[0]:index[-1] + 1]
+    values = values[index - index[0]][:, :, columns]
+    steps = pd.to_timedelta(attrs['steps'], unit='h').values
+    issue = np.repeat(runs[index], len(steps))
+    df = pd.DataFrame(values.reshape(-1, len(columns)), columns=list(variables))
+    df.insert(0, 'issue_time', issue)
+    df.insert(1, 'valid_time', issue + np.tile(steps, len(index)))
+    # runs from before the site was added
+    df = df.dropna(how='all', subset=list(variables))
+    return df.sort_values(['issue_time', 'valid_time'], ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store", help="path of the site store (Zarr)")
+    parser.add_argument("source", help="folder of the *_sites.nc files")
+    instrument.add_argument(parser)
+    args = parser.parse_args()
+    instrument.configure(args.metrics)
+    update(args.store, args.source)
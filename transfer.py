@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Shared helpers for resumable, incremental HTTP downloads.
+# Downloads are verified while they stream in: the size against the
+# Content-Length, a SHA-256 of the content, and for grib files the message
+# structure (see grib_stream.GribValidator). Files failing a check are
+# fetched again and never renamed into place.
+
+
+import os
+import os.path
+import json
+import hashlib
+import threading
+import requests
+import grib_stream
+
+
+MANIFEST_NAME = ".manifest.json"
+PART_SUFFIX = ".part"
+
+# number of times a download failing the checks is started again
+RETRIES = 2
+
+# endings of the files checked with grib_stream.GribValidator
+GRIB_SUFFIXES = ('.grib2', '.grb2', '.grib', '.grb')
+
+
+class IntegrityError(ValueError):
+    '''
+    Downloaded data failed a check, e.g. a truncated grib message.
+    '''
+
+
+class Manifest:
+    '''
+    Record of the files fetched into a download folder.
+    For every file name the size, Last-Modified and ETag headers
+    of the last complete download are stored in a json file,
+    so that unchanged files can be skipped on the next run.
+
+    Parameters:
+    -------------------------
+    dest_path: download folder the manifest belongs to (string)
+    '''
+
+    def __init__(self, dest_path):
+        self.path = os.path.join(dest_path, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+
+    def get(self, name):
+        with self.lock:
+            return dict(self.entries.get(name, {}))
+
+    def update(self, name, **fields):
+        '''
+        Update the entry of name and write the manifest to disk.
+        '''
+        with self.lock:
+            self.entries.setdefault(name, {}).update(fields)
+            self._save()
+
+    def _save(self):
+        # write to a temporary file first, an interrupted run must
+        # never leave a truncated manifest behind
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def _validators(headers):
+    return {"etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified")}
+
+
+def _unchanged(entry, headers):
+    '''
+    Check if the response headers describe the same file as the manifest entry.
+    '''
+    new = _validators(headers)
+    if entry.get("etag") and new["etag"]:
+        return entry["etag"] == new["etag"]
+    if entry.get("last_modified") and new["last_modified"]:
+        return entry["last_modified"] == new["last_modified"]
+    return False
+
+
+def _expected_size(response, offset):
+    # size of the complete file from the headers, None if unknown; with
+    # Content-Encoding the Content-Length is not the size of the content
+    if response.headers.get("Content-Encoding"):
+        return None
+    if response.status_code == 206:
+        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get("Content-Length")
+    return offset + int(length) if length is not None else None
+
+
+class _Checks:
+    # size, hash and grib structure of a download, fed chunk by chunk
+    def __init__(self, name):
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.grib = grib_stream.GribValidator() if name.endswith(GRIB_SUFFIXES) else None
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        self.sha256.update(chunk)
+        if self.grib is not None:
+            try:
+                self.grib.feed(chunk)
+            except ValueError as err:
+                raise IntegrityError(str(err))
+
+    def close(self, expected_size):
+        if expected_size is not None and self.size != expected_size:
+            raise IntegrityError("Received {} of {} bytes".format(self.size, expected_size))
+        if self.grib is not None:
+            try:
+                self.grib.close()
+            except ValueError as err:
+                raise IntegrityError(str(err))
+
+
+def fetch_file(session, link, target_path, manifest=None, chunk_size=1024*1024,
+               retries=RETRIES):
+    '''
+    Download link to target_path and return the number of bytes transferred.
+
+    Data is written to target_path + '.part' and renamed to target_path
+    once complete and verified: the size has to match the Content-Length
+    and grib files have to consist of complete messages. A download
+    failing the checks is started again from scratch, one losing its
+    connection is resumed (if a manifest is given), up to retries times,
+    then IntegrityError (or the error of the connection) is raised.
+    The SHA-256 of the file is stored in the manifest.
+    If a manifest is given, the download is incremental:
+    files that are unchanged on the server are skipped and partial files
+    left by an interrupted run are resumed with a HTTP Range request.
+    A partial file the server cannot resume (416, e.g. it is already
+    complete) is downloaded again from the start.
+
+    Parameters:
+    -------------------------
+    session: requests.Session
+    link: url of the file (string)
+    target_path: path of the downloaded file (string)
+    manifest: Manifest of the download folder or None
+    chunk_size: size of the chunks written to disk (int)
+    retries: number of new attempts after a failed check (int)
+    '''
+    part_path = target_path + PART_SUFFIX
+    for attempt in range(retries + 1):
+        try:
+            return _fetch(session, link, target_path, manifest, chunk_size)
+        except (IntegrityError, requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError) as err:
+            # after bad data the next attempt starts from scratch; the part
+            # of a lost connection is kept and resumed (with a manifest),
+            # also by the next run after the last attempt
+            if isinstance(err, IntegrityError) and os.path.exists(part_path):
+                os.remove(part_path)
+            if attempt == retries:
+                raise
+            print("Retrying {} ({})".format(link, err))
+
+
+def _fetch(session, link, target_path, manifest, chunk_size):
+    name = os.path.basename(target_path)
+    part_path = target_path + PART_SUFFIX
+    headers = {}
+    entry = {}
+    offset = 0
+
+    if manifest is not None:
+        entry = manifest.get(name)
+        complete = (entry.get("complete") and os.path.exists(target_path)
+                    and os.path.getsize(target_path) == entry.get("size"))
+        if complete:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        elif os.path.exists(part_path) and (entry.get("etag") or entry.get("last_modified")):
+            # resume only if the server still serves the same file,
+            # otherwise If-Range makes it send the complete new file
+            offset = os.path.getsize(part_path)
+            headers["Range"] = "bytes=%d-" % offset
+            headers["If-Range"] = entry.get("etag") or entry["last_modified"]
+        else:
+            complete = False
+    else:
+        complete = False
+
+    with session.get(link, stream=True, headers=headers) as r:
+        if r.status_code == 304 or (complete and r.status_code == 200
+                                    and _unchanged(entry, r.headers)):
+            return 0
+        if r.status_code == 416 and offset:
+            # the part is already complete (or longer than the file)
+            os.remove(part_path)
+            return _fetch(session, link, target_path, manifest, chunk_size)
+        r.raise_for_status()
+        if r.status_code != 206:
+            offset = 0
+        if manifest is not None:
+            manifest.update(name, url=link, complete=False, **_validators(r.headers))
+
+        checks = _Checks(name)
+        if offset:
+            # the checks cover the part from the interrupted run as well
+            with open(part_path, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    checks.feed(chunk)
+
+        nbytes = 0
+        with open(part_path, "ab" if offset else "wb") as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    checks.feed(chunk)
+                    f.write(chunk)
+                    nbytes += len(chunk)
+        checks.close(_expected_size(r, offset))
+
+    os.replace(part_path, target_path)
+    if manifest is not None:
+        manifest.update(name, complete=True, size=os.path.getsize(target_path),
+                        sha256=checks.sha256.hexdigest())
+    return nbytes
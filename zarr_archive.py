@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Appendable Zarr archive of converted forecast runs. All runs of a model
+# are stacked along one 'run' dimension (with 'date' and 'time' as
+# coordinates along it) in a single chunked Zarr store.
+#
+# Readers open the store with its consolidated metadata, which is replaced
+# atomically as the last step of an append. The chunks of a new run are
+# written to new files before that, so a reader always sees complete runs.
+
+
+import os
+import os.path
+import shutil
+import fcntl
+from contextlib import contextmanager
+import numpy as np
+import xarray as xr
+import zarr
+import netcdf_output
+
+
+LOCK_NAME = ".append.lock"
+
+
+def to_run_dataset(ds):
+    '''
+    Replace the singleton date/time dimensions of a converted forecast
+    (date/time for GFS, forecastdate/forecasttime for GDPS) by one run
+    dimension. date and time are kept as coordinates along run.
+    '''
+    for dim in ('date', 'time', 'forecastdate', 'forecasttime'):
+        if dim in ds.dims:
+            ds = ds.squeeze(dim)
+    date = ds['date'].values
+    time = ds['time'].values
+    ds = ds.expand_dims(run=[date + time])
+    return ds.assign_coords(date=('run', [date]), time=('run', [time]))
+
+
+@contextmanager
+def _append_lock(store_path):
+    # parallel conversions of one model append to the same store one by one
+    with open(store_path + LOCK_NAME, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _rollback_partial(store_path, nruns):
+    '''
+    Shrink arrays that were resized by an interrupted append back to the
+    number of runs recorded in the consolidated metadata.
+    '''
+    group = zarr.open_group(store_path, mode='r+', use_consolidated=False)
+    for name, array in group.arrays():
+        dims = (getattr(array.metadata, 'dimension_names', None)
+                or array.attrs.get('_ARRAY_DIMENSIONS', ()))
+        if dims and dims[0] == 'run' and array.shape[0] > nruns:
+            array.resize((nruns,) + array.shape[1:])
+
+
+def append_run(ds, store_path, profile=None):
+    '''
+    Append a converted forecast run to the Zarr store at store_path,
+    the store is created with the first run. Returns False if the run
+    is already in the store.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Output of one of the converters
+    store_path : str
+        Path of the Zarr store of the model
+    profile : dict
+        Encoding profile (see netcdf_output.load_profile), only its chunk
+        shape is used, every run is stored in its own chunks
+    '''
+    run_ds = to_run_dataset(ds)
+    chunks = (profile or {}).get('chunks', {})
+    with _append_lock(store_path):
+        if not os.path.exists(store_path):
+            encoding = {name: {'chunks': (1,) + netcdf_output.chunk_shape(
+                                   var.dims[1:], var.shape[1:], chunks)}
+                        for name, var in run_ds.data_vars.items()}
+            # in minutes, the units guessed from a 00Z first run (days)
+            # would turn later 12Z runs into other dates
+            encoding['run'] = {'units': 'minutes since 1970-01-01', 'dtype': 'int64'}
+            encoding['time'] = {'units': 'minutes', 'dtype': 'int64'}
+            # create the store next to the target and move it into place,
+            # so that no reader ever sees a half written first run
+            tmp = store_path + '.tmp'
+            shutil.rmtree(tmp, ignore_errors=True)
+            run_ds.to_zarr(tmp, mode='w', encoding=encoding, consolidated=True)
+            os.rename(tmp, store_path)
+            return True
+
+        with xr.open_zarr(store_path, consolidated=True) as existing:
+            if np.isin(run_ds['run'].values, existing['run'].values).any():
+                return False
+            _rollback_partial(store_path, existing.sizes['run'])
+            # runs with fewer steps (or levels) are filled up with nan
+            indexers = {}
+            for dim in run_ds.dims:
+                if dim != 'run' and dim in existing.indexes and dim in run_ds.indexes:
+                    if not run_ds.indexes[dim].isin(existing.indexes[dim]).all():
+                        raise ValueError("Coordinate {} of the run does not match the "
+                                         "archive {}".format(dim, store_path))
+                    indexers[dim] = existing.indexes[dim]
+            run_ds = run_ds.reindex(indexers)
+            run_ds = run_ds.drop_vars([name for name in run_ds.variables
+                                       if 'run' not in run_ds[name].dims])
+        run_ds.to_zarr(store_path, append_dim='run', consolidated=True)
+    return True
+
+
+def open_archive(store_path):
+    '''
+    Open all runs of a Zarr archive lazily, sorted by run.
+    '''
+    ds = xr.open_zarr(store_path, consolidated=True)
+    return ds.sortby('run')